@@ -0,0 +1,130 @@
+import torch
+import torch.nn as nn
+from torch.nn.utils import parametrize
+import math
+
+import config
+
+
+class LoRA(nn.Module):
+    """
+    Low-rank adapter of a weight matrix, weight + scale * B x A, applied as a parametrization
+    """
+
+    def __init__(self, weight: torch.Tensor, rank=config.adapter_rank, alpha=config.adapter_alpha):
+        """
+
+        :param weight: the adapted weight, [out, in]
+        :param rank: rank of the delta
+        :param alpha: the delta is scaled by alpha / rank
+        """
+        super(LoRA, self).__init__()
+        out_features, in_features = weight.size()
+        self.scale = alpha / rank
+
+        self.lora_a = nn.Parameter(weight.new_empty((rank, in_features)))
+        # zero init of B, so that the adapted model starts as the base model
+        self.lora_b = nn.Parameter(weight.new_zeros((out_features, rank)))
+        nn.init.kaiming_uniform_(self.lora_a, a=math.sqrt(5))
+
+    def forward(self, weight):
+        return weight + self.scale * torch.mm(self.lora_b, self.lora_a)
+
+
+def get_adapter_config(adapter_config=None) -> dict:
+    """
+    rank, alpha and skipped modules of adapters, default to config
+    :param adapter_config: dict overriding some of them
+    """
+    adapter_config_ = {
+        'rank': config.adapter_rank,
+        'alpha': config.adapter_alpha,
+        'skip_modules': config.adapter_skip_modules
+    }
+    if adapter_config:
+        adapter_config_.update(adapter_config)
+    return adapter_config_
+
+
+def adapted_weights(model: nn.Module, skip_modules=()):
+    """
+    names of weights of gru and linear layers of model
+    :return: list of (module name, module, weight name)
+    """
+    weights = []
+    for module_name, module in model.named_modules():
+        if module_name in skip_modules:
+            continue
+        if isinstance(module, nn.GRU):
+            weights += [(module_name, module, name) for name, _ in module.named_parameters(recurse=False)
+                        if name.startswith('weight_')]
+        elif isinstance(module, nn.Linear):
+            weights.append((module_name, module, 'weight'))
+    return weights
+
+
+def inject_adapters(model: nn.Module, adapter_config=None) -> list:
+    """
+    freeze the model and add low-rank adapters to weights of its gru and linear layers
+    :param model: models.Model
+    :param adapter_config: see get_adapter_config
+    :return: parameters of adapters
+    """
+    adapter_config = get_adapter_config(adapter_config)
+    for param in model.parameters():
+        param.requires_grad_(False)
+
+    params = []
+    for _, module, name in adapted_weights(model, adapter_config['skip_modules']):
+        lora = LoRA(getattr(module, name), rank=adapter_config['rank'], alpha=adapter_config['alpha'])
+        parametrize.register_parametrization(module, name, lora)
+        params += list(lora.parameters())
+    return params
+
+
+def adapter_state_dict(model: nn.Module) -> dict:
+    """
+    copy of parameters of adapters only, keyed as in model.state_dict()
+    """
+    return {key: value.detach().clone() for key, value in model.state_dict().items()
+            if key.endswith('.lora_a') or key.endswith('.lora_b')}
+
+
+def adapter_factors(adapter_state: dict, adapter_config=None) -> dict:
+    """
+    low-rank factors of each adapted weight, from a state dict of adapter_state_dict
+    :return: dict, name of weight in model.named_parameters() -> (A, B, scale), delta of weight is scale * B x A
+    """
+    adapter_config = get_adapter_config(adapter_config)
+    scale = adapter_config['alpha'] / adapter_config['rank']
+    factors = {}
+    for key, value in adapter_state.items():
+        if not key.endswith('.lora_a'):
+            continue
+        # key: <module name>.parametrizations.<weight name>.0.lora_a
+        module_name, weight_key = key.split('.parametrizations.')
+        name = '{}.{}'.format(module_name, weight_key.split('.')[0])
+        factors[name] = (value, adapter_state[key[:-len('lora_a')] + 'lora_b'], scale)
+    return factors
+
+
+def merged_state_dict(model: nn.Module) -> dict:
+    """
+    state dict of model with adapters merged into the weights, loadable by a model without adapters
+    """
+    state_dict = {key: value for key, value in model.state_dict().items() if '.parametrizations.' not in key}
+    with torch.no_grad():
+        for module_name, module in model.named_modules():
+            if parametrize.is_parametrized(module):
+                for name in module.parametrizations.keys():
+                    state_dict[f'{module_name}.{name}'] = getattr(module, name).detach()
+    return state_dict
+
+
+def load_adapters(model: nn.Module, adapter_state: dict):
+    """
+    load parameters of adapters into a model with adapters injected
+    """
+    result = model.load_state_dict(adapter_state, strict=False)
+    if result.unexpected_keys:
+        raise Exception('Unexpected adapter parameters: {}'.format(result.unexpected_keys))
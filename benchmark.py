@@ -0,0 +1,481 @@
+import os
+import time
+import argparse
+import resource
+
+import torch
+from torch.utils.data import DataLoader
+
+import config
+import data
+import eval
+import models
+import translators
+import utils
+torch.manual_seed(1)
+
+dataset_dir = '../dataset_v2/original/'
+
+
+def fold_paths(project, num_fold, split='test'):
+    """
+    paths of code, sbt and comment of given fold of project
+    """
+    prefix = os.path.join(dataset_dir, f'{project}/fold_{num_fold}_{split}')
+    return prefix + '.code', prefix + '.sbt', prefix + '.comment'
+
+
+def load_vocabs():
+    code_vocab = utils.load_vocab_pk(config.code_vocab_path)
+    ast_vocab = utils.load_vocab_pk(config.ast_vocab_path)
+    nl_vocab = utils.load_vocab_pk(config.nl_vocab_path)
+    return code_vocab, ast_vocab, nl_vocab
+
+
+def load_model(model_path, code_vocab, ast_vocab, nl_vocab):
+    return models.Model(code_vocab_size=len(code_vocab),
+                        ast_vocab_size=len(ast_vocab),
+                        nl_vocab_size=len(nl_vocab),
+                        model_file_path=model_path,
+                        is_eval=True)
+
+
+def make_dataloader(dataset, code_vocab, ast_vocab, nl_vocab):
+    return DataLoader(dataset=dataset, batch_size=config.test_batch_size,
+                      collate_fn=lambda *args: utils.unsort_collate_fn(args,
+                                                                       code_vocab=code_vocab,
+                                                                       ast_vocab=ast_vocab,
+                                                                       nl_vocab=nl_vocab))
+
+
+def reset_peak_memory():
+    if config.use_cuda:
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+
+
+def peak_memory():
+    """
+    peak allocated memory in MB since last reset, only tracked on cuda
+    """
+    if config.use_cuda:
+        torch.cuda.synchronize()
+        return torch.cuda.max_memory_allocated() / 1024 / 1024
+    return float('nan')
+
+
+def process_peak_rss():
+    """
+    peak resident memory of this process in MB so far, for cpu where peak_memory is not tracked,
+    it is never reset, so it only grows over the benchmarks of one run
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def parameter_memory(model):
+    """
+    memory of the parameters of model in MB
+    """
+    return sum(param.numel() * param.element_size() for param in model.parameters()) / 1024 / 1024
+
+
+def time_ast_encoder(model, dataloader, train_mode):
+    """
+    time the ast encoder over the whole dataloader
+    :param train_mode: if True, run forward and backward, else forward only
+    :return: seconds, peak memory in MB, number of sbt tokens
+    """
+    n_tokens = 0
+    reset_peak_memory()
+    start_time = time.time()
+    for batch in dataloader:
+        ast_batch, ast_seq_lens = batch[2], batch[3]
+        n_tokens += sum(ast_seq_lens)
+        with torch.set_grad_enabled(train_mode):
+            ast_outputs, ast_hidden = model.ast_encoder(ast_batch, ast_seq_lens)
+            if train_mode:
+                (ast_outputs.sum() + ast_hidden.sum()).backward()
+    if config.use_cuda:
+        torch.cuda.synchronize()
+    return time.time() - start_time, peak_memory(), n_tokens
+
+
+def bench_sbt(args):
+    """
+    compare sbt and compact sbt: ast encoder time and memory, and test scores of the model trained on each
+    """
+    code_vocab, ast_vocab, nl_vocab = load_vocabs()
+    code_path, sbt_path, nl_path = fold_paths(args.testing, args.fold)
+    results = {}
+    for compact, model_path in ((False, args.model), (True, args.compact_model)):
+        name = 'compact sbt' if compact else 'sbt'
+        # without a compact model, the ast encoder of the sbt model is timed on compact sbt
+        config.use_compact_sbt = compact and model_path is not None
+        dataset = data.CodePtrDataset(code_path, sbt_path, nl_path, compact_sbt=compact)
+        dataloader = make_dataloader(dataset, code_vocab, ast_vocab, nl_vocab)
+        model = load_model(model_path if model_path else args.model, code_vocab, ast_vocab, nl_vocab)
+
+        infer_time, infer_memory, n_tokens = time_ast_encoder(model, dataloader, train_mode=False)
+        train_time, train_memory, _ = time_ast_encoder(model, dataloader, train_mode=True)
+        results[name] = {
+            'avg sbt length': n_tokens / len(dataset),
+            'encode time (s)': infer_time,
+            'encode peak memory (MB)': infer_memory,
+            'train time (s)': train_time,
+            'train peak memory (MB)': train_memory,
+        }
+        # scores only make sense for a model trained on the same representation
+        if model_path:
+            test_instance = eval.Test(model_path, code_path=code_path, ast_path=sbt_path, nl_path=nl_path)
+            results[name].update(test_instance.run_test())
+
+    config.use_compact_sbt = False
+    return results
+
+
+def time_encoders(model, dataloader, train_mode):
+    """
+    time the code and ast encoders over the whole dataloader
+    :param train_mode: if True, run forward and backward, else forward only
+    :return: seconds, peak memory in MB, number of code and sbt tokens
+    """
+    n_tokens = 0
+    reset_peak_memory()
+    start_time = time.time()
+    for batch in dataloader:
+        code_batch, code_seq_lens, ast_batch, ast_seq_lens = batch[:4]
+        n_tokens += sum(code_seq_lens) + sum(ast_seq_lens)
+        with torch.set_grad_enabled(train_mode):
+            code_outputs, code_hidden, ast_outputs, ast_hidden = model.run_encoders(code_batch, code_seq_lens,
+                                                                                    ast_batch, ast_seq_lens)
+            if train_mode:
+                (code_outputs.sum() + code_hidden.sum() + ast_outputs.sum() + ast_hidden.sum()).backward()
+    if config.use_cuda:
+        torch.cuda.synchronize()
+    return time.time() - start_time, peak_memory(), n_tokens
+
+
+def bench_encoder(args):
+    """
+    compare gru and transformer encoders: encoding throughput and memory, and test scores of the model trained with each
+    """
+    code_vocab, ast_vocab, nl_vocab = load_vocabs()
+    code_path, sbt_path, nl_path = fold_paths(args.testing, args.fold)
+    dataset = data.CodePtrDataset(code_path, sbt_path, nl_path)
+    dataloader = make_dataloader(dataset, code_vocab, ast_vocab, nl_vocab)
+    encoder_type = config.encoder_type
+    results = {}
+    for name, model_path in (('gru', args.model), ('transformer', args.transformer_model)):
+        config.encoder_type = name
+        # without a checkpoint, the encoder is randomly initialized and only its speed is measured,
+        # a checkpoint builds the encoder saved in its model_config
+        model = load_model(model_path, code_vocab, ast_vocab, nl_vocab)
+
+        infer_time, infer_memory, n_tokens = time_encoders(model, dataloader, train_mode=False)
+        model.train()
+        train_time, train_memory, _ = time_encoders(model, dataloader, train_mode=True)
+        results[name] = {
+            'encode tokens/s': n_tokens / infer_time,
+            'encode peak memory (MB)': infer_memory,
+            'train tokens/s': n_tokens / train_time,
+            'train peak memory (MB)': train_memory,
+        }
+        if model_path:
+            test_instance = eval.Test(model_path, code_path=code_path, ast_path=sbt_path, nl_path=nl_path)
+            results[name].update(test_instance.run_test())
+
+    config.encoder_type = encoder_type
+    return results
+
+
+def bench_parallel(args):
+    """
+    compare running the code and ast encoders one after another and concurrently, see config.use_parallel_encoders:
+    encoding throughput with each number of torch threads
+    """
+    code_vocab, ast_vocab, nl_vocab = load_vocabs()
+    code_path, sbt_path, nl_path = fold_paths(args.testing, args.fold)
+    dataset = data.CodePtrDataset(code_path, sbt_path, nl_path)
+    dataloader = make_dataloader(dataset, code_vocab, ast_vocab, nl_vocab)
+    model = load_model(args.model, code_vocab, ast_vocab, nl_vocab)
+    use_parallel_encoders = config.use_parallel_encoders
+    num_threads = torch.get_num_threads()
+    results = {}
+    for threads in args.threads:
+        torch.set_num_threads(threads)
+        encode_times = {}
+        for parallel in (False, True):
+            config.use_parallel_encoders = parallel
+            model.eval()
+            encode_times[parallel], _, n_tokens = time_encoders(model, dataloader, train_mode=False)
+        results[f'{threads} thread(s)'] = {
+            'sequential tokens/s': n_tokens / encode_times[False],
+            'parallel tokens/s': n_tokens / encode_times[True],
+            'speedup': encode_times[False] / encode_times[True],
+        }
+    config.use_parallel_encoders = use_parallel_encoders
+    torch.set_num_threads(num_threads)
+    return results
+
+
+def bench_distill(args):
+    """
+    compare teacher and distilled student: size, latency and peak memory of eval.Test, and test scores,
+    on cpu the peak resident memory of the process, the student is tested first as it never decreases
+    """
+    code_path, sbt_path, nl_path = fold_paths(args.testing, args.fold)
+    results = {}
+    for name, model_path in (('student', args.student_model), ('teacher', args.model)):
+        reset_peak_memory()
+        test_instance = eval.Test(model_path, code_path=code_path, ast_path=sbt_path, nl_path=nl_path)
+        start_time = time.time()
+        scores = test_instance.run_test()
+        test_time = time.time() - start_time
+        results[name] = {
+            'parameters': sum(param.numel() for param in test_instance.model.parameters()),
+            'parameter memory (MB)': parameter_memory(test_instance.model),
+            'test time (s)': test_time,
+            'summaries/s': test_instance.dataset_size / test_time,
+        }
+        if config.use_cuda:
+            results[name]['test peak memory (MB)'] = peak_memory()
+        else:
+            results[name]['process peak RSS (MB)'] = process_peak_rss()
+        results[name].update(scores)
+    return {name: results[name] for name in ('teacher', 'student')}
+
+
+def time_decode(test_instance):
+    """
+    time encoding and decoding of the test dataset of test_instance, without measuring
+    :return: seconds
+    """
+    start_time = time.time()
+    for batch in test_instance.dataloader:
+        test_instance.decode_batch(batch, batch[0].shape[1])
+    if config.use_cuda:
+        torch.cuda.synchronize()
+    return time.time() - start_time
+
+
+def bench_decode(args):
+    """
+    compare batched greedy decoding, beam search of widths 1 to 5 and sampling of config.num_samples summaries:
+    decoding speed and test scores, sampling is scored by its most likely sample
+    """
+    code_path, sbt_path, nl_path = fold_paths(args.testing, args.fold)
+    test_instance = eval.Test(args.model, code_path=code_path, ast_path=sbt_path, nl_path=nl_path)
+    beam_width = config.beam_width
+    results = {}
+    for name, decode_method, width in [('greedy', 'greedy', 1)] + \
+            [(f'beam {width}', 'beam', width) for width in range(1, 6)] + \
+            [(f'sample {config.num_samples}', 'sample', beam_width)]:
+        test_instance.decode_method = decode_method
+        config.beam_width = width
+        decode_time = time_decode(test_instance)
+        results[name] = {
+            'decode time (s)': decode_time,
+            'summaries/s': test_instance.dataset_size / decode_time,
+        }
+        results[name].update(test_instance.run_test())
+
+    config.beam_width = beam_width
+    return results
+
+
+def bench_shortlist(args):
+    """
+    compare decoding onto the whole comment vocabulary and onto shortlists: decoding speed and test scores
+    """
+    code_path, sbt_path, nl_path = fold_paths(args.testing, args.fold)
+    test_instance = eval.Test(args.model, code_path=code_path, ast_path=sbt_path, nl_path=nl_path,
+                              decode_method=args.decode_method, use_shortlist=True)
+    shortlist = test_instance.shortlist
+    shortlist_sizes = [shortlist.candidates(batch[0]).numel() for batch in test_instance.dataloader]
+    results = {}
+    for name, use_shortlist in (('full vocabulary', False), ('shortlist', True)):
+        test_instance.shortlist = shortlist if use_shortlist else None
+        decode_time = time_decode(test_instance)
+        results[name] = {
+            'output words': sum(shortlist_sizes) / len(shortlist_sizes) if use_shortlist
+            else test_instance.model.out_vocab_size,
+            'decode time (s)': decode_time,
+            'summaries/s': test_instance.dataset_size / decode_time,
+        }
+        results[name].update(test_instance.run_test())
+    return results
+
+
+def bench_length(args):
+    """
+    compare decoding with and without the caps and prior of the length predictor: decoding speed and test scores
+    """
+    code_path, sbt_path, nl_path = fold_paths(args.testing, args.fold)
+    test_instance = eval.Test(args.model, code_path=code_path, ast_path=sbt_path, nl_path=nl_path)
+    length_predictor = test_instance.model.length_predictor
+    if length_predictor is None:
+        raise Exception('Model \'{}\' has no length predictor, see config.use_length_predictor.'.format(args.model))
+    results = {}
+    for decode_method in ('greedy', 'beam'):
+        test_instance.decode_method = decode_method
+        for name, predictor in (('max steps', None), ('length predictor', length_predictor)):
+            test_instance.model.length_predictor = predictor
+            decode_time = time_decode(test_instance)
+            results[f'{decode_method}, {name}'] = {
+                'decode time (s)': decode_time,
+                'summaries/s': test_instance.dataset_size / decode_time,
+            }
+            results[f'{decode_method}, {name}'].update(test_instance.run_test())
+    return results
+
+
+def bench_ensemble(args):
+    """
+    compare decoding by each member alone, by all members one after another, and by their ensemble:
+    decoding speed and test scores
+    """
+    code_path, sbt_path, nl_path = fold_paths(args.testing, args.fold)
+    results = {}
+    total_time = 0
+    for model_path in args.models:
+        test_instance = eval.Test(model_path, code_path=code_path, ast_path=sbt_path, nl_path=nl_path,
+                                  decode_method=args.decode_method)
+        decode_time = time_decode(test_instance)
+        total_time += decode_time
+        results[model_path] = {
+            'decode time (s)': decode_time,
+            'summaries/s': test_instance.dataset_size / decode_time,
+        }
+        results[model_path].update(test_instance.run_test())
+    results['members one after another'] = {
+        'decode time (s)': total_time,
+        'summaries/s': test_instance.dataset_size / total_time,
+    }
+
+    test_instance = eval.Test(args.models, code_path=code_path, ast_path=sbt_path, nl_path=nl_path,
+                              decode_method=args.decode_method)
+    decode_time = time_decode(test_instance)
+    results[f'ensemble of {len(args.models)}'] = {
+        'decode time (s)': decode_time,
+        'summaries/s': test_instance.dataset_size / decode_time,
+    }
+    results[f'ensemble of {len(args.models)}'].update(test_instance.run_test())
+    return results
+
+
+def bench_translator(args):
+    """
+    compare validation by eval.Eval followed by testing by eval.Test, with one pass of translators.Translator:
+    wall time and scores
+    """
+    code_path, sbt_path, nl_path = fold_paths(args.testing, args.fold)
+    code_vocab, ast_vocab, nl_vocab = load_vocabs()
+    model = load_model(args.model, code_vocab, ast_vocab, nl_vocab)
+    results = {}
+
+    start_time = time.time()
+    eval_instance = eval.Eval(model.state_dict(), code_path=code_path, ast_path=sbt_path, nl_path=nl_path)
+    loss = eval_instance.run_eval()
+    test_instance = eval.Test(model, code_path=code_path, ast_path=sbt_path, nl_path=nl_path)
+    results['eval and test'] = {'loss': loss}
+    results['eval and test'].update(test_instance.run_test())
+    results['eval and test']['wall time (s)'] = time.time() - start_time
+
+    start_time = time.time()
+    translator = translators.Translator(model, code_path=code_path, ast_path=sbt_path, nl_path=nl_path)
+    _, results['translator'] = translator()
+    results['translator']['wall time (s)'] = time.time() - start_time
+    return results
+
+
+def bench_workers(args):
+    """
+    compare testing in one process and in shards of several worker processes: test time and scores,
+    the test in this process runs first, so workers start after the threads of torch and the encoders ran here
+    """
+    code_path, sbt_path, nl_path = fold_paths(args.testing, args.fold)
+    test_instance = eval.Test(args.model, code_path=code_path, ast_path=sbt_path, nl_path=nl_path)
+    config.test_worker_threads = args.worker_threads
+    results = {}
+    for workers in [0] + args.workers:
+        test_instance.workers = workers
+        start_time = time.time()
+        scores = test_instance.run_test()
+        test_time = time.time() - start_time
+        results[f'{max(workers, 1)} process(es)'] = {
+            'test time (s)': test_time,
+            'summaries/s': test_instance.dataset_size / test_time,
+        }
+        results[f'{max(workers, 1)} process(es)'].update(scores)
+    return results
+
+
+def print_results(results):
+    for name, result in results.items():
+        print(f'{name}:', end=' ')
+        config.logger.info(f'{name}:')
+        utils.print_test_scores(result, is_average=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark speed, memory and quality of model variants.')
+    subparsers = parser.add_subparsers(required=True)
+
+    sbt_parser = subparsers.add_parser('sbt', help='sbt versus compact sbt')
+    sbt_parser.add_argument('-m', '--model', type=str, required=True, help='model trained on sbt')
+    sbt_parser.add_argument('-c', '--compact_model', type=str, default=None, help='model trained on compact sbt')
+    sbt_parser.set_defaults(func=bench_sbt)
+
+    encoder_parser = subparsers.add_parser('encoder', help='gru versus transformer encoder')
+    encoder_parser.add_argument('-m', '--model', type=str, default=None, help='model trained with gru encoder')
+    encoder_parser.add_argument('-r', '--transformer_model', type=str, default=None,
+                                help='model trained with transformer encoder')
+    encoder_parser.set_defaults(func=bench_encoder)
+
+    parallel_parser = subparsers.add_parser('parallel', help='sequential versus concurrent code and ast encoders')
+    parallel_parser.add_argument('-m', '--model', type=str, default=None,
+                                 help='model to encode with, randomly initialized if not given')
+    parallel_parser.add_argument('-n', '--threads', type=int, nargs='+', default=[2, 4, 8])
+    parallel_parser.set_defaults(func=bench_parallel)
+
+    distill_parser = subparsers.add_parser('distill', help='teacher versus distilled student')
+    distill_parser.add_argument('-m', '--model', type=str, required=True, help='teacher model')
+    distill_parser.add_argument('-s', '--student_model', type=str, required=True, help='student model')
+    distill_parser.set_defaults(func=bench_distill)
+
+    decode_parser = subparsers.add_parser('decode', help='greedy decoding versus beam search and sampling')
+    decode_parser.add_argument('-m', '--model', type=str, required=True)
+    decode_parser.set_defaults(func=bench_decode)
+
+    shortlist_parser = subparsers.add_parser('shortlist', help='whole comment vocabulary versus shortlists')
+    shortlist_parser.add_argument('-m', '--model', type=str, required=True)
+    shortlist_parser.add_argument('-d', '--decode_method', type=str, default='greedy', choices=['greedy', 'beam'])
+    shortlist_parser.set_defaults(func=bench_shortlist)
+
+    length_parser = subparsers.add_parser('length', help='decoding with versus without length predictor')
+    length_parser.add_argument('-m', '--model', type=str, required=True, help='model with length predictor')
+    length_parser.set_defaults(func=bench_length)
+
+    ensemble_parser = subparsers.add_parser('ensemble', help='single models versus their ensemble')
+    ensemble_parser.add_argument('-m', '--models', type=str, nargs='+', required=True, help='members of ensemble')
+    ensemble_parser.add_argument('-d', '--decode_method', type=str, default='beam',
+                                 choices=['greedy', 'beam', 'sample'])
+    ensemble_parser.set_defaults(func=bench_ensemble)
+
+    translator_parser = subparsers.add_parser('translator', help='eval and test versus one pass of translator')
+    translator_parser.add_argument('-m', '--model', type=str, required=True)
+    translator_parser.set_defaults(func=bench_translator)
+
+    workers_parser = subparsers.add_parser('workers', help='one process versus sharded test in worker processes')
+    workers_parser.add_argument('-m', '--model', type=str, required=True)
+    workers_parser.add_argument('-w', '--workers', type=int, nargs='+', default=[2, 4, 8])
+    workers_parser.add_argument('-n', '--worker_threads', type=int, default=2,
+                                help='torch threads of each worker, 0 to share the threads of this process')
+    workers_parser.set_defaults(func=bench_workers)
+
+    for sub_parser in subparsers.choices.values():
+        sub_parser.add_argument('-t', '--testing', type=str, default='flink')
+        sub_parser.add_argument('-f', '--fold', type=int, default=0)
+
+    args = parser.parse_args()
+    print_results(args.func(args))
@@ -0,0 +1,18 @@
+import os
+
+import utils
+import config
+import data
+import shortlist
+
+code_path='../dataset_v2/original/train.code'
+ast_path='../dataset_v2/original/train.sbt'
+nl_path='../dataset_v2/original/train.comment'
+lexical_table_path = 'lexical_table.pk'
+dataset = data.CodePtrDataset(code_path,ast_path,nl_path)
+codes, _, nls = dataset.get_dataset()
+
+# comment words likely for each code word, for the shortlists of decoding, see config.shortlist_lexical_path
+lexical_table = shortlist.build_lexical_table(codes, nls)
+utils.save_pickle(lexical_table, os.path.join(config.vocab_dir, lexical_table_path))
+print("Lexical table code words: ", len(lexical_table))
@@ -74,9 +74,15 @@ trim_vocab_max_size = True
 use_coverage = False
 use_pointer_gen = False
 use_teacher_forcing = True
+use_batch_shrinking = True     # in evaluation, stop decoding sequences that are finished
 use_check_point = False
 use_lr_decay = True
 use_early_stopping = True
+use_parallel_encoders = False    # run code and ast encoders concurrently on cpu, see benchmark.py parallel before enabling
+use_activation_checkpoint = False    # recompute encoder and decoder activations in backward to save memory
+use_compact_sbt = False     # feed ast encoder with compact sbt, about half the length of sbt, must match a checkpoint
+use_sparse_embedding = False    # sparse gradients for embeddings, updated by utils.RowSparseAdam
+use_length_predictor = False    # train a head predicting summary length, which caps decoding steps of each example
 
 validate_during_train = True
 save_valid_model = True
@@ -91,10 +97,16 @@ min_nl_length = 4
 max_decode_steps = 30
 early_stopping_patience = 3
 early_stopping_patience_meta = 3
+decoder_checkpoint_steps = 10    # decoder steps per checkpointed chunk, 0 checkpoints encoders only
 
 
 # hyperparameters
 vocab_min_count = 5
+encoder_type = 'gru'    # 'gru' or 'transformer', for both code and ast encoder, a checkpoint keeps its own
+transformer_layers = 2
+transformer_heads = 8
+transformer_ff_size = 1024
+transformer_dropout_rate = 0.1
 code_vocab_size = 50000  # 30000
 nl_vocab_size = 30000    # 30000
 
@@ -103,6 +115,16 @@ embedding_dim = 256
 hidden_size = 256
 decoder_dropout_rate = 0.5
 teacher_forcing_ratio = 0.5
+length_loss_weight = 0.1    # weight of the loss of the length predictor
+student_hidden_size = 128
+student_embedding_dim = 128
+student_nl_vocab_size = 10000
+distill_temperature = 2.0
+distill_alpha = 0.5     # weight of the distillation loss, the rest is the loss on targets
+adapter_rank = 8
+adapter_alpha = 16
+adapter_skip_modules = ['decoder.out']     # the output layer has a row per comment word
+adapter_cache_size = 32     # number of per-project adapters kept in memory for inference
 batch_size = 32     # 128
 code_encoder_lr = 0.001
 ast_encoder_lr = 0.001
@@ -113,10 +135,27 @@ lr_decay_rate = 0.99
 n_epochs = 50    # 50
 support_batch_size=16
 query_batch_size=16
+inner_train_steps = 2   # adaptation steps of each task in meta training
+decode_method = 'beam'     # 'beam', 'greedy' or 'sample', greedy is much faster for bulk summarization
 beam_width = 5
 beam_top_sentences = 1     # number of sentences beam decoder decode for one input
+num_samples = 5     # sentences sample decoder samples for one input
+sample_temperature = 1.0
+sample_top_k = 0    # sample from the k most likely words only, 0 for all words
+sample_top_p = 1.0  # sample from the most likely words of this total probability only, 1.0 for all words
+length_cap_probability = 0.95   # decoding stops at the predicted length of this probability, see use_length_predictor
+length_cap_margin = 2   # steps allowed after the predicted length
+length_prior_weight = 0.5   # weight of the predicted length prob added to the log prob of EOS, 0 for no prior
+use_shortlist = False   # decoder projects only onto a shortlist of comment words of each test batch
+shortlist_size = 2000   # number of the most frequent comment words in every shortlist
+shortlist_lexical_path = None   # file in vocab_dir of the lexical table, see buildlexicaltable.py, or None
+shortlist_lexical_top_k = 10    # comment words the lexical table keeps for each code word
 eval_batch_size = 32    # 16
 test_batch_size = 16
+test_workers = 0    # processes eval.Test decodes and measures shards of the test set in, 0 or 1 for this process only
+test_worker_threads = 0     # torch threads of each test worker, 0 to share the threads of this process among them
+metric_workers = 0  # processes scoring decoded batches while the next batches decode, 0 to score in between
+meteor_cache_path = None    # file in out_dir of stems and synonyms meteor looked up, kept across runs, or None
 init_uniform_mag = 0.02
 init_normal_std = 1e-4
 
@@ -133,14 +172,18 @@ validate_every = 5000     # 2000
 save_config = True
 
 config_be_saved = ['dataset_dir', 'use_cuda', 'device', 'use_coverage', 'use_pointer_gen', 'use_teacher_forcing',
-                   'use_lr_decay', 'use_early_stopping', 'max_code_length', 'max_nl_length', 'min_nl_length',
+                   'use_compact_sbt', 'use_lr_decay', 'use_early_stopping', 'max_code_length', 'max_nl_length', 'min_nl_length',
                    'max_decode_steps', 'early_stopping_patience']
 
-train_config_be_saved = ['embedding_dim', 'hidden_size', 'decoder_dropout_rate', 'teacher_forcing_ratio',
+train_config_be_saved = ['encoder_type', 'embedding_dim', 'hidden_size', 'decoder_dropout_rate', 'teacher_forcing_ratio',
+                         'use_length_predictor', 'length_loss_weight',
                          'batch_size', 'code_encoder_lr', 'ast_encoder_lr', 'reduce_hidden_lr',
                          'decoder_lr', 'lr_decay_every', 'lr_decay_rate', 'n_epochs']
 
-eval_config_be_saved = ['beam_width', 'beam_top_sentences', 'eval_batch_size', 'test_batch_size']
+eval_config_be_saved = ['decode_method', 'beam_width', 'beam_top_sentences', 'num_samples', 'sample_temperature',
+                        'sample_top_k', 'sample_top_p', 'length_cap_probability', 'length_cap_margin',
+                        'length_prior_weight', 'use_shortlist', 'shortlist_size', 'eval_batch_size', 'test_batch_size',
+                        'test_workers', 'test_worker_threads', 'metric_workers', 'meteor_cache_path']
 
 if save_config:
     config_dict = locals()
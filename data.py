@@ -1,16 +1,22 @@
 from torch.utils.data import Dataset
 
 import utils
+import config
 
 
 class CodePtrDataset(Dataset):
 
-    def __init__(self, code_path, ast_path, nl_path,num_of_data=-1,seed=1):
+    def __init__(self, code_path, ast_path, nl_path,num_of_data=-1,seed=1,compact_sbt=None):
         # get lines
         codes = utils.load_dataset(code_path,num_of_data,seed)
         asts = utils.load_dataset(ast_path,num_of_data,seed)
         nls = utils.load_dataset(nl_path,num_of_data,seed)
 
+        if compact_sbt is None:
+            compact_sbt = config.use_compact_sbt
+        if compact_sbt:
+            asts = [utils.compact_sbt(ast) for ast in asts]
+
         if len(codes) != len(asts) or len(codes) != len(nls) or len(asts) != len(nls):
             raise Exception('The lengths of three dataset do not match.')
 
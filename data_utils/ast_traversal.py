@@ -1,4 +1,5 @@
 import json
+import argparse
 
 
 def SBT_(cur_root_id, node_list):
@@ -18,15 +19,36 @@ def SBT_(cur_root_id, node_list):
     return tmp_list
 
 
+def SBT_compact(cur_root_id, node_list):
+    """
+    compact sbt, the type of a node opens it and a single ")" closes it, eg. "A B ) C ) )"
+    for "( A ( B ) B ( C ) C ) A", half of the tokens of SBT_ while the tree is still recoverable
+    """
+    cur_root = node_list[cur_root_id]
+    tmp_list = [cur_root['type']]
+
+    if 'children' in cur_root:
+        for ch in cur_root['children']:
+            tmp_list.extend(SBT_compact(ch, node_list))
+    tmp_list.append(")")
+    return tmp_list
+
 
-def get_sbt_structure(ast_file, out_file):
+def get_sbt_structure(ast_file, out_file, compact=False):
+    sbt = SBT_compact if compact else SBT_
     with open(ast_file, 'r') as ast_file:
         with open(out_file, 'w+') as out:
             asts = ast_file.readlines()
             for a in asts:
                 a = json.loads(a)
-                ast_sbt = SBT_(0, a)
+                ast_sbt = sbt(0, a)
                 out.write(' '.join(ast_sbt) + '\n')
 
 
-get_sbt_structure("test/test_ast.json", "test.token.ast")
\ No newline at end of file
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serialize asts into sbt sequences.')
+    parser.add_argument('ast_file', nargs='?', default='test/test_ast.json')
+    parser.add_argument('out_file', nargs='?', default='test.token.ast')
+    parser.add_argument('-c', '--compact', action='store_true', help='write compact sbt')
+    args = parser.parse_args()
+    get_sbt_structure(args.ast_file, args.out_file, compact=args.compact)
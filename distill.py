@@ -0,0 +1,96 @@
+import torch
+import torch.nn.functional as F
+
+import utils
+import config
+import models
+import train
+
+
+class Distill(train.Train):
+    """
+    Train a small student model on the soft targets of a trained teacher model
+    """
+
+    def __init__(self, teacher_model_file_path, hidden_size=config.student_hidden_size,
+                 embedding_dim=config.student_embedding_dim, nl_vocab_size=config.student_nl_vocab_size,
+                 temperature=config.distill_temperature, alpha=config.distill_alpha, **kwargs):
+        """
+
+        :param teacher_model_file_path: checkpoint of the teacher model
+        :param hidden_size: hidden size of the student
+        :param embedding_dim: embedding dim of the student
+        :param nl_vocab_size: the student predicts only the first nl_vocab_size words of the comment vocabulary
+        :param temperature: temperature of soft targets of teacher and predictions of student
+        :param alpha: weight of the distillation loss, the rest is the loss on targets
+        :param kwargs: passed to train.Train
+        """
+        self.temperature = temperature
+        self.alpha = alpha
+        model_config = {
+            'hidden_size': hidden_size,
+            'embedding_dim': embedding_dim,
+            'nl_vocab_size': nl_vocab_size
+        }
+        super(Distill, self).__init__(model_config=model_config, **kwargs)
+
+        self.teacher = models.Model(code_vocab_size=self.code_vocab_size,
+                                    ast_vocab_size=self.ast_vocab_size,
+                                    nl_vocab_size=self.nl_vocab_size,
+                                    model_file_path=teacher_model_file_path,
+                                    is_eval=True)
+        for param in self.teacher.parameters():
+            param.requires_grad_(False)
+
+    def train_one_batch(self, batch, batch_size, criterion, encoder_states=None):
+        """
+        train one batch on soft targets of teacher and targets,
+        both models are fed the targets at every step, so that they predict from the same prefix
+        :param batch: get from collate_fn of corresponding dataloader
+        :param batch_size: batch size
+        :param criterion: loss function on targets
+        :param encoder_states: cached encoder states of the batch for the student, see Model.encode
+        :return: avg loss
+        """
+        out_vocab_size = self.model.out_vocab_size
+        teacher_forcing = [True] * max(batch[5])
+
+        with torch.no_grad():
+            teacher_outputs = self.teacher(batch, batch_size, self.nl_vocab,
+                                           teacher_forcing=teacher_forcing)   # [T, B, teacher_vocab_size]
+            # soft targets over the student vocabulary
+            soft_targets = F.softmax(teacher_outputs[:, :, :out_vocab_size] / self.temperature, dim=2)
+
+        nl_batch = utils.restrict_vocab(batch[4], out_vocab_size, self.nl_vocab)
+        batch = (*batch[:4], nl_batch, batch[5])
+
+        self.optimizer.zero_grad()
+        if self.sparse_optimizer is not None:
+            self.sparse_optimizer.zero_grad()
+
+        if encoder_states is None and self.model.length_predictor is not None:
+            encoder_states = self.model.encode(batch)
+        decoder_outputs = self.model(batch, batch_size, self.nl_vocab, teacher_forcing=teacher_forcing,
+                                     encoder_states=encoder_states)     # [T, B, out_vocab_size]
+
+        # kl divergence on every non-pad position, scaled by temperature^2 to keep the gradient scale
+        log_probs = F.log_softmax(decoder_outputs / self.temperature, dim=2)
+        kl = F.kl_div(log_probs, soft_targets, reduction='none').sum(dim=2)    # [T, B]
+        mask = nl_batch.ne(utils.get_pad_index(self.nl_vocab)).float()
+        distill_loss = (kl * mask).sum() / mask.sum() * self.temperature ** 2
+
+        target_loss = criterion(decoder_outputs.view(-1, out_vocab_size), nl_batch.view(-1))
+
+        loss = self.alpha * distill_loss + (1 - self.alpha) * target_loss
+        if self.model.length_predictor is not None:
+            loss = loss + config.length_loss_weight * self.model.length_loss(encoder_states[2], batch[5])
+        loss.backward()
+
+        # address over fit
+        utils.clip_grad_norm(self.model.parameters(), 5)
+
+        self.optimizer.step()
+        if self.sparse_optimizer is not None:
+            self.sparse_optimizer.step()
+
+        return loss
@@ -0,0 +1,142 @@
+import torch
+import torch.nn as nn
+from torch.func import stack_module_state, functional_call, vmap
+import copy
+
+import models
+
+
+class EnsembleDecoder(nn.Module):
+    """
+    Decoders of all members of an ensemble, their parameters are stacked and a step of all of them is one vmapped call,
+    states of members are in the second to last dimension: hidden [1, B, M, H], encoder outputs [T, B, M, H],
+    so that eval.Test selects and reorders rows of them as those of a single model
+    """
+
+    def __init__(self, decoders):
+        """
+
+        :param decoders: list of models.Decoder of the same sizes
+        """
+        super(EnsembleDecoder, self).__init__()
+        self.num_members = len(decoders)
+        self.hidden_size = decoders[0].hidden_size
+        self.params, self.buffers = stack_module_state(decoders)
+
+        # a weightless copy to call with the stacked parameters, no gate table as the weights are not its own
+        self.template = copy.deepcopy(decoders[0]).to('meta')
+        self.template.use_gate_table = False
+        self.template.eval()
+
+    def forward(self, inputs: torch.Tensor, last_hidden: torch.Tensor,
+                code_outputs: torch.Tensor, ast_outputs: torch.Tensor, keys=None, shortlist=None):
+        """
+        one step of all members, see models.Decoder.forward
+        :param inputs: word input of current time step, [B]
+        :param last_hidden: [1, B, M, H]
+        :param code_outputs: [T, B, M, H]
+        :param ast_outputs: [T, B, M, H]
+        :param keys: if given, project_keys(code_outputs, ast_outputs)
+        :param shortlist: if given, shortlist_out(indices) of the only words to predict
+        :return: output: log probs averaged over members, [B, nl_vocab_size]
+                hidden: [1, B, M, H]
+                None, None for attention weights
+        """
+        if keys is None:
+            keys = self.project_keys(code_outputs, ast_outputs)
+
+        def step(params, buffers, last_hidden, code_outputs, ast_outputs, code_keys, ast_keys, shortlist):
+            outputs, hidden, _, _ = functional_call(self.template, (params, buffers),
+                                                    (inputs, last_hidden, code_outputs, ast_outputs),
+                                                    {'keys': (code_keys, ast_keys), 'shortlist': shortlist})
+            return outputs, hidden
+
+        in_dims = (0, 0, 2, 2, 2, 2, 2, 0 if shortlist is not None else None)
+        outputs, hidden = vmap(step, in_dims=in_dims)(self.params, self.buffers, last_hidden, code_outputs,
+                                                      ast_outputs, *keys, shortlist)     # [M, B, V], [M, 1, B, H]
+        return outputs.mean(dim=0), hidden.movedim(0, 2), None, None
+
+    def project_keys(self, code_outputs, ast_outputs):
+        """
+        keys of both attentions of all members, see models.Decoder.project_keys
+        :return: code_keys: [T, B, M, H]
+                ast_keys: [T, B, M, H]
+        """
+        keys = []
+        for name, encoder_outputs in (('code_attention', code_outputs), ('ast_attention', ast_outputs)):
+            weight = self.params[name + '.attn.weight'][:, :, self.hidden_size:]     # [M, H, H]
+            bias = self.params[name + '.attn.bias']     # [M, H]
+            keys.append(torch.einsum('tbmh,mgh->tbmg', encoder_outputs, weight) + bias)
+        return tuple(keys)
+
+    def shortlist_out(self, indices):
+        """
+        rows of the output layers of all members for given words only, see models.Decoder.shortlist_out
+        :return: weight: [M, V', 2H]
+                bias: [M, V']
+        """
+        return self.params['out.weight'].index_select(1, indices), self.params['out.bias'].index_select(1, indices)
+
+
+class Ensemble(nn.Module):
+    """
+    Ensemble of models of several checkpoints, used by eval.Test in place of a models.Model,
+    members encode one after another once per batch, and decode together as one vmapped step,
+    averaging their log probs
+    """
+
+    def __init__(self, models_, code_vocab_size, ast_vocab_size, nl_vocab_size):
+        """
+
+        :param models_: list of file names, state dicts or instances of models.Model, of the same sizes
+        :param code_vocab_size:
+        :param ast_vocab_size:
+        :param nl_vocab_size:
+        """
+        super(Ensemble, self).__init__()
+        members = []
+        for model in models_:
+            if isinstance(model, models.Model):
+                members.append(model)
+            elif isinstance(model, str):
+                members.append(models.Model(code_vocab_size=code_vocab_size, ast_vocab_size=ast_vocab_size,
+                                            nl_vocab_size=nl_vocab_size, model_file_path=model, is_eval=True))
+            elif isinstance(model, dict):
+                members.append(models.Model(code_vocab_size=code_vocab_size, ast_vocab_size=ast_vocab_size,
+                                            nl_vocab_size=nl_vocab_size, model_state_dict=model, is_eval=True))
+            else:
+                raise Exception('Members of \'Ensemble\' must be file names, state_dicts or instances of the model.')
+
+        sizes = {(member.model_config['hidden_size'], member.out_vocab_size) for member in members}
+        if len(sizes) > 1:
+            raise Exception('Members of \'Ensemble\' must have the same hidden size and output vocabulary, '
+                            'got: {}'.format(sorted(sizes)))
+
+        self.decoder = EnsembleDecoder([member.decoder for member in members])
+        # the stacked parameters replace the decoders of members, only their encoders are used
+        for member in members:
+            member.decoder = None
+        self.members = nn.ModuleList(members)
+
+        self.model_config = members[0].model_config
+        self.out_vocab_size = members[0].out_vocab_size
+        self.length_predictor = None
+        self.is_eval = True
+
+    def forward(self, batch, batch_size, nl_vocab, is_test=True):
+        """
+        encode the batch by all members, only for decoding by eval.Test
+        :return: code_outputs: [T, B, M, H]
+                ast_outputs: [T, B, M, H]
+                decoder_hidden: [1, B, M, H]
+        """
+        if not is_test:
+            raise Exception('Ensemble only encodes, decoding is done by eval.Test.')
+        return self.encode(batch)
+
+    def encode(self, batch):
+        """
+        encoder states of all members, see models.Model.encode
+        """
+        states = [member.encode(batch) for member in self.members]
+        return tuple(torch.stack(member_states, dim=2) for member_states in zip(*states))
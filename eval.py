@@ -1,14 +1,20 @@
 import torch
 import torch.nn as nn
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, Subset
 
 import os
 import time
+import multiprocessing
+import pickle
+from collections import deque
 
 import models
 import data
 import utils
+import metrics
 import config
+import shortlist
+import ensemble
 torch.manual_seed(1)
 
 class Eval(object):
@@ -79,8 +85,8 @@ class Eval(object):
 
             decoder_outputs = self.model(batch, batch_size, self.nl_vocab)  # [T, B, nl_vocab_size]
 
-            decoder_outputs = decoder_outputs.view(-1, config.nl_vocab_size)
-            nl_batch = nl_batch.view(-1)
+            decoder_outputs = decoder_outputs.view(-1, self.model.out_vocab_size)
+            nl_batch = utils.restrict_vocab(nl_batch, self.model.out_vocab_size, self.nl_vocab).view(-1)
 
             loss = criterion(decoder_outputs, nl_batch)
 
@@ -110,29 +116,45 @@ class Eval(object):
         self.model.load_state_dict(state_dict)
 
 
-class BeamNode(object):
-
-    def __init__(self, sentence_indices, log_probs, hidden):
-        """
-
-        :param sentence_indices: indices of words of current sentence (from root to current node)
-        :param log_probs: log prob of node of sentence
-        :param hidden: [1, 1, H]
-        """
-        self.sentence_indices = sentence_indices
-        self.log_probs = log_probs
-        self.hidden = hidden
-
-    def extend_node(self, word_index, log_prob, hidden):
-        return BeamNode(sentence_indices=self.sentence_indices + [word_index],
-                        log_probs=self.log_probs + [log_prob],
-                        hidden=hidden)
-
-    def avg_log_prob(self):
-        return sum(self.log_probs) / len(self.sentence_indices)
-
-    def word_index(self):
-        return self.sentence_indices[-1]
+# instance of Test whose test set worker processes are testing shards of, see Test.iter_sharded_test_batches
+_sharded_test = None
+
+# types of the values of config passed on to worker processes
+_config_value_types = (bool, int, float, str, list, tuple, type(None), torch.device)
+
+
+def _init_test_worker(num_threads, config_values, meteor_cache, test_state):
+    """
+    set up a worker process of Test.iter_sharded_test_batches, which is not forked from the testing process
+    :param num_threads: torch threads of the worker
+    :param config_values: values of config in the testing process, which may differ from those of config.py
+    :param meteor_cache: stems and synonyms looked up for meteor, see metrics.get_meteor_cache
+    :param test_state: the pickled instance of Test, loaded after config is set as its dataloader is built from config
+    """
+    global _sharded_test
+    vars(config).update(config_values)
+    metrics.update_meteor_cache(meteor_cache)
+    torch.set_num_threads(num_threads)
+    _sharded_test = pickle.loads(test_state)
+
+
+def _test_shard(shard):
+    """
+    test batches [start, end) of the test set of _sharded_test, in a worker process
+    :param shard: start, end
+    :return: start, list of index_batch, batch_size and results of test_one_batch of every batch
+    """
+    start, end = shard
+    test = _sharded_test
+    test_batch_size = test.dataloader.batch_size
+    indices = range(start * test_batch_size, min(end * test_batch_size, test.dataset_size))
+    dataloader = DataLoader(dataset=Subset(test.dataset, indices), batch_size=test_batch_size,
+                            collate_fn=test.dataloader.collate_fn)
+    results = []
+    for index_batch, batch in enumerate(dataloader, start):
+        batch_size = batch[0].shape[1]
+        results.append((index_batch, batch_size, test.test_one_batch(batch, batch_size)))
+    return start, results
 
 
 class Test(object):
@@ -140,7 +162,16 @@ class Test(object):
     def __init__(self, model,code_path=config.test_code_path,
                                 ast_path=config.test_sbt_path,
                                 nl_path=config.test_nl_path
-                                ,vocab_path=None):
+                                ,vocab_path=None,decode_method=None,use_shortlist=None,workers=None):
+        """
+
+        :param decode_method: 'beam' or 'greedy', default to config.decode_method
+        :param use_shortlist: whether to decode onto a shortlist of comment words of each batch,
+                              default to config.use_shortlist
+        :param workers: number of processes to test in, default to config.test_workers, see iter_test_batches
+        """
+        self.decode_method = decode_method if decode_method else config.decode_method
+        self.workers = workers if workers is not None else config.test_workers
 
         # vocabulary
         if vocab_path==None:
@@ -156,22 +187,20 @@ class Test(object):
         self.ast_vocab_size = len(self.ast_vocab)
         self.nl_vocab_size = len(self.nl_vocab)
 
-        self.dataset = data.CodePtrDataset(code_path,
-                                           ast_path,
-                                           nl_path)
-        self.dataset_size = len(self.dataset)
-        self.dataloader = DataLoader(dataset=self.dataset,
-                                     batch_size=config.test_batch_size,
-                                     collate_fn=lambda *args: utils.unsort_collate_fn(args,
-                                                                                      code_vocab=self.code_vocab,
-                                                                                      ast_vocab=self.ast_vocab,
-                                                                                      nl_vocab=self.nl_vocab,
-                                                                                      raw_nl=True))
-
-        
+        # without code_path, only the model and decoding are set up, e.g. for inference
+        self.dataset = None
+        self.dataset_size = 0
+        if code_path is not None:
+            self.dataset = data.CodePtrDataset(code_path,
+                                               ast_path,
+                                               nl_path)
+            self.dataset_size = len(self.dataset)
+            self.dataloader = self.build_dataloader()
 
         # model
-        if isinstance(model, str):
+        if isinstance(model, (models.Model, ensemble.Ensemble)):
+            self.model = model
+        elif isinstance(model, str):
             self.model = models.Model(code_vocab_size=self.code_vocab_size,
                                       ast_vocab_size=self.ast_vocab_size,
                                       nl_vocab_size=self.nl_vocab_size,
@@ -183,8 +212,42 @@ class Test(object):
                                       nl_vocab_size=self.nl_vocab_size,
                                       model_state_dict=model,
                                       is_eval=True)
+        elif isinstance(model, (list, tuple)):
+            # an ensemble of several models
+            self.model = ensemble.Ensemble(model,
+                                           code_vocab_size=self.code_vocab_size,
+                                           ast_vocab_size=self.ast_vocab_size,
+                                           nl_vocab_size=self.nl_vocab_size)
         else:
-            raise Exception('Parameter \'model\' for class \'Test\' must be file name or state_dict of the model.')
+            raise Exception('Parameter \'model\' for class \'Test\' must be file name, state_dict, instance of the model, '
+                            'or list of them for an ensemble.')
+
+        if use_shortlist is None:
+            use_shortlist = config.use_shortlist
+        self.shortlist = None
+        if use_shortlist:
+            self.shortlist = shortlist.load_shortlist(self.code_vocab, self.nl_vocab,
+                                                      out_vocab_size=self.model.out_vocab_size)
+
+    def build_dataloader(self) -> DataLoader:
+        return DataLoader(dataset=self.dataset,
+                          batch_size=config.test_batch_size,
+                          collate_fn=lambda *args: utils.unsort_collate_fn(args,
+                                                                           code_vocab=self.code_vocab,
+                                                                           ast_vocab=self.ast_vocab,
+                                                                           nl_vocab=self.nl_vocab,
+                                                                           raw_nl=True))
+
+    def __getstate__(self):
+        # the collate function of the dataloader is a closure, which does not pickle, the dataloader is built again
+        state = self.__dict__.copy()
+        state.pop('dataloader', None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.dataset is not None:
+            self.dataloader = self.build_dataloader()
 
     def run_test(self) -> dict:
         """
@@ -208,27 +271,86 @@ class Test(object):
         :param batch_size:
         :return:
         """
-        with torch.no_grad():
-            nl_batch = batch[4]
+        nl_batch = batch[4]
 
-            # outputs: [T, B, H]
-            # hidden: [1, B, H]
-            code_outputs, ast_outputs, decoder_hidden = \
-                self.model(batch, batch_size, self.nl_vocab, is_test=True)
+        candidates = self.decode_batch(batch, batch_size)
 
-            # decode
-            batch_sentences = self.beam_decode(batch_size=batch_size,
-                                               code_outputs=code_outputs,
-                                               ast_outputs=ast_outputs,
-                                               decoder_hidden=decoder_hidden)
+        # measure
+        s_blue_score, meteor_score,rouge_score = utils.measure(batch_size, references=nl_batch, candidates=candidates)
 
-            # translate indices into words both for candidates
-            candidates = self.translate_indices(batch_sentences)
+        return nl_batch, candidates, s_blue_score, meteor_score,rouge_score
 
-            # measure
-            s_blue_score, meteor_score,rouge_score = utils.measure(batch_size, references=nl_batch, candidates=candidates)
+    def decode_batch(self, batch, batch_size, encoder_states=None):
+        """
+        encode and decode one batch into words
+        :param batch: get from collate_fn, nl_batch is not used
+        :param batch_size:
+        :param encoder_states: if given, outputs of self.model.encode for the batch, which is not encoded again
+        :return: candidates, words of the best sentence of every example, [B, T]
+        """
+        if self.decode_method == 'greedy':
+            decode = self.greedy_decode
+        elif self.decode_method == 'beam':
+            decode = self.beam_decode
+        elif self.decode_method == 'sample':
+            decode = self.sample_decode
+        else:
+            raise Exception('Unknown decode method: \'{}\''.format(self.decode_method))
+
+        batch_sentences = self.encode_decode(batch, batch_size, decode, encoder_states=encoder_states)
+        if self.decode_method == 'sample':
+            # the most likely samples
+            batch_sentences = [sentences[: config.beam_top_sentences] for sentences in batch_sentences]
 
-            return nl_batch, candidates, s_blue_score, meteor_score,rouge_score
+        # translate indices into words both for candidates
+        return self.translate_indices(batch_sentences)
+
+    def sample_batch(self, batch, batch_size):
+        """
+        encode one batch and sample config.num_samples summaries of every example
+        :param batch: get from collate_fn, nl_batch is not used
+        :param batch_size:
+        :return: words of the samples of every example, the most likely first, [B, N, T]
+        """
+        batch_sentences = self.encode_decode(batch, batch_size, self.sample_decode)
+        return [self.translate_indices([[sentence] for sentence in sentences]) for sentences in batch_sentences]
+
+    def encode_decode(self, batch, batch_size, decode, encoder_states=None):
+        """
+        encode one batch and decode it by given decode method
+        :param decode: one of self.greedy_decode, self.beam_decode and self.sample_decode
+        :param encoder_states: if given, outputs of self.model.encode for the batch, which is not encoded again
+        :return: batch_sentences of decode
+        """
+        with torch.no_grad():
+            # outputs: [T, B, H]
+            # hidden: [1, B, H]
+            if encoder_states is None:
+                encoder_states = self.model(batch, batch_size, self.nl_vocab, is_test=True)
+            code_outputs, ast_outputs, decoder_hidden = encoder_states
+
+            candidates = None
+            if self.shortlist is not None:
+                candidates = self.shortlist.candidates(batch[0])
+            length_log_probs = None
+            if self.model.length_predictor is not None:
+                length_log_probs = self.model.length_predictor(decoder_hidden)
+
+            return decode(batch_size=batch_size,
+                          code_outputs=code_outputs,
+                          ast_outputs=ast_outputs,
+                          decoder_hidden=decoder_hidden,
+                          candidates=candidates,
+                          length_log_probs=length_log_probs)
+
+    def eos_column(self, candidates=None) -> int:
+        """
+        column of EOS in outputs of decoder, which are over candidates if given
+        """
+        eos_index = utils.get_eos_index(self.nl_vocab)
+        if candidates is None:
+            return eos_index
+        return candidates.eq(eos_index).nonzero().item()
 
     def test_iter(self):
         """
@@ -252,10 +374,11 @@ class Test(object):
             except IOError:
                 print('Test details file open failed.')
 
-        for index_batch, batch in enumerate(self.dataloader):
-            batch_size = batch[0].shape[1]
+        # stems and synonyms of the references for meteor, looked up once before any workers fork
+        utils.preload_meteor_words(self.dataset.get_dataset()[2])
 
-            references, candidates, s_blue_score, meteor_score,rouge_score = self.test_one_batch(batch, batch_size)
+        for index_batch, batch_size, batch_results in self.iter_test_batches():
+            references, candidates, s_blue_score, meteor_score,rouge_score = batch_results
             total_s_bleu += s_blue_score
             total_meteor += meteor_score
             total_rouge +=rouge_score
@@ -289,158 +412,468 @@ class Test(object):
             out_file.write('rouge_L: ' + str(avg_rouge) + '\n')
             out_file.flush()
             out_file.close()
+        utils.save_meteor_cache()
 
         return c_bleu, avg_s_bleu, avg_meteor,avg_rouge
 
-    def greedy_decode(self, batch_size, code_outputs: torch.Tensor,
-                      ast_outputs: torch.Tensor, decoder_hidden: torch.Tensor):
+    def iter_test_batches(self):
+        """
+        results of test_one_batch on every batch of self.dataloader, in order,
+        the batches are split among self.workers processes if more than one
+        :return: generator of index_batch, batch_size and results of test_one_batch
+        """
+        if self.workers > 1:
+            yield from self.iter_sharded_test_batches()
+            return
+        if config.metric_workers > 0:
+            yield from self.iter_pipelined_test_batches()
+            return
+        for index_batch, batch in enumerate(self.dataloader):
+            batch_size = batch[0].shape[1]
+            yield index_batch, batch_size, self.test_one_batch(batch, batch_size)
+
+    def iter_pipelined_test_batches(self):
+        """
+        results of test_one_batch on every batch of self.dataloader, in order,
+        batches decoded in this process are measured by config.metric_workers forked processes meanwhile,
+        at most two batches per worker are waiting to be measured
+        :return: generator of index_batch, batch_size and results of test_one_batch
+        """
+        def finish(index_batch, batch_size, references, candidates, measuring):
+            return index_batch, batch_size, (references, candidates, *measuring.get())
+
+        context = multiprocessing.get_context('fork')
+        with context.Pool(processes=config.metric_workers) as pool:
+            waiting = deque()
+            for index_batch, batch in enumerate(self.dataloader):
+                batch_size = batch[0].shape[1]
+                references = batch[4]
+                candidates = self.decode_batch(batch, batch_size)
+                measuring = pool.apply_async(utils.measure, (batch_size, references, candidates))
+                waiting.append((index_batch, batch_size, references, candidates, measuring))
+
+                while waiting and (waiting[0][-1].ready() or len(waiting) > 2 * config.metric_workers):
+                    yield finish(*waiting.popleft())
+            while waiting:
+                yield finish(*waiting.popleft())
+
+    def iter_sharded_test_batches(self):
+        """
+        results of test_one_batch on every batch of self.dataloader, in order, computed by self.workers processes,
+        each of config.test_worker_threads torch threads.
+        Workers are forked from a fresh server process, not from this one: the OpenMP threads of torch do not exist
+        in a child forked after they ran, so a child using more than one thread would wait on them forever,
+        and so would the thread of models.get_encoder_executor. Each worker gets this instance pickled instead.
+        Shards are runs of whole batches of self.dataloader, several per worker for balance,
+        so batches are the same as in this process and so are their results and the sums of them
+        :return: generator of index_batch, batch_size and results of test_one_batch
+        """
+        if config.use_cuda:
+            raise Exception('Sharded test runs on cpu only, set config.test_workers to 0 to test on cuda.')
+        num_batches = len(self.dataloader)
+        shard_size = max(1, num_batches // (self.workers * 4))
+        shards = [(start, min(start + shard_size, num_batches)) for start in range(0, num_batches, shard_size)]
+        num_threads = config.test_worker_threads
+        if num_threads <= 0:
+            num_threads = max(1, torch.get_num_threads() // self.workers)
+
+        self.model.eval()
+        config_values = {name: value for name, value in vars(config).items()
+                         if not name.startswith('_') and isinstance(value, _config_value_types)}
+        initargs = (num_threads, config_values, metrics.get_meteor_cache(), pickle.dumps(self))
+        context = multiprocessing.get_context('forkserver')
+        # the server imports this module once, with sys.path of this process, rather than every worker
+        context.set_forkserver_preload(['eval'])
+        with context.Pool(processes=self.workers, initializer=_init_test_worker, initargs=initargs) as pool:
+            # shards finish out of order, yield them in order
+            finished = {}
+            next_shard = 0
+            for start, shard_results in pool.imap_unordered(_test_shard, shards):
+                finished[start] = shard_results
+                while next_shard < len(shards) and shards[next_shard][0] in finished:
+                    yield from finished.pop(shards[next_shard][0])
+                    next_shard += 1
+
+    def greedy_decode(self, batch_size, code_outputs: torch.Tensor, ast_outputs: torch.Tensor,
+                      decoder_hidden: torch.Tensor, candidates=None, length_log_probs=None):
         """
-        decode for one batch, sentence by sentence
+        greedy decode for one batch, the whole batch at once,
+        sequences which have output EOS are removed from the decoder batch, and it stops when all have
         :param batch_size:
         :param code_outputs: [T, B, H]
         :param ast_outputs: [T, B, H]
         :param decoder_hidden: [1, B, H]
-        :return: batch_sentences, [B, config.beam_top_sentence]
+        :param candidates: if given, indices of the only words to decode, [V'], see shortlist.Shortlist
+        :param length_log_probs: if given, predicted lengths of the model, [B, L], they cap the steps of each example
+                                 and favor EOS at likely lengths, see models.LengthPredictor
+        :return: batch_sentences, [B, 1]
         """
-        batch_sentences = []
-        for index_batch in range(batch_size):
-            batch_hidden = decoder_hidden[:, index_batch, :].unsqueeze(1)  # [1, 1, H]
-            batch_code_output = code_outputs[:, index_batch, :].unsqueeze(1)  # [T, 1, H]
-            batch_ast_output = ast_outputs[:, index_batch, :].unsqueeze(1)  # [T, 1, H]
-
-            decoded_indices = []
-            decoder_inputs = torch.tensor([utils.get_sos_index(self.nl_vocab)], device=config.device).long()    # [1]
-
-            for step in range(config.max_decode_steps):
-                # batch_output: [1, nl_vocab_size]
-                # batch_hidden: [1, H]
-                # attn_weights: [1, 1, T]
-                # decoder_outputs: [1, nl_vocab_size]
-                decoder_outputs, batch_hidden, \
-                    code_attn_weights, ast_attn_weights = self.model.decoder(inputs=decoder_inputs,
-                                                                             last_hidden=batch_hidden,
-                                                                             code_outputs=batch_code_output,
-                                                                             ast_outputs=batch_ast_output)
-                # log_prob, word_index: [1, 1]
-                _, word_index = decoder_outputs.topk(1)
-                word_index = word_index[0][0].item()
-
-                decoded_indices.append(word_index)
-                if word_index == utils.get_eos_index(self.nl_vocab):
-                    break
+        device = decoder_hidden.device
+        eos_index = utils.get_eos_index(self.nl_vocab)
+        eos_column = self.eos_column(candidates)
+        if length_log_probs is not None:
+            caps = self.model.length_predictor.caps(length_log_probs)    # [B]
+        decoder_inputs = torch.full((batch_size,), utils.get_sos_index(self.nl_vocab),
+                                    dtype=torch.long, device=device)  # [B]
+        active = torch.arange(batch_size, device=device)    # examples not finished
+        code_keys, ast_keys = self.model.decoder.project_keys(code_outputs, ast_outputs)
+        out = self.model.decoder.shortlist_out(candidates) if candidates is not None else None
+
+        # words of each step, EOS for finished examples, S x [B]
+        step_words = []
+        for step in range(config.max_decode_steps):
+            # decoder_outputs: [A, nl_vocab_size]
+            # decoder_hidden: [1, A, H]
+            decoder_outputs, decoder_hidden, _, _ = self.model.decoder(inputs=decoder_inputs,
+                                                                       last_hidden=decoder_hidden,
+                                                                       code_outputs=code_outputs,
+                                                                       ast_outputs=ast_outputs,
+                                                                       keys=(code_keys, ast_keys),
+                                                                       shortlist=out)
+            if length_log_probs is not None:
+                decoder_outputs[:, eos_column] += self.model.length_predictor.eos_prior(length_log_probs, step)
+            _, word_indices = decoder_outputs.topk(1)   # [A, 1]
+            decoder_inputs = word_indices.squeeze(1)    # [A]
+            if length_log_probs is not None:
+                decoder_inputs = decoder_inputs.masked_fill(caps <= step + 1, eos_column)
+            if candidates is not None:
+                decoder_inputs = candidates[decoder_inputs]
+            step_words.append(torch.full((batch_size,), eos_index, dtype=torch.long, device=device))
+            step_words[-1][active] = decoder_inputs
+
+            unfinished = decoder_inputs.ne(eos_index)
+            if unfinished.all():
+                continue
+            keep = unfinished.nonzero().squeeze(1)
+            if keep.numel() == 0:
+                break
+            active = active.index_select(0, keep)
+            decoder_inputs = decoder_inputs.index_select(0, keep)
+            decoder_hidden = decoder_hidden.index_select(1, keep)
+            code_outputs = code_outputs.index_select(1, keep)
+            ast_outputs = ast_outputs.index_select(1, keep)
+            code_keys = code_keys.index_select(1, keep)
+            ast_keys = ast_keys.index_select(1, keep)
+            if length_log_probs is not None:
+                length_log_probs = length_log_probs.index_select(0, keep)
+                caps = caps.index_select(0, keep)
 
+        batch_sentences = []
+        for decoded_indices in torch.stack(step_words, dim=1).tolist():
+            if eos_index in decoded_indices:
+                decoded_indices = decoded_indices[: decoded_indices.index(eos_index) + 1]
             batch_sentences.append([decoded_indices])
 
         return batch_sentences
 
-    def beam_decode(self, batch_size, code_outputs: torch.Tensor,
-                    ast_outputs: torch.Tensor, decoder_hidden: torch.Tensor):
+    def sample_decode(self, batch_size, code_outputs: torch.Tensor, ast_outputs: torch.Tensor,
+                      decoder_hidden: torch.Tensor, candidates=None, length_log_probs=None):
         """
-        beam decode for one batch, feed one batch for decoder
+        sample config.num_samples sentences for each example of one batch, all samples of all examples are
+        decoded together as one batch of B x N, words are sampled by config.sample_temperature,
+        config.sample_top_k and config.sample_top_p, an example stops when all its samples have output EOS
         :param batch_size:
         :param code_outputs: [T, B, H]
         :param ast_outputs: [T, B, H]
         :param decoder_hidden: [1, B, H]
+        :param candidates: if given, indices of the only words to decode, [V'], see shortlist.Shortlist
+        :param length_log_probs: if given, predicted lengths of the model, [B, L], they cap the steps of each example
+                                 and favor EOS at likely lengths, see models.LengthPredictor
+        :return: batch_sentences, [B, N], indices including EOS and without SOS,
+                 sorted by sum of log probs / length, the length counts the SOS as in beam_decode
+        """
+        num_samples = config.num_samples
+        device = decoder_hidden.device
+        eos_index = utils.get_eos_index(self.nl_vocab)
+        eos_column = self.eos_column(candidates)
+        if length_log_probs is not None:
+            caps = self.model.length_predictor.caps(length_log_probs)    # [B]
+
+        # samples of the example b are rows b * N to b * N + N - 1 of the decoder batch,
+        # the decoder broadcasts the encoder outputs of each example over its samples
+        rows = torch.arange(batch_size, device=device).repeat_interleave(num_samples)     # [B*N]
+        code_keys, ast_keys = self.model.decoder.project_keys(code_outputs, ast_outputs)
+        out = self.model.decoder.shortlist_out(candidates) if candidates is not None else None
+        decoder_hidden = decoder_hidden.index_select(1, rows)   # [1, B*N, H]
+        decoder_inputs = torch.full((batch_size * num_samples,), utils.get_sos_index(self.nl_vocab),
+                                    dtype=torch.long, device=device)
+
+        ended = torch.zeros((batch_size, num_samples), dtype=torch.bool, device=device)
+        log_probs = torch.zeros((batch_size, num_samples), device=device)  # sum of log probs of the model
+        lengths = torch.zeros((batch_size, num_samples), dtype=torch.long, device=device)   # including EOS
+        active = torch.arange(batch_size, device=device)    # examples with samples not finished
+        sample_offsets = torch.arange(num_samples, device=device)
+
+        # words of each step, EOS after the end of samples, S x [B, N]
+        step_words = []
+        for step in range(config.max_decode_steps):
+            # decoder_outputs: [A*N, nl_vocab_size]
+            # decoder_hidden: [1, A*N, H]
+            decoder_outputs, decoder_hidden, _, _ = self.model.decoder(inputs=decoder_inputs,
+                                                                       last_hidden=decoder_hidden,
+                                                                       code_outputs=code_outputs,
+                                                                       ast_outputs=ast_outputs,
+                                                                       keys=(code_keys, ast_keys),
+                                                                       shortlist=out)
+            if length_log_probs is not None:
+                decoder_outputs[:, eos_column] += self.model.length_predictor.eos_prior(
+                    length_log_probs[active], step).repeat_interleave(num_samples)
+            logits = utils.filter_logits(decoder_outputs / config.sample_temperature,
+                                         top_k=config.sample_top_k, top_p=config.sample_top_p)
+            word_indices = torch.multinomial(torch.softmax(logits, dim=1), 1)     # [A*N, 1]
+            if length_log_probs is not None:
+                capped = (caps[active] <= step + 1).repeat_interleave(num_samples)  # [A*N]
+                word_indices = word_indices.masked_fill(capped.unsqueeze(1), eos_column)
+            word_log_probs = decoder_outputs.gather(1, word_indices).view(-1, num_samples)  # [A, N]
+            decoder_inputs = word_indices.squeeze(1)   # [A*N]
+            if candidates is not None:
+                decoder_inputs = candidates[decoder_inputs]
+
+            # samples ended before keep outputting EOS, and are not scored any more
+            running = ~ended[active]    # [A, N]
+            words = decoder_inputs.view(-1, num_samples).masked_fill(~running, eos_index)
+            log_probs[active] += word_log_probs.masked_fill(~running, 0.)
+            lengths[active] += running.long()
+            ended[active] = ~running | words.eq(eos_index)
+            step_words.append(torch.full((batch_size, num_samples), eos_index, dtype=torch.long, device=device))
+            step_words[-1][active] = words
+
+            keep = ~ended[active].all(1)
+            if keep.all():
+                continue
+            keep = keep.nonzero().squeeze(1)
+            if keep.numel() == 0:
+                break
+            keep_rows = (keep.unsqueeze(1) * num_samples + sample_offsets).view(-1)
+            active = active.index_select(0, keep)
+            decoder_inputs = decoder_inputs.index_select(0, keep_rows)
+            decoder_hidden = decoder_hidden.index_select(1, keep_rows)
+            code_outputs = code_outputs.index_select(1, keep)
+            ast_outputs = ast_outputs.index_select(1, keep)
+            code_keys = code_keys.index_select(1, keep)
+            ast_keys = ast_keys.index_select(1, keep)
+
+        scores = log_probs / (lengths + 1).float()
+        order = scores.argsort(dim=1, descending=True).tolist()     # [B, N]
+        sample_words = torch.stack(step_words, dim=2).tolist()  # [B, N, S]
+        lengths = lengths.tolist()
+        return [[sample_words[index_batch][index_sample][:lengths[index_batch][index_sample]]
+                 for index_sample in order[index_batch]] for index_batch in range(batch_size)]
+
+    def beam_decode(self, batch_size, code_outputs: torch.Tensor, ast_outputs: torch.Tensor,
+                    decoder_hidden: torch.Tensor, candidates=None, length_log_probs=None):
+        """
+        beam decode for one batch, all beams of all examples are decoded together as one batch of B x K,
+        a hypothesis is scored by sum of log probs / length, the length counts the SOS,
+        an example stops when no hypothesis is alive, or when no alive hypothesis can reach the score of
+        the beam_top_sentences-th finished one: its sum of log probs can only decrease, and its length is at most
+        max_decode_steps + 1, hypotheses without EOS are only returned for examples that reach max_decode_steps
+        :param batch_size:
+        :param code_outputs: [T, B, H]
+        :param ast_outputs: [T, B, H]
+        :param decoder_hidden: [1, B, H]
+        :param candidates: if given, indices of the only words to decode, [V'], see shortlist.Shortlist
+        :param length_log_probs: if given, predicted lengths of the model, [B, L], they cap the steps of each example
+                                 and favor EOS at likely lengths, see models.LengthPredictor
         :return: batch_sentences, [B, config.beam_top_sentence]
         """
+        beam_width = config.beam_width
+        device = decoder_hidden.device
+        sos_index = utils.get_sos_index(self.nl_vocab)
+        eos_index = utils.get_eos_index(self.nl_vocab)
+        eos_column = self.eos_column(candidates)
+        neg_inf = float('-inf')
+        if length_log_probs is not None:
+            caps = self.model.length_predictor.caps(length_log_probs)    # [B]
+
+        # beams of the example b are rows b * K to b * K + K - 1 of the decoder batch,
+        # the decoder broadcasts the encoder outputs of each example over its beams
+        rows = torch.arange(batch_size, device=device).repeat_interleave(beam_width)     # [B*K]
+        code_keys, ast_keys = self.model.decoder.project_keys(code_outputs, ast_outputs)
+        out = self.model.decoder.shortlist_out(candidates) if candidates is not None else None
+        decoder_hidden = decoder_hidden.index_select(1, rows)   # [1, B*K, H]
+        decoder_inputs = torch.full((batch_size * beam_width,), sos_index, dtype=torch.long, device=device)
+
+        # state of beams of all examples, [B, K]
+        # sum of log probs, the search starts from one alive beam per example
+        cum_log_probs = torch.full((batch_size, beam_width), neg_inf, device=device)
+        cum_log_probs[:, 0] = 0.
+        ended = torch.zeros((batch_size, beam_width), dtype=torch.bool, device=device)  # last word is EOS
+        harvested = torch.zeros((batch_size, beam_width), dtype=torch.bool, device=device)
+        steps = torch.zeros(batch_size, dtype=torch.long, device=device)    # number of decoded words
+
+        # best beam_width finished hypotheses, [B, K], pointing to the beam and step of their EOS
+        finished_scores = torch.full((batch_size, beam_width), neg_inf, device=device)
+        finished_beams = torch.zeros((batch_size, beam_width), dtype=torch.long, device=device)
+        finished_steps = torch.zeros((batch_size, beam_width), dtype=torch.long, device=device)
+
+        # word and parent beam of each beam at each step, S x [B, K]
+        word_history = []
+        parent_history = []
+
+        active = torch.arange(batch_size, device=device)    # examples still searching
+        beam_offsets = torch.arange(beam_width, device=device)
+        returned_count = min(config.beam_top_sentences, beam_width)
+        max_length = config.max_decode_steps + 1
+        for step in range(config.max_decode_steps):
+            # move beams ended with EOS to finished hypotheses, keep the best beam_width of them
+            new_ended = ended[active] & ~harvested[active] & (cum_log_probs[active] > neg_inf)  # [A, K]
+            new_scores = (cum_log_probs[active] / (steps[active] + 1).float().unsqueeze(1)).masked_fill(
+                ~new_ended, neg_inf)
+            pool_scores = torch.cat([finished_scores[active], new_scores], dim=1)  # [A, 2K]
+            pool_beams = torch.cat([finished_beams[active], beam_offsets.expand(active.numel(), -1)], dim=1)
+            pool_steps = torch.cat([finished_steps[active], (steps[active] - 1).unsqueeze(1).expand(-1, beam_width)],
+                                   dim=1)
+            pool_scores, pool_indices = pool_scores.topk(beam_width, dim=1)     # [A, K]
+            finished_scores[active] = pool_scores
+            finished_beams[active] = pool_beams.gather(1, pool_indices)
+            finished_steps[active] = pool_steps.gather(1, pool_indices)
+            harvested[active] |= new_ended
+
+            # stop examples without alive beam, or whose alive beams can not beat the finished hypotheses
+            # to be returned, finished ones can not be dropped before then as alive beams are scored without EOS
+            alive = ~ended[active] & (cum_log_probs[active] > neg_inf)
+            best_reachable = cum_log_probs[active].masked_fill(~alive, neg_inf).max(1)[0] / max_length   # [A]
+            last_top_finished = finished_scores[active][:, returned_count - 1]     # [A]
+            keep = (alive.any(1) & (best_reachable >= last_top_finished)).nonzero().squeeze(1)
+            if keep.numel() == 0:
+                break
+            if keep.numel() < active.numel():
+                active = active.index_select(0, keep)
+                keep_rows = (keep.unsqueeze(1) * beam_width + beam_offsets).view(-1)
+                code_outputs = code_outputs.index_select(1, keep)
+                ast_outputs = ast_outputs.index_select(1, keep)
+                code_keys = code_keys.index_select(1, keep)
+                ast_keys = ast_keys.index_select(1, keep)
+                decoder_hidden = decoder_hidden.index_select(1, keep_rows)
+                decoder_inputs = decoder_inputs.index_select(0, keep_rows)
+                alive = alive.index_select(0, keep)
+            num_active = active.numel()
+
+            # decoder_outputs: [A*K, nl_vocab_size]
+            # decoder_hidden: [1, A*K, H]
+            decoder_outputs, decoder_hidden, _, _ = self.model.decoder(inputs=decoder_inputs,
+                                                                       last_hidden=decoder_hidden,
+                                                                       code_outputs=code_outputs,
+                                                                       ast_outputs=ast_outputs,
+                                                                       keys=(code_keys, ast_keys),
+                                                                       shortlist=out)
+            vocab_size = decoder_outputs.size(1)
+            decoder_outputs = decoder_outputs.view(num_active, beam_width, vocab_size)
+            if length_log_probs is not None:
+                decoder_outputs[:, :, eos_column] += self.model.length_predictor.eos_prior(
+                    length_log_probs[active], step).unsqueeze(1)
+
+            # extend alive beams by every word, and select the best beam_width of all extensions
+            scores = cum_log_probs[active].unsqueeze(2) + decoder_outputs
+            scores = scores.masked_fill(~alive.unsqueeze(2), neg_inf)
+            if length_log_probs is not None:
+                # beams of examples at their step cap can only end
+                capped = caps[active] <= step + 1   # [A]
+                not_eos = torch.arange(vocab_size, device=device).ne(eos_column)   # [V]
+                scores = scores.masked_fill(capped.view(-1, 1, 1) & not_eos, neg_inf)
+            top_scores, top_indices = scores.view(num_active, -1).topk(beam_width, dim=1)     # [A, K]
+            parents = torch.div(top_indices, vocab_size, rounding_mode='floor')
+            words = top_indices % vocab_size
+            if candidates is not None:
+                words = candidates[words]
+
+            parent_rows = (torch.arange(num_active, device=device).unsqueeze(1) * beam_width + parents).view(-1)
+            decoder_hidden = decoder_hidden.index_select(1, parent_rows)
+            decoder_inputs = words.view(-1)
+
+            cum_log_probs[active] = top_scores
+            ended[active] = words == eos_index
+            harvested[active] = False
+            steps[active] += 1
+            word_history.append(torch.zeros((batch_size, beam_width), dtype=torch.long, device=device))
+            word_history[-1][active] = words
+            parent_history.append(torch.zeros((batch_size, beam_width), dtype=torch.long, device=device))
+            parent_history[-1][active] = parents
+
+        # beams left unfinished at max_decode_steps compete with finished hypotheses
+        left = ~harvested & (cum_log_probs > neg_inf) & steps.eq(config.max_decode_steps).unsqueeze(1)
+        left_scores = (cum_log_probs / (steps + 1).float().unsqueeze(1)).masked_fill(~left, neg_inf)
+        scores = torch.cat([finished_scores, left_scores], dim=1)   # [B, 2K]
+        beams = torch.cat([finished_beams, beam_offsets.expand(batch_size, -1)], dim=1)
+        last_steps = torch.cat([finished_steps, (steps - 1).unsqueeze(1).expand(-1, beam_width)], dim=1)
+
+        top_count = min(config.beam_top_sentences, scores.size(1))
+        top_scores, top_indices = scores.topk(top_count, dim=1)   # [B, N]
+        beams = beams.gather(1, top_indices)
+        last_steps = last_steps.gather(1, top_indices)
+
+        # follow the parents back from the last word of each selected hypothesis
+        example_indices = torch.arange(batch_size, device=device).unsqueeze(1).expand(-1, top_count)
+        sentence_words = torch.zeros((len(word_history), batch_size, top_count), dtype=torch.long, device=device)
+        for step in range(len(word_history) - 1, -1, -1):
+            on_path = last_steps >= step
+            sentence_words[step] = word_history[step][example_indices, beams]
+            beams = torch.where(on_path, parent_history[step][example_indices, beams], beams)
+
+        sentence_words = sentence_words.permute(1, 2, 0).tolist()
+        top_scores = top_scores.tolist()
+        last_steps = last_steps.tolist()
         batch_sentences = []
-
-        # B = 1
         for index_batch in range(batch_size):
-            # for each input sentence
-            single_decoder_hidden = decoder_hidden[:, index_batch, :].unsqueeze(1)  # [1, 1, H]
-            single_code_output = code_outputs[:, index_batch, :].unsqueeze(1)  # [T, 1, H]
-            single_ast_output = ast_outputs[:, index_batch, :].unsqueeze(1)  # [T, 1, H]
-
-            root = BeamNode(sentence_indices=[utils.get_sos_index(self.nl_vocab)],
-                            log_probs=[0.0],
-                            hidden=single_decoder_hidden)
-
-            current_nodes = [root]  # list of nodes to be further extended
-            final_nodes = []  # list of end nodes
-
-            for step in range(config.max_decode_steps):
-                if len(current_nodes) == 0:
-                    break
-
-                candidate_nodes = []  # list of nodes to be extended next step
-
-                feed_inputs = []
-                feed_hidden = []
-
-                # B = len(current_nodes) except eos
-                extend_nodes = []
-                for node in current_nodes:
-                    # if current node is EOS
-                    if node.word_index() == utils.get_eos_index(self.nl_vocab):
-                        final_nodes.append(node)
-                        # if number of final nodes reach the beam width
-                        if len(final_nodes) >= config.beam_width:
-                            break
-                        continue
-
-                    extend_nodes.append(node)
-
-                    decoder_inputs = node.word_index()
-                    single_decoder_hidden = node.hidden.clone().detach()     # [1, 1, H]
-
-                    feed_inputs.append(decoder_inputs)  # [B]
-                    feed_hidden.append(single_decoder_hidden)   # B x [1, 1, H]
-
-                if len(extend_nodes) == 0:
-                    break
-
-                feed_batch_size = len(feed_inputs)
-                feed_code_outputs = single_code_output.repeat(1, feed_batch_size, 1)
-                feed_ast_outputs = single_ast_output.repeat(1, feed_batch_size, 1)
-
-                feed_inputs = torch.tensor(feed_inputs, device=config.device)   # [B]
-                feed_hidden = torch.stack(feed_hidden, dim=2).squeeze(0)    # [1, B, H]
-
-                # decoder_outputs: [B, nl_vocab_size]
-                # new_decoder_hidden: [1, B, H]
-                # attn_weights: [B, 1, T]
-                decoder_outputs, new_decoder_hidden, \
-                    code_attn_weights, ast_attn_weights = self.model.decoder(inputs=feed_inputs,
-                                                                             last_hidden=feed_hidden,
-                                                                             code_outputs=feed_code_outputs,
-                                                                             ast_outputs=feed_ast_outputs)
-
-                # get top k words
-                # log_probs: [B, beam_width]
-                # word_indices: [B, beam_width]
-                batch_log_probs, batch_word_indices = decoder_outputs.topk(config.beam_width)
-
-                for index_node, node in enumerate(extend_nodes):
-                    log_probs = batch_log_probs[index_node]
-                    word_indices = batch_word_indices[index_node]
-                    hidden = new_decoder_hidden[:, index_node, :].unsqueeze(1)
-
-                    for i in range(config.beam_width):
-                        log_prob = log_probs[i]
-                        word_index = word_indices[i].item()
-
-                        new_node = node.extend_node(word_index=word_index,
-                                                    log_prob=log_prob,
-                                                    hidden=hidden)
-                        candidate_nodes.append(new_node)
-
-                # sort candidate nodes by log_prb and select beam_width nodes
-                candidate_nodes = sorted(candidate_nodes, key=lambda item: item.avg_log_prob(), reverse=True)
-                current_nodes = candidate_nodes[: config.beam_width]
-
-            final_nodes += current_nodes
-            final_nodes = sorted(final_nodes, key=lambda item: item.avg_log_prob(), reverse=True)
-            final_nodes = final_nodes[: config.beam_top_sentences]
-
             sentences = []
-            for final_node in final_nodes:
-                sentences.append(final_node.sentence_indices)
-
+            for index_top in range(top_count):
+                if top_scores[index_batch][index_top] == neg_inf:
+                    continue
+                length = last_steps[index_batch][index_top] + 1
+                sentences.append([sos_index] + sentence_words[index_batch][index_top][:length])
             batch_sentences.append(sentences)
 
         return batch_sentences
 
+    def stream_decode(self, batch, cancel=None):
+        """
+        greedy decode a batch of one example, yielding each word as soon as it is decoded,
+        special symbols are skipped as in translate_indices,
+        closing the generator or setting cancel stops decoding before the next step
+        :param batch: get from collate_fn, of one example, nl_batch is not used
+        :param cancel: threading.Event, or None
+        :return: generator of words
+        """
+        eos_index = utils.get_eos_index(self.nl_vocab)
+        # gradients are disabled per step only, so that the caller does not run without them between words
+        with torch.no_grad():
+            code_outputs, ast_outputs, decoder_hidden = self.model(batch, 1, self.nl_vocab, is_test=True)
+            keys = self.model.decoder.project_keys(code_outputs, ast_outputs)
+            candidates = self.shortlist.candidates(batch[0]) if self.shortlist is not None else None
+            out = self.model.decoder.shortlist_out(candidates) if candidates is not None else None
+            eos_column = self.eos_column(candidates)
+            length_log_probs = None
+            cap = config.max_decode_steps + 1
+            if self.model.length_predictor is not None:
+                length_log_probs = self.model.length_predictor(decoder_hidden)
+                cap = self.model.length_predictor.caps(length_log_probs).item()
+        decoder_inputs = utils.init_decoder_inputs(batch_size=1, vocab=self.nl_vocab)     # [1]
+
+        # the step at the cap could only output EOS
+        for step in range(min(cap - 1, config.max_decode_steps)):
+            if cancel is not None and cancel.is_set():
+                return
+            with torch.no_grad():
+                decoder_outputs, decoder_hidden, _, _ = self.model.decoder(inputs=decoder_inputs,
+                                                                           last_hidden=decoder_hidden,
+                                                                           code_outputs=code_outputs,
+                                                                           ast_outputs=ast_outputs,
+                                                                           keys=keys,
+                                                                           shortlist=out)
+                if length_log_probs is not None:
+                    decoder_outputs[:, eos_column] += self.model.length_predictor.eos_prior(length_log_probs, step)
+                decoder_inputs = decoder_outputs.argmax(dim=1)    # [1]
+                if candidates is not None:
+                    decoder_inputs = candidates[decoder_inputs]
+
+            index = decoder_inputs.item()
+            if index == eos_index:
+                return
+            word = self.nl_vocab.index2word[index]
+            if utils.is_unk(word) or not utils.is_special_symbol(word):
+                yield word
+
     def translate_indices(self, batch_sentences):
         """
         translate indices to words for one batch
@@ -0,0 +1,134 @@
+import torch
+from collections import OrderedDict
+
+import config
+import utils
+import eval
+import adapters
+
+
+class ProjectSummarizer(object):
+    """
+    Summarize code of many projects with one resident base model,
+    switching per-project adapters (saved by train.Train with adapter=True) in and out by project id
+    """
+
+    def __init__(self, model, adapter_paths=None, cache_size=config.adapter_cache_size, vocab_path=None):
+        """
+
+        :param model: file name, state dict or instance of the base model
+        :param adapter_paths: dict, project id -> adapter file, projects without adapter use the base model
+        :param cache_size: number of adapters kept in memory, least recently used ones are dropped
+        :param vocab_path: tuple of code vocab, ast vocab, nl vocab, default to config
+        """
+        self.test_instance = eval.Test(model, code_path=None, vocab_path=vocab_path)
+        self.model = self.test_instance.model
+        self.adapter_paths = dict(adapter_paths) if adapter_paths else {}
+        self.cache_size = cache_size
+
+        # project id -> adapter factors, in order of use, the least recently used first
+        self.adapters = OrderedDict()
+        # name of weight -> copy of the base weight, for every weight an adapter has changed
+        self.base_weights = {}
+        self.active_project = None
+
+    def register(self, project_id, adapter_path):
+        """
+        add or replace the adapter of a project
+        """
+        self.adapter_paths[project_id] = adapter_path
+        self.adapters.pop(project_id, None)
+        if self.active_project == project_id:
+            self.switch(None)
+
+    def get_adapter(self, project_id) -> dict:
+        """
+        factors of the adapter of given project, loaded from file if not cached
+        :return: see adapters.adapter_factors
+        """
+        if project_id in self.adapters:
+            self.adapters.move_to_end(project_id)
+            return self.adapters[project_id]
+
+        state = torch.load(self.adapter_paths[project_id], map_location=config.device)
+        factors = adapters.adapter_factors(state['adapter'], state['adapter_config'])
+        self.adapters[project_id] = factors
+        if len(self.adapters) > self.cache_size:
+            self.adapters.popitem(last=False)
+        return factors
+
+    def switch(self, project_id):
+        """
+        make the weights of the model those of given project, base weights plus its adapter merged
+        :param project_id: None or a project without adapter for the base model
+        """
+        if project_id == self.active_project:
+            return
+
+        weights = dict(self.model.named_parameters())
+        with torch.no_grad():
+            for name, base_weight in self.base_weights.items():
+                weights[name].copy_(base_weight)
+            if project_id in self.adapter_paths:
+                for name, (lora_a, lora_b, scale) in self.get_adapter(project_id).items():
+                    if name not in self.base_weights:
+                        self.base_weights[name] = weights[name].detach().clone()
+                    weights[name].addmm_(lora_b, lora_a, alpha=scale)
+        self.active_project = project_id
+
+    def summarize(self, requests) -> list:
+        """
+        summarize code of any projects, requests of the same project are batched together
+        :param requests: list of (project id, tokens of code, tokens of sbt)
+        :return: summaries in order of requests, list of words each
+        """
+        groups = OrderedDict()
+        for index, (project_id, _, _) in enumerate(requests):
+            groups.setdefault(project_id, []).append(index)
+
+        summaries = [None] * len(requests)
+        # start with the active project to save a switch
+        for project_id, indices in sorted(groups.items(), key=lambda item: item[0] != self.active_project):
+            self.switch(project_id)
+            for start in range(0, len(indices), config.test_batch_size):
+                batch_indices = indices[start: start + config.test_batch_size]
+                batch_summaries = self.summarize_batch([requests[index][1:] for index in batch_indices])
+                for index, summary in zip(batch_indices, batch_summaries):
+                    summaries[index] = summary
+        return summaries
+
+    def stream(self, project_id, code, sbt, cancel=None):
+        """
+        summarize the code of one project, yielding each word as soon as it is decoded,
+        the weights of the project stay active until the generator is exhausted or closed,
+        so other projects must not be summarized in between
+        :param project_id: see switch
+        :param code: tokens of code
+        :param sbt: tokens of sbt
+        :param cancel: threading.Event, set to stop decoding, or None
+        :return: generator of words, see eval.Test.stream_decode
+        """
+        self.switch(project_id)
+        return self.test_instance.stream_decode(self.make_batch([(code, sbt)]), cancel=cancel)
+
+    def summarize_batch(self, examples) -> list:
+        """
+        summarize one batch with the active weights
+        :param examples: list of (tokens of code, tokens of sbt)
+        :return: list of words of each summary
+        """
+        return self.test_instance.decode_batch(self.make_batch(examples), len(examples))
+
+    def make_batch(self, examples):
+        """
+        batch of examples as from collate_fn
+        :param examples: list of (tokens of code, tokens of sbt)
+        """
+        batch = []
+        for code, sbt in examples:
+            if config.use_compact_sbt:
+                sbt = utils.compact_sbt(sbt)
+            batch.append((code[: config.max_code_length], sbt, []))
+        return utils.unsort_collate_fn((batch,), code_vocab=self.test_instance.code_vocab,
+                                       ast_vocab=self.test_instance.ast_vocab,
+                                       nl_vocab=self.test_instance.nl_vocab, raw_nl=True)
@@ -6,7 +6,7 @@ import eval
 import utils
 import torch
 torch.manual_seed(1)
-def _train(testing_project,is_transfer,num_fold,validating_project,vocab_file_path=None, model_file_path=None,model_state_dict=None,num_of_data=-1,seed=1,adam=True):
+def _train(testing_project,is_transfer,num_fold,validating_project,vocab_file_path=None, model_file_path=None,model_state_dict=None,num_of_data=-1,seed=1,adam=True,adapter=False,freeze_encoder=False):
     print('\nStarting the training process......\n')
 
     if vocab_file_path:
@@ -36,7 +36,7 @@ def _train(testing_project,is_transfer,num_fold,validating_project,vocab_file_pa
                                     ,code_valid_path=f'../dataset_v2/original/{validating_project}/all_truncated_final.code',nl_valid_path=f'../dataset_v2/original/{validating_project}/all_truncated_final.comment',
                                     ast_valid_path=f'../dataset_v2/original/{validating_project}/all_truncated.sbt'
                                     ,model_state_dict=model_state_dict,batch_size=config.support_batch_size
-                                    ,num_of_data=num_of_data,model_file_path=model_file_path,save_file=False,seed=seed,adam=adam,is_test=True)        
+                                    ,num_of_data=num_of_data,model_file_path=model_file_path,save_file=False,seed=seed,adam=adam,is_test=True,adapter=adapter,freeze_encoder=freeze_encoder)        
     print('Environments built successfully.\n')
     print('Size of train dataset:', train_instance.train_dataset_size)
 
@@ -92,6 +92,10 @@ if __name__ == '__main__':
     parser.add_argument('-num','--numtest',
                         type=int, default=1)
     parser.add_argument('--adam', action=argparse.BooleanOptionalAction, default=True)
+    parser.add_argument('--adapter', action=argparse.BooleanOptionalAction, default=False,
+                        help='fine-tune low-rank adapters only')
+    parser.add_argument('--freeze_encoder', default=False, action=argparse.BooleanOptionalAction,
+                        help='fine-tune the decoder only, on cached encoder states')
 
     args = parser.parse_args()
     num_test=args.numtest
@@ -113,7 +117,7 @@ if __name__ == '__main__':
                 for num_fold in range(5):
                     res_dict=None
                     for i in range(num_test):
-                        best_model_dict2=_train(testing_project,is_transfer=True,vocab_file_path=(config.code_vocab_path, config.ast_vocab_path, config.nl_vocab_path),model_file_path=os.path.join(path,file),num_of_data=num_data,seed=i,adam=args.adam,num_fold=num_fold,validating_project=validating_project)
+                        best_model_dict2=_train(testing_project,is_transfer=True,vocab_file_path=(config.code_vocab_path, config.ast_vocab_path, config.nl_vocab_path),model_file_path=os.path.join(path,file),num_of_data=num_data,seed=i,adam=args.adam,num_fold=num_fold,validating_project=validating_project,adapter=args.adapter,freeze_encoder=args.freeze_encoder)
                         result=_test(best_model_dict2,testing_project,num_fold=num_fold)
                         if res_dict==None:
                             res_dict=result
@@ -138,7 +142,7 @@ if __name__ == '__main__':
                 for i in range(num_test):
                     best_model_dict2=os.path.join(path,args.specific)
                     if num_data!=0:
-                        best_model_dict2=_train(testing_project,is_transfer=True,vocab_file_path=(config.code_vocab_path, config.ast_vocab_path, config.nl_vocab_path),model_file_path=os.path.join(path,args.specific),num_of_data=num_data,seed=i,adam=args.adam,num_fold=num_fold,validating_project=validating_project)
+                        best_model_dict2=_train(testing_project,is_transfer=True,vocab_file_path=(config.code_vocab_path, config.ast_vocab_path, config.nl_vocab_path),model_file_path=os.path.join(path,args.specific),num_of_data=num_data,seed=i,adam=args.adam,num_fold=num_fold,validating_project=validating_project,adapter=args.adapter,freeze_encoder=args.freeze_encoder)
                     result=_test(best_model_dict2,testing_project,num_fold=num_fold)      
                     if res_dict==None:
                         res_dict=result
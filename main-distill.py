@@ -0,0 +1,37 @@
+import argparse
+
+import config
+import distill
+import eval
+
+dataset_dir = '../dataset_v2/original/'
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Distill a trained model into a smaller student model.')
+    parser.add_argument('-m', '--teacher_model', type=str, required=True, help='checkpoint of the teacher model')
+    parser.add_argument('--hidden_size', type=int, default=config.student_hidden_size)
+    parser.add_argument('--embedding_dim', type=int, default=config.student_embedding_dim)
+    parser.add_argument('--nl_vocab_size', type=int, default=config.student_nl_vocab_size)
+    parser.add_argument('--temperature', type=float, default=config.distill_temperature)
+    parser.add_argument('--alpha', type=float, default=config.distill_alpha)
+    args = parser.parse_args()
+
+    # the student shares the vocabularies of the teacher
+    distill_instance = distill.Distill(args.teacher_model, hidden_size=args.hidden_size,
+                                       embedding_dim=args.embedding_dim, nl_vocab_size=args.nl_vocab_size,
+                                       temperature=args.temperature, alpha=args.alpha,
+                                       vocab_file_path=(config.code_vocab_path, config.ast_vocab_path,
+                                                        config.nl_vocab_path),
+                                       code_path=dataset_dir + 'train.code', ast_path=dataset_dir + 'train.sbt',
+                                       nl_path=dataset_dir + 'train.comment',
+                                       code_valid_path=dataset_dir + 'valid.code',
+                                       ast_valid_path=dataset_dir + 'valid.sbt',
+                                       nl_valid_path=dataset_dir + 'valid.comment')
+    config.logger.info('Start distilling into student: {}'.format(distill_instance.model.model_config))
+    best_model = distill_instance.run_train()
+    config.logger.info('Distilling is done.')
+
+    test_instance = eval.Test(best_model, code_path=dataset_dir + 'test.code', ast_path=dataset_dir + 'test.sbt',
+                              nl_path=dataset_dir + 'test.comment')
+    test_instance.run_test()
@@ -59,7 +59,7 @@ def _train(training_projects,validating_project,vocab_file_path=None, model_file
 
     return best_model
 
-def _test(model,vocab_file_path,testing_project,num_fold,validating_project,num_of_data=-1,seed=1,adam=True):
+def _test(model,vocab_file_path,testing_project,num_fold,validating_project,num_of_data=-1,seed=1,adam=True,adapter=False,freeze_encoder=False):
     dataset_dir = "../dataset_v2/"
     if num_of_data==0:
         test_instance = eval.Test(model,
@@ -79,7 +79,7 @@ def _test(model,vocab_file_path,testing_project,num_fold,validating_project,num_
                                     nl_path=os.path.join(dataset_dir,f'original/{testing_project}/fold_{num_fold}_train.comment'),batch_size=config.support_batch_size,
                                     code_valid_path=os.path.join(dataset_dir,f'original/{validating_project}/all_truncated_final.code'),nl_valid_path=os.path.join(dataset_dir,f'{validating_project}/all_truncated_final.comment'),
                                         ast_valid_path=os.path.join(dataset_dir,f'{validating_project}/all_truncated.sbt')
-                                        ,num_of_data=num_of_data,save_file=False,seed=seed,adam=adam,is_test=True)
+                                        ,num_of_data=num_of_data,save_file=False,seed=seed,adam=adam,is_test=True,adapter=adapter,freeze_encoder=freeze_encoder)
     elif isinstance(model, str):
         train_instance = train.Train(vocab_file_path=vocab_file_path, model_file_path=model,
                                     code_path=os.path.join(dataset_dir,f'original/{testing_project}/fold_{num_fold}_train.code')
@@ -87,7 +87,7 @@ def _test(model,vocab_file_path,testing_project,num_fold,validating_project,num_
                                     nl_path=os.path.join(dataset_dir,f'original/{testing_project}/fold_{num_fold}_train.comment'),batch_size=config.support_batch_size,
                                     code_valid_path=os.path.join(dataset_dir,f'original/{validating_project}/all_truncated_final.code'),nl_valid_path=os.path.join(dataset_dir,f'original/{validating_project}/all_truncated_final.comment'),
                                         ast_valid_path=os.path.join(dataset_dir,f'original/{validating_project}/all_truncated.sbt')
-                                        ,num_of_data=num_of_data,save_file=False,seed=seed,adam=adam,is_test=True)        
+                                        ,num_of_data=num_of_data,save_file=False,seed=seed,adam=adam,is_test=True,adapter=adapter,freeze_encoder=freeze_encoder)        
     best_model_test_dict=train_instance.run_train()
     print('\nInitializing the test environments......')
     test_instance = eval.Test(best_model_test_dict,
@@ -142,6 +142,10 @@ if __name__ == '__main__':
     parser.add_argument('-num','--numtest',
                         type=int, default=1)
     parser.add_argument('-a','--adam', default=True, action=argparse.BooleanOptionalAction)
+    parser.add_argument('--adapter', default=False, action=argparse.BooleanOptionalAction,
+                        help='fine-tune low-rank adapters only')
+    parser.add_argument('--freeze_encoder', default=False, action=argparse.BooleanOptionalAction,
+                        help='fine-tune the decoder only, on cached encoder states')
     args = parser.parse_args()
     training_projects=['dubbo','guava','kafka']
     validating_project=args.validate
@@ -167,7 +171,7 @@ if __name__ == '__main__':
                 for num_fold in range(5):
                     res_dict=None
                     for i in range(num_test):
-                        result=_test(os.path.join(path,file),vocab_file_path=(config.code_vocab_path, config.ast_vocab_path, config.nl_vocab_path),testing_project=testing_project,num_of_data=num_data,seed=i,adam=args.adam,num_fold=num_fold,validating_project=validating_project)
+                        result=_test(os.path.join(path,file),vocab_file_path=(config.code_vocab_path, config.ast_vocab_path, config.nl_vocab_path),testing_project=testing_project,num_of_data=num_data,seed=i,adam=args.adam,num_fold=num_fold,validating_project=validating_project,adapter=args.adapter,freeze_encoder=args.freeze_encoder)
                         if res_dict==None:
                             res_dict=result
                         else:
@@ -191,7 +195,7 @@ if __name__ == '__main__':
             for num_fold in range(5):
                 res_dict=None
                 for i in range(num_test):
-                    result=_test(os.path.join(path,args.specific),vocab_file_path=(config.code_vocab_path, config.ast_vocab_path, config.nl_vocab_path),testing_project=testing_project,num_of_data=num_data,seed=i,adam=args.adam,num_fold=num_fold,validating_project=validating_project)
+                    result=_test(os.path.join(path,args.specific),vocab_file_path=(config.code_vocab_path, config.ast_vocab_path, config.nl_vocab_path),testing_project=testing_project,num_of_data=num_data,seed=i,adam=args.adam,num_fold=num_fold,validating_project=validating_project,adapter=args.adapter,freeze_encoder=args.freeze_encoder)
                     if res_dict==None:
                         res_dict=result
                     else:
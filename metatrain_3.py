@@ -149,13 +149,24 @@ class MetaTrain(object):
         # ], betas=(0.9, 0.999), eps=1e-08, weight_decay=0, amsgrad=False)
 
         self.params=self.maml.parameters()
-        self.optimizer=Adam(self.maml.parameters(),lr=config.learning_rate)
+        # adapt() updates only the touched rows of sparse embeddings, their meta gradients are sparse as well
+        self.sparse_optimizer=None
+        if config.use_sparse_embedding:
+            sparse_params, dense_params = models.split_sparse_parameters(self.maml)
+            self.optimizer=Adam(dense_params,lr=config.learning_rate)
+            self.sparse_optimizer=utils.RowSparseAdam(sparse_params,lr=config.learning_rate)
+        else:
+            self.optimizer=Adam(self.maml.parameters(),lr=config.learning_rate)
         self.eval_instance = eval.Eval(self.get_cur_state_dict(),code_path=f'../dataset_v2/original/{validating_project}/valid_transfer.code',ast_path=f'../dataset_v2/original/{validating_project}/valid_transfer.sbt',nl_path=f'../dataset_v2/original/{validating_project}/valid_transfer.comment')
 
         if config.use_lr_decay:
             self.lr_scheduler = lr_scheduler.StepLR(self.optimizer,
                                                     step_size=config.lr_decay_every,
                                                     gamma=config.lr_decay_rate)
+            if self.sparse_optimizer is not None:
+                self.sparse_lr_scheduler = lr_scheduler.StepLR(self.sparse_optimizer,
+                                                               step_size=config.lr_decay_every,
+                                                               gamma=config.lr_decay_rate)
 
         # best score and model(state dict)
         self.min_loss: float = 1000
@@ -222,7 +233,7 @@ class MetaTrain(object):
 
             return loss
 
-    def train_iter(self,train_steps=12000, inner_train_steps=2, 
+    def train_iter(self,train_steps=12000, inner_train_steps=config.inner_train_steps, 
               valid_steps=200, inner_valid_steps=4, 
               valid_every=5, eval_start=0, early_stop=50, epoch_number=12000):
 
@@ -248,6 +259,8 @@ class MetaTrain(object):
                 #projects=random.sample(self.training_projects, 4)
                 losses = []
                 self.optimizer.zero_grad() 
+                if self.sparse_optimizer is not None:
+                    self.sparse_optimizer.zero_grad()
                 for project in self.training_projects: # inner loop
                     sup_iter=iter(self.meta_dataloaders[project]['support'])
                     sup_batch = next(sup_iter) 
@@ -275,8 +288,10 @@ class MetaTrain(object):
                     query_loss.backward()
                     losses.append(query_loss.item())
 
-                torch.nn.utils.clip_grad_norm_(self.params, 5)
+                utils.clip_grad_norm(self.params, 5)
                 self.optimizer.step()
+                if self.sparse_optimizer is not None:
+                    self.sparse_optimizer.step()
                 pbar.set_description('Epoch = %d, iteration = %d, [loss=%.4f, min=%.4f, max=%.4f] \n' % (epoch, idx, np.mean(losses), np.min(losses), np.max(losses)))
                 config.logger.info('epoch: {}/{}, iteration: {}/{}, avg loss: {:.4f}'.format(
                         epoch + 1, epoch_number,iteration+1 , num_iteration, np.mean(losses)))
@@ -284,6 +299,8 @@ class MetaTrain(object):
 
             if config.use_lr_decay:
                 self.lr_scheduler.step()
+                if self.sparse_optimizer is not None:
+                    self.sparse_lr_scheduler.step()
                 
             # validation
             if epoch >= eval_start:
@@ -329,6 +346,8 @@ class MetaTrain(object):
                 'model': self.model.state_dict(),
                 'optimizer': self.optimizer.state_dict(),
             }
+        if self.sparse_optimizer is not None:
+            state_dict['sparse_optimizer'] = self.sparse_optimizer.state_dict()
         return state_dict
 
     def valid_state_dict(self, state_dict, epoch, batch=-1):
@@ -0,0 +1,409 @@
+import math
+import itertools
+import os
+import pickle
+import numpy as np
+from nltk.corpus import wordnet
+from nltk.stem.porter import PorterStemmer
+from nltk.tokenize import NLTKWordTokenizer
+from rouge import Rouge
+
+# bleu of up to 4-grams, weights(0.25, 0.25, 0.25, 0.25), smoothed by method4 of nltk as utils.sentence_bleu_score
+bleu_max_n = 4
+bleu_smoothing_k = 5    # k of nltk.translate.bleu_score.SmoothingFunction
+
+# rouge-L f score of the rouge package as utils.rouge, alpha 0.5, summaries truncated to 665 characters
+rouge_alpha = 0.5
+rouge_length_limit = 665
+_rouge_tokenizer = NLTKWordTokenizer()
+_rouge_word_tokens = {}     # word -> its tokens after preprocessing, see rouge_word_tokens
+
+# meteor of nltk single_meteor_score with the parameters of utils.meteor_score,
+# stems and wordnet synonyms of words are looked up once in a run, see meteor_stem and meteor_synonyms
+meteor_alpha = 0.85
+meteor_beta = 0.2
+meteor_gamma = 0.6
+_meteor_stemmer = PorterStemmer()
+_meteor_stems = {}      # word -> its porter stem
+_meteor_synonyms = {}   # word -> set of itself and the single word lemmas of its wordnet synsets
+
+
+def count_bleu_ngrams(references, candidates, max_n=bleu_max_n) -> (np.ndarray, np.ndarray):
+    """
+    clipped n-gram matches of every candidate against its reference, for all sentences at once:
+    n-grams of every order are ranked into integers over the whole batch, then counted and matched by numpy
+    :param references: tokens of reference of every candidate, [S, T]
+    :param candidates: tokens of candidates, [S, T]
+    :param max_n: max order of n-grams
+    :return: numerators: number of clipped matches of every order of every candidate, [S, max_n]
+             denominators: number of n-grams of every order of every candidate, at least 1, [S, max_n]
+    """
+    num_sentences = len(candidates)
+    numerators = np.zeros((num_sentences, max_n), dtype=np.int64)
+    sentences = list(candidates) + list(references)
+    seg_lens = np.fromiter(map(len, sentences), dtype=np.int64, count=len(sentences))
+    denominators = np.maximum(1, seg_lens[:num_sentences, None] - np.arange(max_n)[None, :])
+
+    # candidates and references in one stream of token ids, segment s < S is candidate s, S + s is its reference
+    words = list(itertools.chain.from_iterable(sentences))
+    word2id = dict(zip(dict.fromkeys(words), itertools.count()))
+    tokens = np.fromiter(map(word2id.__getitem__, words), dtype=np.int64, count=len(words))
+    if tokens.size == 0:
+        return numerators, denominators
+    segments = np.repeat(np.arange(len(sentences)), seg_lens)
+    remains = np.repeat(np.cumsum(seg_lens), seg_lens) - np.arange(tokens.size)   # tokens left in the sentence
+    # side of every token, 2 * s for candidate s and 2 * s + 1 for its reference
+    sides = segments % num_sentences * 2 + (segments >= num_sentences)
+    num_sides = 2 * num_sentences
+
+    keys = np.zeros_like(tokens)    # rank of the n-gram starting at each token, among all n-grams of the same order
+    num_keys = 1
+    for n in range(1, max_n + 1):
+        starts = np.flatnonzero(remains >= n)
+        if starts.size == 0:
+            break
+        # an n-gram is its (n-1)-gram followed by one token, one sort by n-gram and side gives
+        # both the ranks of n-grams and their counts on every side
+        ngrams = keys[starts] * len(word2id) + tokens[starts + n - 1]
+        sorted_keys = ngrams * num_sides + sides[starts]
+        order = np.argsort(sorted_keys)
+        sorted_keys = sorted_keys[order]
+        sorted_ngrams = ngrams[order]
+        keys[starts[order]] = np.concatenate(([0], np.cumsum(sorted_ngrams[1:] != sorted_ngrams[:-1])))
+
+        first = np.flatnonzero(np.concatenate(([True], sorted_keys[1:] != sorted_keys[:-1])))
+        unique_keys = sorted_keys[first]
+        counts = np.diff(np.append(first, sorted_keys.size))
+        # a candidate n-gram is matched if the next key is the same n-gram of its reference
+        matched = np.zeros(unique_keys.size, dtype=bool)
+        matched[:-1] = (unique_keys[:-1] & 1 == 0) & (unique_keys[1:] == unique_keys[:-1] + 1)
+        matched = np.flatnonzero(matched)
+        clipped = np.minimum(counts[matched], counts[matched + 1])
+        numerators[:, n - 1] = np.bincount(unique_keys[matched] % num_sides // 2, weights=clipped,
+                                           minlength=num_sentences)
+    return numerators, denominators
+
+
+def sentence_bleu_scores(references, candidates) -> np.ndarray:
+    """
+    sentence level bleu of every candidate, as nltk sentence_bleu with smoothing method4, see utils.sentence_bleu_score
+    :param references: tokens of reference of every candidate, [S, T]
+    :param candidates: tokens of candidates, [S, T]
+    :return: scores, [S]
+    """
+    numerators, denominators = count_bleu_ngrams(references, candidates)
+    candidate_lens = np.fromiter(map(len, candidates), dtype=np.float64, count=len(candidates))
+    reference_lens = np.fromiter(map(len, references), dtype=np.float64, count=len(references))
+
+    # method4: the k-th order without matches counts 1 / (2^k * bleu_smoothing_k / ln(length)) matches
+    zeros = numerators == 0
+    smoothed_count = np.cumsum(zeros, axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        smoothed = 1 / (2.0 ** smoothed_count * bleu_smoothing_k / np.log(candidate_lens)[:, None]) / denominators
+        precisions = np.where(zeros & (candidate_lens[:, None] > 1), smoothed, numerators / denominators)
+        log_precisions = np.where(precisions > 0, np.log(np.where(precisions > 0, precisions, 1)), 0)
+        brevity_penalties = np.where(candidate_lens > reference_lens, 1.0,
+                                     np.exp(1 - reference_lens / candidate_lens))
+    scores = brevity_penalties * np.exp(log_precisions.sum(axis=1) / bleu_max_n)
+    # no matched words, or an empty candidate
+    return np.where(zeros[:, 0], 0.0, scores)
+
+
+def corpus_bleu_score(references, candidates) -> float:
+    """
+    corpus level bleu, as nltk corpus_bleu with smoothing method4, see utils.corpus_bleu_score
+    :param references: tokens of reference of every candidate, [S, T]
+    :param candidates: tokens of candidates, [S, T]
+    :return: corpus level bleu score
+    """
+    numerators, denominators = count_bleu_ngrams(references, candidates)
+    numerators = numerators.sum(axis=0).tolist()
+    denominators = denominators.sum(axis=0).tolist()
+    candidate_len = sum(len(candidate) for candidate in candidates)
+    reference_len = sum(len(reference) for reference in references)
+    if numerators[0] == 0:
+        return 0
+
+    precisions = []
+    smoothed_count = 1
+    for numerator, denominator in zip(numerators, denominators):
+        if numerator == 0 and candidate_len > 1:
+            precisions.append(1 / (2 ** smoothed_count * bleu_smoothing_k / math.log(candidate_len)) / denominator)
+            smoothed_count += 1
+        else:
+            precisions.append(numerator / denominator)
+
+    if candidate_len > reference_len:
+        brevity_penalty = 1
+    else:
+        brevity_penalty = math.exp(1 - reference_len / candidate_len)
+    return brevity_penalty * math.exp(math.fsum(math.log(precision) / bleu_max_n
+                                                for precision in precisions if precision > 0))
+
+
+def rouge_word_tokens(word) -> list:
+    """
+    tokens of one word preprocessed as by the rouge package: lowered, split at characters other than letters and
+    digits, tokenized by nltk, which splits some contractions, and stemmed, with 'cannot' kept as one token
+    """
+    tokens = _rouge_word_tokens.get(word)
+    if tokens is None:
+        if Rouge.STEMMER is None:
+            # loads the stemmer and the wordnet rules of the rouge package
+            Rouge(metrics=['rouge-l'], max_n=4)
+        cleaned = Rouge.REMOVE_CHAR_PATTERN.sub(' ', word.lower()).strip()
+        tokens = Rouge.stem_tokens(_rouge_tokenizer.tokenize(Rouge.KEEP_CANNOT_IN_ONE_WORD.sub('_cannot_', cleaned)))
+        tokens = Rouge.KEEP_CANNOT_IN_ONE_WORD_REVERSED.sub('cannot', ' '.join(tokens)).split()
+        _rouge_word_tokens[word] = tokens
+    return tokens
+
+
+def rouge_tokens(words) -> list:
+    """
+    tokens of a summary as the rouge package scores it, every word is preprocessed once and cached
+    :param words: tokens of summary
+    :return: preprocessed tokens
+    """
+    summary = ' '.join(words).strip()
+    if len(summary) >= rouge_length_limit:
+        words = summary[:rouge_length_limit].split()
+    return [token for word in words for token in rouge_word_tokens(word)]
+
+
+def lcs_lengths(references, candidates) -> np.ndarray:
+    """
+    lengths of longest common subsequences of pairs of sequences of token ids, by the bit-parallel algorithm
+    of Allison-Dix and Hyyro: bit i of a row is position i of the reference, and a row advances by one candidate
+    token with an addition. Pairs whose reference fits 64 bits advance together in numpy, the others one by one
+    :param references: token ids of references, [S, T]
+    :param candidates: token ids of candidates, [S, T]
+    :return: lengths, [S]
+    """
+    num_pairs = len(candidates)
+    lengths = np.zeros(num_pairs, dtype=np.int64)
+    reference_lens = np.fromiter(map(len, references), dtype=np.int64, count=num_pairs)
+    candidate_lens = np.fromiter(map(len, candidates), dtype=np.int64, count=num_pairs)
+    short = np.flatnonzero((reference_lens > 0) & (reference_lens <= 64) & (candidate_lens > 0))
+
+    if short.size > 0:
+        max_candidate_len = candidate_lens[short].max()
+        reference_ids = np.full((short.size, 64), -1, dtype=np.int64)
+        candidate_ids = np.full((short.size, max_candidate_len), -2, dtype=np.int64)
+        for row, index in enumerate(short.tolist()):
+            reference_ids[row, :reference_lens[index]] = references[index]
+            candidate_ids[row, :candidate_lens[index]] = candidates[index]
+        # positions of every candidate token in the reference, as bits, [S', max_candidate_len]
+        matches = candidate_ids[:, :, None] == reference_ids[:, None, :]
+        matches = np.packbits(matches, axis=2, bitorder='little').view('<u8')[:, :, 0]
+
+        rows = np.full(short.size, np.iinfo(np.uint64).max, dtype=np.uint64)
+        for step in range(max_candidate_len):
+            matched = rows & matches[:, step]
+            rows = (rows + matched) | (rows - matched)
+        # zero bits of a row within its reference are the common subsequence
+        zeros = np.unpackbits((~rows).view(np.uint8).reshape(-1, 8), axis=1, bitorder='little')
+        lengths[short] = (zeros * (np.arange(64) < reference_lens[short, None])).sum(axis=1)
+
+    for index in np.flatnonzero((reference_lens > 64) & (candidate_lens > 0)).tolist():
+        masks = {}
+        for position, token in enumerate(references[index]):
+            masks[token] = masks.get(token, 0) | 1 << position
+        full = (1 << int(reference_lens[index])) - 1
+        row = full
+        for token in candidates[index]:
+            matched = row & masks.get(token, 0)
+            row = ((row + matched) | (row - matched)) & full
+        lengths[index] = int(reference_lens[index]) - bin(row).count('1')
+    return lengths
+
+
+def rouge_l_scores(references, candidates) -> np.ndarray:
+    """
+    rouge-L f score of every candidate, as the rouge package with utils.rouge, whose overlap of a single reference
+    and candidate is the length of their longest common subsequence
+    :param references: tokens of reference of every candidate, [S, T]
+    :param candidates: tokens of candidates, [S, T]
+    :return: scores, [S]
+    """
+    word2id = {}
+    reference_ids = [[word2id.setdefault(token, len(word2id)) for token in rouge_tokens(reference)]
+                     for reference in references]
+    candidate_ids = [[word2id.setdefault(token, len(word2id)) for token in rouge_tokens(candidate)]
+                     for candidate in candidates]
+    lengths = lcs_lengths(reference_ids, candidate_ids).astype(np.float64)
+    reference_lens = np.fromiter(map(len, reference_ids), dtype=np.float64, count=len(reference_ids))
+    candidate_lens = np.fromiter(map(len, candidate_ids), dtype=np.float64, count=len(candidate_ids))
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        precisions = np.where(candidate_lens == 0, 0.0, lengths / candidate_lens)
+        recalls = np.where(reference_lens == 0, 0.0, lengths / reference_lens)
+        scores = precisions * recalls / ((1 - rouge_alpha) * precisions + rouge_alpha * recalls)
+    return np.where((precisions == 0) | (recalls == 0), 0.0, scores)
+
+
+def meteor_stem(word) -> str:
+    """
+    porter stem of a lowered word, as nltk meteor stems it
+    """
+    stem = _meteor_stems.get(word)
+    if stem is None:
+        stem = _meteor_stems[word] = _meteor_stemmer.stem(word)
+    return stem
+
+
+def meteor_synonyms(word, wordnet_reader=None) -> frozenset:
+    """
+    the word and its synonyms as nltk meteor matches them: names of lemmas of all its synsets without '_'
+    :param wordnet_reader: reader of wordnet, default to nltk.corpus.wordnet, only the default is cached
+    """
+    if wordnet_reader is not None:
+        return frozenset(lemma.name() for synset in wordnet_reader.synsets(word) for lemma in synset.lemmas()
+                         if lemma.name().find('_') < 0).union({word})
+    synonyms = _meteor_synonyms.get(word)
+    if synonyms is None:
+        synonyms = _meteor_synonyms[word] = meteor_synonyms(word, wordnet)
+    return synonyms
+
+
+def preload_meteor_words(words):
+    """
+    look up stems of given words and synonyms of their stems in advance, e.g. before forking workers
+    :param words: iterable of words, as in references and candidates
+    """
+    for word in set(word.lower() for word in words):
+        meteor_synonyms(meteor_stem(word))
+
+
+def get_meteor_cache() -> dict:
+    """
+    all stems and synonyms looked up so far, e.g. for processes which do not share the memory of this one
+    """
+    return {'stems': _meteor_stems, 'synonyms': _meteor_synonyms}
+
+
+def update_meteor_cache(cache):
+    """
+    add stems and synonyms from get_meteor_cache to those of this run
+    """
+    _meteor_stems.update(cache['stems'])
+    _meteor_synonyms.update(cache['synonyms'])
+
+
+def load_meteor_cache(path):
+    """
+    add the stems and synonyms saved by save_meteor_cache to those of this run, if the file exists
+    """
+    if os.path.exists(path):
+        with open(path, 'rb') as file:
+            update_meteor_cache(pickle.load(file))
+
+
+def save_meteor_cache(path):
+    """
+    save all stems and synonyms looked up so far, for load_meteor_cache of later runs
+    """
+    with open(path, 'wb') as file:
+        pickle.dump(get_meteor_cache(), file)
+
+
+def _match_meteor_words(candidate, candidate_words, reference, reference_words, synonyms=None):
+    """
+    one stage of the alignment of nltk meteor, every candidate word from the last one is matched with
+    the last reference word still unmatched which equals it, or is one of its synonyms if given
+    :param candidate: positions of candidate words not matched yet
+    :param candidate_words: words of candidate at this stage, lowered or stemmed
+    :param reference: positions of reference words not matched yet
+    :param reference_words: words of reference at this stage
+    :param synonyms: function of a candidate word, returning the reference words it matches, or None
+    :return: matches, list of positions in candidate and reference
+             positions of candidate and reference words still not matched
+    """
+    positions = {}
+    for position in reference:
+        positions.setdefault(reference_words[position], []).append(position)
+    matches = []
+    unmatched_candidate = []
+    for position in reversed(candidate):
+        word = candidate_words[position]
+        if synonyms is None:
+            word_positions = positions.get(word)
+            reference_position = word_positions.pop() if word_positions else -1
+        else:
+            reference_position = -1
+            best_positions = None
+            for synonym in synonyms(word):
+                word_positions = positions.get(synonym)
+                if word_positions and word_positions[-1] > reference_position:
+                    reference_position = word_positions[-1]
+                    best_positions = word_positions
+            if best_positions is not None:
+                best_positions.pop()
+        if reference_position < 0:
+            unmatched_candidate.append(position)
+        else:
+            matches.append((position, reference_position))
+    if matches:
+        matched_reference = set(reference_position for _, reference_position in matches)
+        reference = [position for position in reference if position not in matched_reference]
+    unmatched_candidate.reverse()
+    return matches, unmatched_candidate, reference
+
+
+def meteor_score(reference, candidate, alpha=meteor_alpha, beta=meteor_beta, gamma=meteor_gamma,
+                 wordnet_reader=None) -> float:
+    """
+    meteor score of one candidate, as nltk single_meteor_score: words are lowered, and aligned by exact match,
+    then by porter stems, then by wordnet synonyms of the candidate stems, with stems and synonyms memoized
+    :param reference: tokens of reference sentence
+    :param candidate: tokens of sentence generated by model
+    :param wordnet_reader: reader of wordnet, default to nltk.corpus.wordnet
+    :return: meteor score
+    """
+    candidate_len = len(candidate)
+    reference_len = len(reference)
+    if candidate_len == 0 or reference_len == 0:
+        return 0.0
+    candidate_words = [word.lower() for word in candidate]
+    reference_words = [word.lower() for word in reference]
+
+    matches, candidate, reference = _match_meteor_words(range(candidate_len), candidate_words,
+                                                        range(reference_len), reference_words)
+    if candidate and reference:
+        candidate_words = [meteor_stem(word) for word in candidate_words]
+        reference_words = [meteor_stem(word) for word in reference_words]
+        stem_matches, candidate, reference = _match_meteor_words(candidate, candidate_words,
+                                                                 reference, reference_words)
+        matches += stem_matches
+    if candidate and reference:
+        synonym_matches, _, _ = _match_meteor_words(candidate, candidate_words, reference, reference_words,
+                                                    lambda word: meteor_synonyms(word, wordnet_reader))
+        matches += synonym_matches
+    matches.sort()
+
+    matches_count = len(matches)
+    if matches_count == 0:
+        return 0.0
+    precision = float(matches_count) / candidate_len
+    recall = float(matches_count) / reference_len
+    fmean = (precision * recall) / (alpha * precision + (1 - alpha) * recall)
+    # fewest chunks of matches adjacent in both sentences
+    chunk_count = 1
+    previous_candidate, previous_reference = matches[0]
+    for candidate_position, reference_position in matches[1:]:
+        if candidate_position != previous_candidate + 1 or reference_position != previous_reference + 1:
+            chunk_count += 1
+        previous_candidate, previous_reference = candidate_position, reference_position
+    frag_frac = float(chunk_count) / matches_count
+    penalty = gamma * frag_frac ** beta
+    return (1 - penalty) * fmean
+
+
+def meteor_scores(references, candidates) -> np.ndarray:
+    """
+    meteor score of every candidate, see meteor_score
+    :param references: tokens of reference of every candidate, [S, T]
+    :param candidates: tokens of candidates, [S, T]
+    :return: scores, [S]
+    """
+    return np.array([meteor_score(reference, candidate) for reference, candidate in zip(references, candidates)],
+                    dtype=np.float64)
@@ -2,7 +2,12 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
+from torch.utils.checkpoint import checkpoint
+from torch.func import functional_call
+from concurrent.futures import ThreadPoolExecutor
+import functools
 import math
+import os
 import random
 
 import config
@@ -44,6 +49,25 @@ def init_wt_normal(wt):
     wt.data.normal_(std=config.init_normal_std)
 
 
+def split_sparse_parameters(module: nn.Module) -> (list, list):
+    """
+    split parameters into weights of sparse embeddings, whose gradients are sparse, and the others
+    :param module: model
+    :return: sparse parameters, dense parameters
+    """
+    sparse_ids = set()
+    for sub_module in module.modules():
+        if isinstance(sub_module, nn.Embedding) and sub_module.sparse:
+            sparse_ids.add(id(sub_module.weight))
+    sparse_params, dense_params = [], []
+    for param in module.parameters():
+        if id(param) in sparse_ids:
+            sparse_params.append(param)
+        else:
+            dense_params.append(param)
+    return sparse_params, dense_params
+
+
 def init_wt_uniform(wt):
     """
     initialize the given weight following the uniform distribution
@@ -53,19 +77,68 @@ def init_wt_uniform(wt):
     wt.data.uniform_(-config.init_uniform_mag, config.init_uniform_mag)
 
 
+# single worker thread which runs the code encoder while the calling thread runs the ast encoder
+_encoder_executor = None
+
+
+def get_encoder_executor() -> ThreadPoolExecutor:
+    global _encoder_executor
+    if _encoder_executor is None:
+        _encoder_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='code_encoder')
+    return _encoder_executor
+
+
+def _drop_encoder_executor():
+    """
+    the thread of the executor does not exist in a forked child, e.g. a worker of eval.Test,
+    so the child creates its own executor on first use
+    """
+    global _encoder_executor
+    _encoder_executor = None
+
+
+os.register_at_fork(after_in_child=_drop_encoder_executor)
+
+
+def run_with_grad_enabled(module, grad_enabled, *inputs):
+    """
+    run the module in current thread, grad mode is thread local so it must be passed from the calling thread
+    """
+    with torch.set_grad_enabled(grad_enabled):
+        return module(*inputs)
+
+
+def checkpoint_module(module, *inputs):
+    """
+    run the module with activation checkpointing, its parameters are inputs of the checkpoint,
+    so that the recomputation in backward uses the parameters of the forward pass, adapt() of learn2learn
+    replaces the parameters of a cloned module after its forward pass
+    """
+    return checkpoint(functional_call, module, dict(module.named_parameters()), inputs, use_reentrant=False)
+
+
+def with_parameters(module, parameters):
+    """
+    the module as a function of given parameters instead of its own, if parameters is None the module itself
+    """
+    if parameters is None:
+        return module
+    return lambda *args, **kwargs: functional_call(module, parameters, args, kwargs)
+
+
 class Encoder(nn.Module):
     """
     Encoder for both code and ast
     """
 
-    def __init__(self, vocab_size):
+    def __init__(self, vocab_size, hidden_size=config.hidden_size, embedding_dim=config.embedding_dim):
         super(Encoder, self).__init__()
-        self.hidden_size = config.hidden_size
+        self.hidden_size = hidden_size
         self.num_directions = 2
 
         # vocab_size: config.code_vocab_size for code encoder, size of sbt vocabulary for ast encoder
-        self.embedding = nn.Embedding(vocab_size, config.embedding_dim)
-        self.gru = nn.GRU(config.embedding_dim, self.hidden_size,bidirectional=True)
+        self.embedding = nn.Embedding(vocab_size, embedding_dim, sparse=config.use_sparse_embedding)
+        self.gru = nn.GRU(embedding_dim, self.hidden_size,bidirectional=True)
 
         init_wt_normal(self.embedding.weight)
         init_rnn_wt(self.gru)
@@ -93,6 +166,79 @@ class Encoder(nn.Module):
         return torch.zeros(self.num_directions, batch_size, self.hidden_size, device=config.device)
 
 
+class TransformerEncoder(nn.Module):
+    """
+    Self-attention encoder for both code and ast, parallel over time steps, same contract as Encoder
+    """
+
+    def __init__(self, vocab_size, hidden_size=config.hidden_size, embedding_dim=config.embedding_dim,
+                 num_layers=config.transformer_layers, num_heads=config.transformer_heads,
+                 ff_size=config.transformer_ff_size):
+        super(TransformerEncoder, self).__init__()
+        self.hidden_size = hidden_size
+
+        self.embedding = nn.Embedding(vocab_size, embedding_dim, sparse=config.use_sparse_embedding)
+        self.input_linear = nn.Linear(embedding_dim, self.hidden_size)
+        layer = nn.TransformerEncoderLayer(d_model=self.hidden_size,
+                                           nhead=num_heads,
+                                           dim_feedforward=ff_size,
+                                           dropout=config.transformer_dropout_rate)
+        self.transformer = nn.TransformerEncoder(layer, num_layers=num_layers,
+                                                 enable_nested_tensor=False)
+
+    def forward(self, inputs: torch.Tensor, seq_lens) -> (torch.Tensor, torch.Tensor):
+        """
+
+        :param inputs: [T, B]
+        :param seq_lens: lengths of sequences, [B]
+        :return: outputs: [T, B, H], zeros at padding positions like Encoder
+                hidden: mean and max pooling of outputs, [2, B, H]
+        """
+        time_step, batch_size = inputs.size()
+        seq_lens = torch.as_tensor(seq_lens, device=inputs.device)
+        padding_mask = torch.arange(time_step, device=inputs.device).unsqueeze(0) >= seq_lens.unsqueeze(1)  # [B, T]
+
+        embedded = self.input_linear(self.embedding(inputs))    # [T, B, H]
+        embedded = embedded + positional_encoding(time_step, self.hidden_size, inputs.device).unsqueeze(1)
+        outputs = self.transformer(embedded, src_key_padding_mask=padding_mask)    # [T, B, H]
+        outputs = outputs.masked_fill(padding_mask.t().unsqueeze(2), 0.)
+
+        mean_hidden = outputs.sum(dim=0) / seq_lens.unsqueeze(1).to(outputs.dtype)  # [B, H]
+        max_hidden = outputs.masked_fill(padding_mask.t().unsqueeze(2), float('-inf')).max(dim=0)[0]  # [B, H]
+        hidden = torch.stack([mean_hidden, max_hidden])     # [2, B, H]
+
+        return outputs, hidden
+
+
+def positional_encoding(time_step, hidden_size, device) -> torch.Tensor:
+    """
+    sinusoidal positional encoding
+    :return: [T, H]
+    """
+    position = torch.arange(time_step, dtype=torch.float, device=device).unsqueeze(1)   # [T, 1]
+    div_term = torch.exp(torch.arange(0, hidden_size, 2, dtype=torch.float, device=device) *
+                         (-math.log(10000.0) / hidden_size))     # [H / 2]
+    encoding = torch.zeros(time_step, hidden_size, device=device)
+    encoding[:, 0::2] = torch.sin(position * div_term)
+    encoding[:, 1::2] = torch.cos(position * div_term)
+    return encoding
+
+
+def build_encoder(vocab_size, model_config) -> nn.Module:
+    """
+    build the encoder selected by model_config['encoder_type'], of the sizes in model_config, see get_model_config
+    """
+    encoder_type = model_config['encoder_type']
+    if encoder_type == 'gru':
+        return Encoder(vocab_size, model_config['hidden_size'], model_config['embedding_dim'])
+    if encoder_type == 'transformer':
+        return TransformerEncoder(vocab_size, model_config['hidden_size'], model_config['embedding_dim'],
+                                  num_layers=model_config['transformer_layers'],
+                                  num_heads=model_config['transformer_heads'],
+                                  ff_size=model_config['transformer_ff_size'])
+    raise Exception('Unknown encoder type: \'{}\''.format(encoder_type))
+
+
 class ReduceHidden(nn.Module):
 
     def __init__(self, hidden_size=config.hidden_size):
@@ -115,6 +261,45 @@ class ReduceHidden(nn.Module):
         return hidden
 
 
+class LengthPredictor(nn.Module):
+    """
+    Predict the length of the summary, counting the EOS, from the initial hidden state of decoder
+    """
+
+    def __init__(self, hidden_size=config.hidden_size, max_length=config.max_decode_steps):
+        super(LengthPredictor, self).__init__()
+        self.max_length = max_length
+        self.linear = nn.Linear(hidden_size, max_length)
+
+        init_linear_wt(self.linear)
+
+    def forward(self, decoder_hidden):
+        """
+
+        :param decoder_hidden: [1, B, H]
+        :return: log probs of lengths 1 to max_length, [B, max_length]
+        """
+        return F.log_softmax(self.linear(decoder_hidden.squeeze(0)), dim=1)
+
+    def caps(self, length_log_probs, probability=config.length_cap_probability, margin=config.length_cap_margin):
+        """
+        step caps of decoding, the shortest lengths whose predicted probability reaches given probability, plus margin
+        :param length_log_probs: [B, max_length]
+        :return: [B]
+        """
+        cum_probs = length_log_probs.exp().cumsum(dim=1)
+        return (cum_probs < probability).sum(dim=1) + 1 + margin
+
+    def eos_prior(self, length_log_probs, step, weight=config.length_prior_weight):
+        """
+        bonus to the log prob of EOS at given step, to favor summaries of likely lengths
+        :param length_log_probs: [B, max_length]
+        :param step: index of the decoding step, the summary ending there is of length step + 1
+        :return: [B]
+        """
+        return weight * length_log_probs[:, min(step, self.max_length - 1)]
+
+
 class Attention(nn.Module):
 
     def __init__(self, hidden_size=config.hidden_size):
@@ -126,117 +311,249 @@ class Attention(nn.Module):
         stdv = 1. / math.sqrt(self.v.size(0))
         self.v.data.normal_(mean=0, std=stdv)
 
-    def forward(self, hidden, encoder_outputs):
+    def forward(self, hidden, encoder_outputs, keys=None):
         """
         forward the net
-        :param hidden: the last hidden state of encoder, [1, B, H]
+        :param hidden: the last hidden state of decoder, [1, N, H],
+                       N is B x K for K hypotheses of every sequence, whose rows are adjacent
         :param encoder_outputs: [T, B, H]
-        :return: softmax scores, [B, 1, T]
+        :param keys: if given, project_keys(encoder_outputs)
+        :return: softmax scores, [N, 1, T]
         """
-        time_step, batch_size, _ = encoder_outputs.size()
-        h = hidden.repeat(time_step, 1, 1).transpose(0, 1)  # [B, T, H]
-        encoder_outputs = encoder_outputs.transpose(0, 1)   # [B, T, H]
-        attn_energies = self.score(h, encoder_outputs)      # [B, T]
+        if keys is None:
+            keys = self.project_keys(encoder_outputs)
+        time_step, batch_size, _ = keys.size()
+        # the hidden half of self.attn, broadcast over time steps and over the hypotheses of a sequence
+        query = F.linear(hidden.squeeze(0), self.attn.weight[:, :self.hidden_size])    # [N, H]
+        query = query.view(batch_size, -1, self.hidden_size)   # [B, K, H]
+        energy = F.relu(keys.unsqueeze(2) + query.unsqueeze(0))     # [T, B, K, H]
+        attn_energies = torch.matmul(energy, self.v).view(time_step, -1).t()   # [N, T]
         return F.softmax(attn_energies, dim=1).unsqueeze(1)
 
-    def score(self, hidden, encoder_outputs):
+    def project_keys(self, encoder_outputs):
         """
-        calculate the attention scores of each word
-        :param hidden: [B, T, H]
-        :param encoder_outputs: [B, T, H]
-        :return: energy: scores of each word in a batch, [B, T]
+        the encoder half of self.attn, which does not change over decoding steps
+        :param encoder_outputs: [T, B, H]
+        :return: keys: [T, B, H]
         """
-        # after cat: [B, T, 2*H]
-        # after attn: [B, T, H]
-        # energy: [B, T, H]
-        energy = F.relu(self.attn(torch.cat([hidden, encoder_outputs], dim=2)))
-        energy = energy.transpose(1, 2)     # [B, H, T]
-        v = self.v.repeat(encoder_outputs.size(0), 1).unsqueeze(1)      # [B, 1, H]
-        energy = torch.bmm(v, energy)   # [B, 1, T]
-        return energy.squeeze(1)
+        return F.linear(encoder_outputs, self.attn.weight[:, self.hidden_size:], self.attn.bias)
 
 
 class Decoder(nn.Module):
 
-    def __init__(self, vocab_size, hidden_size=config.hidden_size):
+    def __init__(self, vocab_size, hidden_size=config.hidden_size, embedding_dim=config.embedding_dim,
+                 out_vocab_size=config.nl_vocab_size):
         super(Decoder, self).__init__()
         self.hidden_size = hidden_size
 
-        self.embedding = nn.Embedding(vocab_size, config.embedding_dim)
+        self.embedding = nn.Embedding(vocab_size, embedding_dim, sparse=config.use_sparse_embedding)
         self.dropout = nn.Dropout(config.decoder_dropout_rate)
-        self.code_attention = Attention()
-        self.ast_attention = Attention()
-        self.gru = nn.GRU(config.embedding_dim + self.hidden_size, self.hidden_size)
-        self.out = nn.Linear(2 * self.hidden_size, config.nl_vocab_size)
+        self.code_attention = Attention(self.hidden_size)
+        self.ast_attention = Attention(self.hidden_size)
+        self.gru = nn.GRU(embedding_dim + self.hidden_size, self.hidden_size)
+        self.out = nn.Linear(2 * self.hidden_size, out_vocab_size)
 
         init_wt_normal(self.embedding.weight)
         init_rnn_wt(self.gru)
         init_linear_wt(self.out)
 
+        # rows of embedding x weight_ih for inference, filled lazily, see gate_inputs
+        self.use_gate_table = True
+        self.gate_table = None
+        self.gate_table_filled = None
+        self.gate_table_key = None
+
     def forward(self, inputs: torch.Tensor, last_hidden: torch.Tensor,
-                code_outputs: torch.Tensor, ast_outputs: torch.Tensor) \
+                code_outputs: torch.Tensor, ast_outputs: torch.Tensor, keys=None, shortlist=None) \
             -> (torch.Tensor, torch.Tensor, torch.Tensor):
         """
-        forward the net
-        :param inputs: word input of current time step, [B]
-        :param last_hidden: last decoder hidden state, [1, B, H]
+        forward the net, the batch may hold K hypotheses of every sequence of the encoder batch,
+        e.g. beams, as adjacent rows, they share the encoder outputs without copying them
+        :param inputs: word input of current time step, [B] or [B x K]
+        :param last_hidden: last decoder hidden state, [1, B, H] or [1, B x K, H]
         :param code_outputs: outputs of code encoder, [T, B, H]
         :param ast_outputs: outputs of ast encoder, [T, B, H]
-        :return: output: [B, nl_vocab_size]
+        :param keys: if given, project_keys(code_outputs, ast_outputs)
+        :param shortlist: if given, shortlist_out(indices) of the only words to predict
+        :return: output: [B, nl_vocab_size], or [B, len(indices)] with shortlist
                 hidden: [1, B, H]
                 attn_weights: [B, 1, T]
         """
-        embedded = self.embedding(inputs).unsqueeze(0)      # [1, B, embedding_dim]
-        #embedded = self.dropout(embedded)
-
-        code_attn_weights = self.code_attention(last_hidden, code_outputs)  # [B, 1, T]
-        code_context = code_attn_weights.bmm(code_outputs.transpose(0, 1))  # [B, 1, H]
-        code_context = code_context.transpose(0, 1)     # [1, B, H]
+        if keys is None:
+            keys = self.project_keys(code_outputs, ast_outputs)
+        code_keys, ast_keys = keys
+        batch_size = code_outputs.size(1)
+
+        code_attn_weights = self.code_attention(last_hidden, code_outputs, code_keys)  # [B, 1, T]
+        code_context = code_attn_weights.view(batch_size, -1, code_outputs.size(0)).bmm(
+            code_outputs.transpose(0, 1))  # [B, K, H]
+
+        ast_attn_weights = self.ast_attention(last_hidden, ast_outputs, ast_keys)  # [B, 1, T]
+        ast_context = ast_attn_weights.view(batch_size, -1, ast_outputs.size(0)).bmm(
+            ast_outputs.transpose(0, 1))     # [B, K, H]
+
+        context = code_context + ast_context    # [B, K, H]
+        context = context.view(-1, self.hidden_size)    # [B, H]
+        outputs = self.gru_step(inputs, context, last_hidden.squeeze(0))     # [B, H]
+        hidden = outputs.unsqueeze(0)   # [1, B, H]
+        if shortlist is None:
+            outputs = self.out(torch.cat([outputs, context], 1))    # [B, nl_vocab_size]
+        else:
+            outputs = F.linear(torch.cat([outputs, context], 1), *shortlist)
+        outputs = F.log_softmax(outputs, dim=1)     # [B, nl_vocab_size]
+        return outputs, hidden, code_attn_weights, ast_attn_weights
 
-        ast_attn_weights = self.ast_attention(last_hidden, ast_outputs)  # [B, 1, T]
-        ast_context = ast_attn_weights.bmm(ast_outputs.transpose(0, 1))     # [B, 1, H]
-        ast_context = ast_context.transpose(0, 1)   # [1, B, H]
+    def project_keys(self, code_outputs, ast_outputs):
+        """
+        keys of both attentions, to be computed once per encoder batch instead of once per step
+        :return: code_keys: [T, B, H]
+                ast_keys: [T, B, H]
+        """
+        return self.code_attention.project_keys(code_outputs), self.ast_attention.project_keys(ast_outputs)
 
-        context = code_context + ast_context    # [1, B, H]
+    def shortlist_out(self, indices):
+        """
+        rows of self.out for given words only, to be computed once per batch
+        :param indices: indices of words, [V']
+        :return: weight: [V', 2H]
+                bias: [V']
+        """
+        return self.out.weight.index_select(0, indices), self.out.bias.index_select(0, indices)
 
-        rnn_input = torch.cat([embedded, context], dim=2)   # [1, B, embedding_dim + H]
-        outputs, hidden = self.gru(rnn_input, last_hidden)  # [1, B, H] for both
-        outputs = outputs.squeeze(0)    # [B, H]
-        context = context.squeeze(0)    # [B, H]
-        outputs = self.out(torch.cat([outputs, context], 1))    # [B, nl_vocab_size]
-        outputs = F.log_softmax(outputs, dim=1)     # [B, nl_vocab_size]
-        return outputs, hidden, code_attn_weights, ast_attn_weights
+    def gru_step(self, inputs: torch.Tensor, context: torch.Tensor, last_hidden: torch.Tensor) -> torch.Tensor:
+        """
+        one step of self.gru on input [embedding of inputs, context], computed as a gru cell
+        :param inputs: word input of current time step, [B]
+        :param context: [B, H]
+        :param last_hidden: [B, H]
+        :return: hidden: [B, H]
+        """
+        # [3H, embedding_dim + H], gates in order of reset, update, new
+        weight_ih = self.gru.weight_ih_l0
+        embedding_dim = self.embedding.embedding_dim
+
+        gate_inputs = self.gate_inputs(inputs) + F.linear(context, weight_ih[:, embedding_dim:])     # [B, 3H]
+        gate_hidden = F.linear(last_hidden, self.gru.weight_hh_l0, self.gru.bias_hh_l0)     # [B, 3H]
+
+        hidden_size = last_hidden.size(-1)
+        reset_gate, update_gate = torch.sigmoid(gate_inputs[:, :2 * hidden_size] +
+                                                gate_hidden[:, :2 * hidden_size]).chunk(2, 1)
+        new_gate = torch.tanh(torch.addcmul(gate_inputs[:, 2 * hidden_size:], reset_gate,
+                                            gate_hidden[:, 2 * hidden_size:]))
+        # (1 - update_gate) * new_gate + update_gate * last_hidden
+        return torch.lerp(new_gate, last_hidden, update_gate)
+
+    def gate_inputs(self, inputs: torch.Tensor) -> torch.Tensor:
+        """
+        the embedding half of the gru input projection, embedding(inputs) x weight_ih[:, :embedding_dim] + bias_ih,
+        at inference it is a row gather of a [V, 3H] table, rows are computed the first time a word is fed
+        so that short lived models (eg. maml clones) do not pay for the whole vocabulary
+        :param inputs: [B]
+        :return: [B, 3H]
+        """
+        embedding_dim = self.embedding.embedding_dim
+        if self.training or torch.is_grad_enabled() or not self.use_gate_table:
+            return F.linear(self.embedding(inputs), self.gru.weight_ih_l0[:, :embedding_dim], self.gru.bias_ih_l0)
+
+        # rebuild the table whenever embedding or gru weights are replaced or modified in place
+        params = [self.embedding.weight] + list(self.gru.parameters())
+        key = tuple((param.data_ptr(), param._version) for param in params)
+        if key != self.gate_table_key:
+            weight = self.embedding.weight
+            self.gate_table = weight.new_empty((weight.size(0), 3 * self.hidden_size))
+            self.gate_table_filled = torch.zeros(weight.size(0), dtype=torch.bool, device=weight.device)
+            self.gate_table_key = key
+
+        missing = inputs[~self.gate_table_filled[inputs]].unique()
+        if missing.numel() > 0:
+            self.gate_table[missing] = F.linear(self.embedding(missing), self.gru.weight_ih_l0[:, :embedding_dim],
+                                                self.gru.bias_ih_l0)
+            self.gate_table_filled[missing] = True
+        return self.gate_table[inputs]
+
+
+def get_model_config(model_config=None) -> dict:
+    """
+    sizes of the model, hidden_size, embedding_dim, encoder_type and sizes of transformer encoders default to config,
+    compact_sbt is whether the ast encoder reads compact sbt, see config.use_compact_sbt,
+    nl_vocab_size is None for a decoder over the whole comment vocabulary,
+    max_length is the number of lengths of the length predictor, None for no length predictor
+    :param model_config: dict overriding some of the sizes, e.g. saved with a checkpoint
+    """
+    model_config_ = {
+        'hidden_size': config.hidden_size,
+        'embedding_dim': config.embedding_dim,
+        'encoder_type': config.encoder_type,
+        'transformer_layers': config.transformer_layers,
+        'transformer_heads': config.transformer_heads,
+        'transformer_ff_size': config.transformer_ff_size,
+        'compact_sbt': config.use_compact_sbt,
+        'nl_vocab_size': None,
+        'max_length': config.max_decode_steps if config.use_length_predictor else None
+    }
+    if model_config:
+        model_config_.update(model_config)
+    return model_config_
 
 
 class Model(nn.Module):
 
     def __init__(self, code_vocab_size, ast_vocab_size, nl_vocab_size,
-                 model_file_path=None, model_state_dict=None, is_eval=False):
+                 model_file_path=None, model_state_dict=None, is_eval=False, model_config=None):
+        """
+
+        :param model_config: dict overriding the sizes of the model, see get_model_config,
+                             the one saved with a checkpoint takes precedence
+        """
         super(Model, self).__init__()
 
+        state = None
+        if model_file_path:
+            state = torch.load(model_file_path,map_location=torch.device('cuda' if config.use_cuda else 'cpu'))
+            model_config = state.get('model_config', model_config)
+        if model_state_dict:
+            model_config = model_state_dict.get('model_config', model_config)
+        self.model_config = get_model_config(model_config)
+        # datasets read sbt as config says, which must be the representation the model is trained on
+        if self.model_config['compact_sbt'] != config.use_compact_sbt:
+            raise Exception('The model is trained on {}, set config.use_compact_sbt to {}.'.format(
+                'compact sbt' if self.model_config['compact_sbt'] else 'sbt', self.model_config['compact_sbt']))
+        hidden_size = self.model_config['hidden_size']
+        embedding_dim = self.model_config['embedding_dim']
+
         # vocabulary size for encoders
         self.code_vocab_size = code_vocab_size
         self.ast_vocab_size = ast_vocab_size
         self.is_eval = is_eval
 
         # init models
-        self.code_encoder = Encoder(self.code_vocab_size)
-        self.ast_encoder = Encoder(self.ast_vocab_size)
-        self.reduce_hidden = ReduceHidden()
-        self.decoder = Decoder(nl_vocab_size)
+        self.code_encoder = build_encoder(self.code_vocab_size, self.model_config)
+        self.ast_encoder = build_encoder(self.ast_vocab_size, self.model_config)
+        self.reduce_hidden = ReduceHidden(hidden_size)
+        if self.model_config['nl_vocab_size'] is None:
+            self.decoder = Decoder(nl_vocab_size, hidden_size, embedding_dim, out_vocab_size=config.nl_vocab_size)
+        else:
+            # a model restricted to the most frequent words of the (trimmed) comment vocabulary
+            self.decoder = Decoder(self.model_config['nl_vocab_size'], hidden_size, embedding_dim,
+                                   out_vocab_size=self.model_config['nl_vocab_size'])
+        self.out_vocab_size = self.decoder.out.out_features
+        self.length_predictor = None
+        if self.model_config['max_length'] is not None:
+            self.length_predictor = LengthPredictor(hidden_size, self.model_config['max_length'])
 
         if config.use_cuda:
             self.code_encoder = self.code_encoder.cuda()
             self.ast_encoder = self.ast_encoder.cuda()
             self.reduce_hidden = self.reduce_hidden.cuda()
             self.decoder = self.decoder.cuda()
+            if self.length_predictor is not None:
+                self.length_predictor = self.length_predictor.cuda()
 
-        if model_file_path:
-            state = torch.load(model_file_path,map_location=torch.device('cuda' if config.use_cuda else 'cpu'))
-            self.load_state_dict(state["model"])
+        if state:
+            self.load_model_state(state["model"])
 
         if model_state_dict:
-            self.load_state_dict(model_state_dict["model"])
+            self.load_model_state(model_state_dict["model"])
 
         if is_eval:
             self.code_encoder.eval()
@@ -244,23 +561,111 @@ class Model(nn.Module):
             self.reduce_hidden.eval()
             self.decoder.eval()
 
-    def forward(self, batch, batch_size, nl_vocab, is_test=False):
+    def load_model_state(self, model_state):
+        """
+        load weights of a checkpoint, which may be saved before the length predictor was added,
+        then the length predictor is trained from scratch, or dropped for evaluation
+        """
+        if self.length_predictor is not None and not any(key.startswith('length_predictor.') for key in model_state):
+            config.logger.info('No length predictor in the checkpoint, {}.'.format(
+                'it is not used' if self.is_eval else 'it is trained from scratch'))
+            if self.is_eval:
+                self.length_predictor = None
+                self.model_config['max_length'] = None
+            else:
+                model_state = dict(model_state, **{'length_predictor.' + key: value for key, value
+                                                   in self.length_predictor.state_dict().items()})
+        self.load_state_dict(model_state)
+
+    def length_loss(self, decoder_hidden, nl_seq_lens):
+        """
+        loss of the length predictor
+        :param decoder_hidden: initial hidden state of decoder, [1, B, H]
+        :param nl_seq_lens: lengths of targets including EOS, [B]
+        :return: nll loss
+        """
+        targets = torch.tensor(nl_seq_lens, dtype=torch.long, device=decoder_hidden.device)
+        targets = targets.clamp(1, self.length_predictor.max_length) - 1
+        return F.nll_loss(self.length_predictor(decoder_hidden), targets)
+
+    def forward(self, batch, batch_size, nl_vocab, is_test=False, teacher_forcing=None, encoder_states=None):
         """
 
         :param batch:
         :param batch_size:
         :param nl_vocab:
         :param is_test: if True, function will return before decoding
+        :param teacher_forcing: if given, list of whether to feed the target at every step,
+                                else decided randomly by config.teacher_forcing_ratio
+        :param encoder_states: if given, outputs of self.encode for the batch, which is not encoded again
         :return: decoder_outputs: [T, B, nl_vocab_size]
         """
+        nl_batch, nl_seq_lens = batch[4], batch[5]
+
+        if encoder_states is None:
+            encoder_states = self.encode(batch)
+        code_outputs, ast_outputs, decoder_hidden = encoder_states
+
+        if is_test:
+            return code_outputs, ast_outputs, decoder_hidden
+
+        if nl_seq_lens is None:
+            max_decode_step = config.max_decode_steps
+        else:
+            max_decode_step = max(nl_seq_lens)
+
+        decoder_inputs = utils.init_decoder_inputs(batch_size=batch_size, vocab=nl_vocab)  # [B]
+
+        decoder_outputs = torch.zeros((max_decode_step, batch_size, self.out_vocab_size), device=config.device)
+
+        # decide teacher forcing of every step up front, so that a checkpointed chunk recomputes the same steps
+        if teacher_forcing is None:
+            teacher_forcing = [config.use_teacher_forcing and random.random() < config.teacher_forcing_ratio
+                               and not self.is_eval for _ in range(max_decode_step)]
+
+        if config.use_batch_shrinking and self.is_eval and not torch.is_grad_enabled():
+            self.decode_shrinking(decoder_outputs, decoder_inputs, decoder_hidden, code_outputs, ast_outputs,
+                                  nl_batch, nl_seq_lens, teacher_forcing, nl_vocab)
+            return decoder_outputs
+
+        chunk_size = max_decode_step
+        if self.use_activation_checkpoint() and config.decoder_checkpoint_steps > 0:
+            chunk_size = config.decoder_checkpoint_steps
+
+        keys = self.decoder.project_keys(code_outputs, ast_outputs)
+        for start in range(0, max_decode_step, chunk_size):
+            end = min(start + chunk_size, max_decode_step)
+            if chunk_size < max_decode_step:
+                # parameters of the decoder are passed in, see checkpoint_module
+                outputs, decoder_hidden, decoder_inputs = checkpoint(self.decode_steps, decoder_inputs, decoder_hidden,
+                                                                     code_outputs, ast_outputs, keys, nl_batch,
+                                                                     teacher_forcing, start, end,
+                                                                     dict(self.decoder.named_parameters()),
+                                                                     use_reentrant=False)
+            else:
+                outputs, decoder_hidden, decoder_inputs = self.decode_steps(decoder_inputs, decoder_hidden,
+                                                                            code_outputs, ast_outputs, keys, nl_batch,
+                                                                            teacher_forcing, start, end)
+            decoder_outputs[start: end] = outputs
+
+        return decoder_outputs
+
+    def encode(self, batch):
+        """
+        encode code and ast, and get the initial hidden state of decoder
+        :param batch: get from collate_fn
+        :return: code_outputs: [T, B, H]
+                ast_outputs: [T, B, H]
+                decoder_hidden: [1, B, H]
+        """
         # batch: [T, B]
-        code_batch, code_seq_lens, ast_batch, ast_seq_lens, nl_batch, nl_seq_lens = batch
+        code_batch, code_seq_lens, ast_batch, ast_seq_lens = batch[:4]
 
         # encode
         # outputs: [T, B, H]
         # hidden: [2, B, H]
-        code_outputs, code_hidden = self.code_encoder(code_batch, code_seq_lens)
-        ast_outputs, ast_hidden = self.ast_encoder(ast_batch, ast_seq_lens)
+        code_outputs, code_hidden, ast_outputs, ast_hidden = self.run_encoders(code_batch, code_seq_lens,
+                                                                               ast_batch, ast_seq_lens)
 
         # data for decoder
         code_hidden = code_hidden[0] + code_hidden[1]   # [B, H]
@@ -269,30 +674,39 @@ class Model(nn.Module):
         ast_hidden = ast_hidden.unsqueeze(0)       # [1, B, H]
         decoder_hidden = self.reduce_hidden(code_hidden, ast_hidden)  # [1, B, H]
 
-        if is_test:
-            return code_outputs, ast_outputs, decoder_hidden
-
-        if nl_seq_lens is None:
-            max_decode_step = config.max_decode_steps
-        else:
-            max_decode_step = max(nl_seq_lens)
-
-        decoder_inputs = utils.init_decoder_inputs(batch_size=batch_size, vocab=nl_vocab)  # [B]
-
-        decoder_outputs = torch.zeros((max_decode_step, batch_size, config.nl_vocab_size), device=config.device)
+        return code_outputs, ast_outputs, decoder_hidden
 
-        for step in range(max_decode_step):
+    def decode_steps(self, decoder_inputs, decoder_hidden, code_outputs, ast_outputs, keys, nl_batch,
+                     teacher_forcing, start, end, decoder_parameters=None):
+        """
+        run the decoder from step start to step end (exclusive)
+        :param decoder_inputs: [B]
+        :param decoder_hidden: [1, B, H]
+        :param code_outputs: [T, B, H]
+        :param ast_outputs: [T, B, H]
+        :param keys: self.decoder.project_keys(code_outputs, ast_outputs)
+        :param nl_batch: [T, B]
+        :param teacher_forcing: whether to use teacher forcing for each step
+        :param decoder_parameters: if given, parameters to run the decoder with instead of its own
+        :return: outputs: [end - start, B, nl_vocab_size]
+                decoder_hidden: [1, B, H]
+                decoder_inputs: input of step end, [B]
+        """
+        decoder = with_parameters(self.decoder, decoder_parameters)
+        outputs = []
+        for step in range(start, end):
             # decoder_outputs: [B, nl_vocab_size]
             # decoder_hidden: [1, B, H]
             # attn_weights: [B, 1, T]
             decoder_output, decoder_hidden, \
-                code_attn_weights, ast_attn_weights = self.decoder(inputs=decoder_inputs,
-                                                                   last_hidden=decoder_hidden,
-                                                                   code_outputs=code_outputs,
-                                                                   ast_outputs=ast_outputs)
-            decoder_outputs[step] = decoder_output
-
-            if config.use_teacher_forcing and random.random() < config.teacher_forcing_ratio and not self.is_eval:
+                code_attn_weights, ast_attn_weights = decoder(inputs=decoder_inputs,
+                                                              last_hidden=decoder_hidden,
+                                                              code_outputs=code_outputs,
+                                                              ast_outputs=ast_outputs,
+                                                              keys=keys)
+            outputs.append(decoder_output)
+
+            if teacher_forcing[step]:
                 # use teacher forcing, ground truth to be the next input
                 decoder_inputs = nl_batch[step]
             else:
@@ -301,7 +715,98 @@ class Model(nn.Module):
                 decoder_inputs = indices.squeeze(1).detach()  # [B]
                 decoder_inputs = decoder_inputs.to(config.device)
 
-        return decoder_outputs
+        return torch.stack(outputs), decoder_hidden, decoder_inputs
+
+    def decode_shrinking(self, decoder_outputs, decoder_inputs, decoder_hidden, code_outputs, ast_outputs,
+                         nl_batch, nl_seq_lens, teacher_forcing, nl_vocab):
+        """
+        run the decoder on the sequences not finished yet only, and stop when all are finished,
+        a sequence is finished after its last target if targets are given, else after it outputs EOS,
+        outputs of finished sequences are left as zeros
+        :param decoder_outputs: filled in place, [T, B, nl_vocab_size]
+        :param decoder_inputs: [B]
+        :param decoder_hidden: [1, B, H]
+        :param code_outputs: [T, B, H]
+        :param ast_outputs: [T, B, H]
+        :param nl_batch: [T, B], or None
+        :param nl_seq_lens: lengths of targets, [B], or None
+        :param teacher_forcing: whether to use teacher forcing for each step
+        """
+        max_decode_step, batch_size, _ = decoder_outputs.size()
+        eos_index = utils.get_eos_index(nl_vocab)
+        # original positions of the sequences in the batch
+        active = torch.arange(batch_size, device=decoder_outputs.device)
+        seq_lens = list(nl_seq_lens) if nl_seq_lens is not None else None
+        code_keys, ast_keys = self.decoder.project_keys(code_outputs, ast_outputs)
+
+        for step in range(max_decode_step):
+            decoder_output, decoder_hidden, _, _ = self.decoder(inputs=decoder_inputs,
+                                                                last_hidden=decoder_hidden,
+                                                                code_outputs=code_outputs,
+                                                                ast_outputs=ast_outputs,
+                                                                keys=(code_keys, ast_keys))
+            decoder_outputs[step].index_copy_(0, active, decoder_output)
+
+            _, indices = decoder_output.topk(1)  # [B, 1]
+            if teacher_forcing[step]:
+                decoder_inputs = nl_batch[step]
+            else:
+                decoder_inputs = indices.squeeze(1)  # [B]
+
+            if seq_lens is not None:
+                keep = [index for index, seq_len in enumerate(seq_lens) if seq_len > step + 1]
+                if len(keep) == len(seq_lens):
+                    continue
+                seq_lens = [seq_lens[index] for index in keep]
+                keep = torch.tensor(keep, dtype=torch.long, device=active.device)
+            else:
+                unfinished = indices.squeeze(1).ne(eos_index)
+                if unfinished.all():
+                    continue
+                keep = unfinished.nonzero().squeeze(1)
+
+            if keep.numel() == 0:
+                break
+            active = active.index_select(0, keep)
+            decoder_inputs = decoder_inputs.index_select(0, keep)
+            decoder_hidden = decoder_hidden.index_select(1, keep)
+            code_outputs = code_outputs.index_select(1, keep)
+            ast_outputs = ast_outputs.index_select(1, keep)
+            code_keys = code_keys.index_select(1, keep)
+            ast_keys = ast_keys.index_select(1, keep)
+            if nl_batch is not None:
+                nl_batch = nl_batch.index_select(1, keep)
+
+    def use_activation_checkpoint(self) -> bool:
+        """
+        activations are only recomputed when a backward pass will follow
+        """
+        return config.use_activation_checkpoint and torch.is_grad_enabled() and not self.is_eval
+
+    def run_encoders(self, code_batch, code_seq_lens, ast_batch, ast_seq_lens):
+        """
+        run code encoder and ast encoder, concurrently on cpu if config.use_parallel_encoders,
+        the two encoders are independent so wall time approaches the longer one (usually ast)
+        :return: code_outputs, code_hidden, ast_outputs, ast_hidden
+        """
+        code_encoder, ast_encoder = self.code_encoder, self.ast_encoder
+        if self.use_activation_checkpoint():
+            # keep only the inputs of the encoders, gru activations over long sbt are recomputed in backward
+            code_encoder = functools.partial(checkpoint_module, self.code_encoder)
+            ast_encoder = functools.partial(checkpoint_module, self.ast_encoder)
+
+        # the number of intra-op threads is set per process, not per thread, so it is not split between
+        # the encoders, both of them start teams of all threads of torch, which oversubscribe the cores
+        if not config.use_parallel_encoders or config.use_cuda or torch.get_num_threads() < 2:
+            code_outputs, code_hidden = code_encoder(code_batch, code_seq_lens)
+            ast_outputs, ast_hidden = ast_encoder(ast_batch, ast_seq_lens)
+            return code_outputs, code_hidden, ast_outputs, ast_hidden
+
+        code_future = get_encoder_executor().submit(run_with_grad_enabled, code_encoder, torch.is_grad_enabled(),
+                                                    code_batch, code_seq_lens)
+        ast_outputs, ast_hidden = ast_encoder(ast_batch, ast_seq_lens)
+        code_outputs, code_hidden = code_future.result()
+        return code_outputs, code_hidden, ast_outputs, ast_hidden
 
     def set_state_dict(self, state_dict):
         self.code_encoder.load_state_dict(state_dict["code_encoder"])
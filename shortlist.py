@@ -0,0 +1,102 @@
+import torch
+import os
+import re
+from collections import Counter
+
+import config
+import utils
+
+
+def split_sub_tokens(token) -> list:
+    """
+    lower case sub-tokens of an identifier, split by camel case, digits and other characters,
+    e.g. getHTTPResponse_code -> get, http, response, code
+    """
+    return [word.lower() for word in re.findall(r'[A-Z]+(?![a-z])|[A-Z]?[a-z]+|[0-9]+', token)]
+
+
+def build_lexical_table(codes, nls, top_k=config.shortlist_lexical_top_k, min_count=config.vocab_min_count) -> dict:
+    """
+    learn the comment words likely for each code word from the training pairs,
+    by dice coefficient of the numbers of pairs they occur in
+    :param codes: list of tokens of code
+    :param nls: list of tokens of comment
+    :param top_k: number of comment words kept for each code word
+    :param min_count: pairs of words occurring together less often are ignored
+    :return: dict, code word -> list of comment words, the most likely first
+    """
+    code_counts = Counter()
+    nl_counts = Counter()
+    pair_counts = Counter()
+    for code, nl in zip(codes, nls):
+        code, nl = set(code), set(nl)
+        code_counts.update(code)
+        nl_counts.update(nl)
+        pair_counts.update((code_word, nl_word) for code_word in code for nl_word in nl)
+
+    candidates = {}
+    for (code_word, nl_word), count in pair_counts.items():
+        if count < min_count:
+            continue
+        dice = 2 * count / (code_counts[code_word] + nl_counts[nl_word])
+        candidates.setdefault(code_word, []).append((dice, nl_word))
+
+    return {code_word: [nl_word for _, nl_word in sorted(words, reverse=True)[:top_k]]
+            for code_word, words in candidates.items()}
+
+
+class Shortlist(object):
+    """
+    Candidate comment words of a batch, the decoder projects only onto them instead of the whole vocabulary:
+    the most frequent comment words, sub-tokens of the code of the batch,
+    and the comment words a lexical table (see build_lexical_table) lists for the code
+    """
+
+    def __init__(self, code_vocab: utils.Vocab, nl_vocab: utils.Vocab, out_vocab_size=None,
+                 size=config.shortlist_size, lexical_table=None):
+        """
+
+        :param code_vocab: vocabulary of code
+        :param nl_vocab: vocabulary of comment, whose words are in order of frequency
+        :param out_vocab_size: words the model predicts, the first out_vocab_size of nl_vocab, default to all
+        :param size: number of the most frequent comment words, always candidates
+        :param lexical_table: dict of build_lexical_table, or None
+        """
+        if out_vocab_size is None:
+            out_vocab_size = len(nl_vocab)
+        size = min(size, out_vocab_size)
+        self.frequent = torch.arange(size, device=config.device)
+
+        # comment words of each code word, besides the frequent ones
+        candidates = []
+        for index in range(len(code_vocab)):
+            word = code_vocab.index2word[index]
+            words = split_sub_tokens(word)
+            if lexical_table is not None:
+                words += lexical_table.get(word, [])
+            nl_indices = set(nl_vocab.word2index.get(nl_word, out_vocab_size) for nl_word in words)
+            candidates.append(sorted(nl_index for nl_index in nl_indices if size <= nl_index < out_vocab_size))
+
+        # code index -> comment indices, padded by a frequent word, [code_vocab_size, max_candidates]
+        max_candidates = max(max(len(nl_indices) for nl_indices in candidates), 1)
+        self.code_table = torch.tensor([nl_indices + [0] * (max_candidates - len(nl_indices))
+                                        for nl_indices in candidates], dtype=torch.long, device=config.device)
+
+    def candidates(self, code_batch: torch.Tensor) -> torch.Tensor:
+        """
+        candidate words of one batch
+        :param code_batch: [T, B]
+        :return: sorted comment indices, [V']
+        """
+        code_candidates = self.code_table.index_select(0, code_batch.reshape(-1)).view(-1)
+        return torch.cat([self.frequent, code_candidates]).unique()
+
+
+def load_shortlist(code_vocab: utils.Vocab, nl_vocab: utils.Vocab, out_vocab_size=None) -> Shortlist:
+    """
+    shortlist of config.shortlist_size frequent words, with the lexical table of config.shortlist_lexical_path if set
+    """
+    lexical_table = None
+    if config.shortlist_lexical_path:
+        lexical_table = utils.load_pickle(os.path.join(config.vocab_dir, config.shortlist_lexical_path))
+    return Shortlist(code_vocab, nl_vocab, out_vocab_size=out_vocab_size, lexical_table=lexical_table)
@@ -2,6 +2,7 @@ import torch
 import torch.nn as nn
 from torch.optim import Adam, lr_scheduler,SGD
 from torch.utils.data import DataLoader
+from torch.nn.utils.rnn import pad_sequence
 import os
 import time
 import threading
@@ -12,6 +13,7 @@ import config
 import data
 import models
 import eval
+import adapters
 torch.manual_seed(1)
 
 
@@ -26,11 +28,15 @@ class Train(object):
                                                  ,num_of_data=-1,save_file=True,exact_vocab=False
                                                  ,meta_baseline=False,code_test_path=None,ast_test_path=None,nl_test_path=None,num_of_data_meta=100,seed=1,adam=True
                                                  ,training_projects=None,validating_project=None,is_test=False,lr=config.learning_rate,save_path=None,spt_add_vocab=False
-                                                 ,is_full_baseline=False):
+                                                 ,is_full_baseline=False,model_config=None,adapter=False,freeze_encoder=False):
         """
 
         :param vocab_file_path: tuple of code vocab, ast vocab, nl vocab, if given, build vocab by given path
         :param model_file_path:
+        :param model_config: sizes of the model to build, see models.get_model_config
+        :param adapter: if True, freeze the model and train low-rank adapters only, see adapters.py
+        :param freeze_encoder: if True, freeze encoders and reduce_hidden and train the decoder only,
+                               encoder states of the train dataset are computed once and cached
         """
         torch.manual_seed(seed)
         # dataset
@@ -137,12 +143,26 @@ class Train(object):
                                   ast_vocab_size=self.ast_vocab_size,
                                   nl_vocab_size=self.nl_vocab_size,
                                   model_file_path=model_file_path,
-                                  model_state_dict=model_state_dict)
+                                  model_state_dict=model_state_dict,
+                                  model_config=model_config)
         # self.params = list(self.model.code_encoder.parameters()) + \
         #     list(self.model.ast_encoder.parameters()) + \
         #     list(self.model.reduce_hidden.parameters()) + \
         #     list(self.model.decoder.parameters())
         self.params=self.model.parameters()
+        self.adapter = adapter
+        if adapter:
+            self.adapter_config = adapters.get_adapter_config()
+            self.params = adapters.inject_adapters(self.model, self.adapter_config)
+        self.freeze_encoder = freeze_encoder
+        # dataset index -> encoder states of the example, filled in the first epoch if freeze_encoder
+        self.encoder_cache = None
+        if freeze_encoder:
+            for module in (self.model.code_encoder, self.model.ast_encoder, self.model.reduce_hidden):
+                module.requires_grad_(False)
+                # no dropout, so that cached states are those of the frozen encoders
+                module.eval()
+            self.params = [param for param in self.params if param.requires_grad]
         # pytorch_total_params = sum(p.numel() for p in self.params if p.requires_grad)
         # print("Total trainable parameter: ",pytorch_total_params)
         # optimizer
@@ -154,7 +174,16 @@ class Train(object):
             
         # ], betas=(0.9, 0.999), eps=1e-08, weight_decay=0, amsgrad=False)
         self.adam=adam
-        if adam:
+        # embeddings with sparse gradients get their own optimizer, SGD handles sparse gradients itself
+        self.sparse_optimizer = None
+        if adapter:
+            # embeddings are frozen, so no sparse gradients
+            self.optimizer=Adam(self.params,lr=lr) if adam else SGD(self.params,lr=0.5)
+        elif adam and config.use_sparse_embedding:
+            sparse_params, dense_params = models.split_sparse_parameters(self.model)
+            self.optimizer=Adam(dense_params,lr=lr)
+            self.sparse_optimizer=utils.RowSparseAdam(sparse_params,lr=lr)
+        elif adam:
             self.optimizer=Adam(self.model.parameters(),lr=lr)
         else:
             self.optimizer=SGD(self.model.parameters(),lr=0.5)
@@ -162,6 +191,10 @@ class Train(object):
             self.lr_scheduler = lr_scheduler.StepLR(self.optimizer,
                                                     step_size=config.lr_decay_every,
                                                     gamma=config.lr_decay_rate)
+            if self.sparse_optimizer is not None:
+                self.sparse_lr_scheduler = lr_scheduler.StepLR(self.sparse_optimizer,
+                                                               step_size=config.lr_decay_every,
+                                                               gamma=config.lr_decay_rate)
 
         # best score and model(state dict)
         self.min_loss: float = 1000
@@ -192,30 +225,42 @@ class Train(object):
         self.train_iter()
         return self.best_model
 
-    def train_one_batch(self, batch, batch_size, criterion):
+    def train_one_batch(self, batch, batch_size, criterion, encoder_states=None):
         """
         train one batch
         :param batch: get from collate_fn of corresponding dataloader
         :param batch_size: batch size
         :param criterion: loss function
+        :param encoder_states: cached encoder states of the batch, see Model.encode
         :return: avg loss
         """
-        nl_batch = batch[4]
+        # words out of the output vocabulary are neither fed to the decoder nor predicted
+        nl_batch = utils.restrict_vocab(batch[4], self.model.out_vocab_size, self.nl_vocab)
+        batch = (*batch[:4], nl_batch, batch[5])
 
         self.optimizer.zero_grad()
+        if self.sparse_optimizer is not None:
+            self.sparse_optimizer.zero_grad()
 
-        decoder_outputs = self.model(batch, batch_size, self.nl_vocab)     # [T, B, nl_vocab_size]
+        if encoder_states is None and self.model.length_predictor is not None:
+            encoder_states = self.model.encode(batch)
+        decoder_outputs = self.model(batch, batch_size, self.nl_vocab,
+                                     encoder_states=encoder_states)     # [T, B, nl_vocab_size]
 
-        decoder_outputs = decoder_outputs.view(-1, config.nl_vocab_size)
+        decoder_outputs = decoder_outputs.view(-1, self.model.out_vocab_size)
         nl_batch = nl_batch.view(-1)
 
         loss = criterion(decoder_outputs, nl_batch)
+        if self.model.length_predictor is not None:
+            loss = loss + config.length_loss_weight * self.model.length_loss(encoder_states[2], batch[5])
         loss.backward()
 
         # address over fit
-        torch.nn.utils.clip_grad_norm_(self.params, 5)
+        utils.clip_grad_norm(self.params, 5)
 
         self.optimizer.step()
+        if self.sparse_optimizer is not None:
+            self.sparse_optimizer.step()
 
         return loss
 
@@ -231,10 +276,10 @@ class Train(object):
             plot_loss = 0
             last_print_index = 0
             last_plot_index = 0
-            for index_batch, batch in enumerate(self.train_dataloader):
+            for index_batch, (batch, encoder_states) in enumerate(self.train_batches()):
 
                 batch_size = len(batch[0][0])
-                loss = self.train_one_batch(batch, batch_size, criterion)
+                loss = self.train_one_batch(batch, batch_size, criterion, encoder_states=encoder_states)
                 print_loss += loss.item()
                 plot_loss += loss.item()
                 config.logger.info(f'Epoch {epoch+1}, batch {index_batch}: {loss}')
@@ -290,6 +335,8 @@ class Train(object):
 
             if config.use_lr_decay and self.adam:
                 self.lr_scheduler.step()
+                if self.sparse_optimizer is not None:
+                    self.sparse_lr_scheduler.step()
 
         plt.xlabel('every {} batches'.format(config.plot_every))
         plt.ylabel('avg loss')
@@ -304,6 +351,55 @@ class Train(object):
                 self.best_epoch_batch[0], self.best_epoch_batch[1] if self.best_epoch_batch[1] != -1 else 'last')
             self.save_model(name=best_model_name, state_dict=self.best_model)
 
+    def train_batches(self):
+        """
+        batches of one epoch with their encoder states, which are None unless self.freeze_encoder,
+        with frozen encoders, the encoder states of each example are computed in the first epoch and cached,
+        every epoch draws new batches from the sampler of the dataloader and pads their cached states together
+        """
+        if not self.freeze_encoder:
+            for batch in self.train_dataloader:
+                yield batch, None
+            return
+
+        first_epoch = self.encoder_cache is None
+        if first_epoch:
+            self.encoder_cache = {}
+        for indices in self.train_dataloader.batch_sampler:
+            batch = self.train_dataloader.collate_fn([self.train_dataset[index] for index in indices])
+            if first_epoch:
+                with torch.no_grad():
+                    encoder_states = self.model.encode(batch)
+                self.cache_encoder_states(indices, batch, encoder_states)
+            else:
+                encoder_states = self.cached_encoder_states(indices)
+            yield batch, encoder_states
+
+    def cache_encoder_states(self, indices, batch, encoder_states):
+        """
+        split encoder states of a batch into states of each example, without padding
+        :param indices: dataset indices of the examples in the batch
+        :param batch: get from collate_fn
+        :param encoder_states: outputs of Model.encode for the batch
+        """
+        code_seq_lens, ast_seq_lens = batch[1], batch[3]
+        code_outputs, ast_outputs, decoder_hidden = encoder_states
+        for i, index in enumerate(indices):
+            self.encoder_cache[index] = (code_outputs[:code_seq_lens[i], i].clone(),
+                                         ast_outputs[:ast_seq_lens[i], i].clone(),
+                                         decoder_hidden[0, i].clone())
+
+    def cached_encoder_states(self, indices):
+        """
+        encoder states of a batch built from the cache, padded with zeros like the outputs of the encoders
+        :param indices: dataset indices of the examples in the batch
+        :return: code_outputs: [T, B, H]
+                ast_outputs: [T, B, H]
+                decoder_hidden: [1, B, H]
+        """
+        code_outputs, ast_outputs, decoder_hidden = zip(*(self.encoder_cache[index] for index in indices))
+        return pad_sequence(code_outputs), pad_sequence(ast_outputs), torch.stack(decoder_hidden).unsqueeze(0)
+
     def save_model(self, name=None, state_dict=None):
         """
         save current model
@@ -313,6 +409,9 @@ class Train(object):
         """
         if state_dict is None:
             state_dict = self.get_cur_state_dict()
+        if self.adapter:
+            # adapters only, to be loaded onto the base model by adapters.load_adapters
+            state_dict = {key: state_dict[key] for key in ('adapter', 'adapter_config', 'model_config')}
         if self.save_path is not None:
             if not os.path.exists(os.path.join('model/', self.save_path)):
                 os.makedirs(os.path.join('model/', self.save_path))
@@ -328,13 +427,25 @@ class Train(object):
 
     def get_cur_state_dict(self) -> dict:
         """
-        get current state dict of model
+        get current state dict of model,
+        in adapter mode, 'model' has the adapters merged so that it loads into a plain models.Model,
+        and the optimizer state is left out
         :return:
         """
+        if self.adapter:
+            return {
+                'model': adapters.merged_state_dict(self.model),
+                'adapter': adapters.adapter_state_dict(self.model),
+                'adapter_config': self.adapter_config,
+                'model_config': self.model.model_config,
+            }
         state_dict = {
                 'model': self.model.state_dict(),
                 'optimizer': self.optimizer.state_dict(),
+                'model_config': self.model.model_config,
             }
+        if self.sparse_optimizer is not None:
+            state_dict['sparse_optimizer'] = self.sparse_optimizer.state_dict()
         return state_dict
 
     def valid_state_dict(self, state_dict, epoch, batch=-1):
@@ -1,126 +1,149 @@
-from tqdm import tqdm
-from collections import defaultdict
 import torch
 import torch.nn as nn
-import torch.nn.functional as F
-from torch.nn.utils.rnn import pad_sequence
-from learn2learn.algorithms import MAML
-import os
+
 import time
 
-import models
-import data
 import utils
 import config
+import eval
+import metrics
+import ensemble
+
+
+class Translator(eval.Test):
+    """
+    Evaluate a model on a dataset in one pass, in place of eval.Eval and eval.Test each going through it:
+    every batch is encoded once, and the encoder states are used both for the loss on the targets
+    and for decoding the summaries, which are measured by the selected metrics
+    """
+
+    all_metrics = {'loss', 'bleu', 'rouge', 'meteor'}
+
+    def __init__(self, model, code_path=config.test_code_path, ast_path=config.test_sbt_path,
+                 nl_path=config.test_nl_path, vocab_path=None, decode_method=None, use_shortlist=None,
+                 metrics=('loss', 'bleu', 'rouge', 'meteor')):
+        """
 
-class Translator(object):
-    def __init__(self, model, sampling_temp=sampling_temp, sampling_topk=sampling_topk,
-                 beam_width=beam_width, n_best=n_best, max_iter=max_iter,
-                 length_penalty=length_penalty, coverage_penalty=coverage_penalty,
-                 metrics=['loss', 'bleu'], unk_replace=False, smooth=3):
-        self.model = model
+        :param model: see eval.Test, as the other parameters
+        :param metrics: any of 'loss', the teacher forced loss on the targets,
+                        'bleu', corpus and sentence level bleu, 'rouge', rouge-L, and 'meteor'
+        """
+        super(Translator, self).__init__(model, code_path=code_path, ast_path=ast_path, nl_path=nl_path,
+                                         vocab_path=vocab_path, decode_method=decode_method,
+                                         use_shortlist=use_shortlist)
         self.metrics = metrics
-        self.unk_replace = unk_replace
-        self.smooth = smooth
-        
+        if 'loss' in self.metrics and isinstance(self.model, ensemble.Ensemble):
+            raise Exception('Loss of an ensemble is not supported, remove \'loss\' from metrics.')
 
     @property
     def metrics(self):
         return self._metrics
-    
+
     @metrics.setter
     def metrics(self, metrics):
         metrics = set(metrics)
-        all_metrics = {'loss', 'bleu', 'rouge', 'meteor'}
-        if not metrics.issubset(all_metrics):
-            raise ValueError('Unkown metric(s): ' + str(metrics.difference(all_metrics)))
+        if not metrics.issubset(self.all_metrics):
+            raise ValueError('Unknown metric(s): ' + str(metrics.difference(self.all_metrics)))
         self._metrics = metrics
-    
-    def val_loss(self, final_state, memory, src_lengths, tgt_batch, weights):
-        outputs, _ = self.model.decoder(tgt_batch[:,:-1], final_state, memory, src_lengths)
-        loss = sequence_loss(outputs, tgt_batch[:,1:], is_probs=self.model.is_ensemble,
-                             pad_id=self.wrapped_decoder.pad_id)
-        return loss.item()
-    
-    def translate_batch(self, src_batch, src_lengths=None, tgt_batch=None, *args):
-        weights = args[0] if self.weights else None
-        raw_batches = args[-1] if self.raw_data else [None]
-        reports = dict(scores=None, attn_history=None)
-        with torch.no_grad():
-            memory, final_state = self.model.encoder(src_batch, src_lengths)
-            if 'loss' in self._metrics:
-                reports['loss'] = self.val_loss(final_state, memory, src_lengths, tgt_batch, weights)
-            predicts, reports['scores'], reports['attn_history'] = \
-            self.wrapped_decoder(final_state, memory, src_lengths, weights)
-        
-        
-        predicts = id2word(predicts, self.model.decoder.field,
-                           (raw_batches[0], reports['attn_history']), 
-                           replace_unk=self.unk_replace)
-        if 'bleu' in self._metrics:
-            reports['bleu'] = batch_bleu(predicts, raw_batches[-1], self.smooth) * 100
-        predicts = [' '.join(s) for s in predicts]
-        
-        if not self._metrics.isdisjoint({'rouge', 'meteor'}):
-            targets = [' '.join(s) for s in raw_batches[-1]]
-            if 'rouge' in self._metrics:
-                rouge = batch_rouge(predicts, targets)
-                reports['rouge'] = rouge['rouge-l']['f'] * 100
-            if 'meteor' in self._metrics:
-                reports['meteor'] = batch_meteor(predicts, targets) * 100
-        return predicts, reports
-    
-    def eval_one_batch(self, batch, batch_size, criterion):
+
+    def loss_batch(self, batch, batch_size):
+        """
+        batch of targets in indices for the loss, the raw comments of batch from collate_fn translated
+        :return: batch as from utils.unsort_collate_fn without raw_nl, targets restricted to the model vocabulary
         """
-        evaluate one batch
-        :param batch:
+        nl_batch = utils.indices_from_batch(batch[4], self.nl_vocab)     # [B, T]
+        nl_seq_lens = utils.get_seq_lens(nl_batch)
+        nl_batch = utils.pad_one_batch(nl_batch, self.nl_vocab)     # [T, B]
+        nl_batch = utils.restrict_vocab(nl_batch, self.model.out_vocab_size, self.nl_vocab)
+        return (*batch[:4], nl_batch, nl_seq_lens)
+
+    def translate_batch(self, batch, batch_size, criterion):
+        """
+        encode one batch, compute its loss and decode it, as selected by self.metrics
+        :param batch: get from collate_fn of self.dataloader, nl_batch is raw data
         :param batch_size:
-        :param criterion:
-        :return:
+        :param criterion: loss function on targets
+        :return: candidates, words of the best sentence of every example, [B, T], empty without measures on them
+                 reports, dict of 'loss' of the batch, and totals of sentence level scores of the batch
         """
+        references = batch[4]
+        reports = {}
+        candidates = []
         with torch.no_grad():
+            encoder_states = self.model.encode(batch)
+
+            if 'loss' in self.metrics:
+                loss_batch = self.loss_batch(batch, batch_size)
+                nl_batch = loss_batch[4]
+                decoder_outputs = self.model(loss_batch, batch_size, self.nl_vocab,
+                                             teacher_forcing=[True] * nl_batch.size(0),
+                                             encoder_states=encoder_states)     # [T, B, out_vocab_size]
+                reports['loss'] = criterion(decoder_outputs.view(-1, self.model.out_vocab_size),
+                                            nl_batch.view(-1)).item()
+
+            if self.metrics.difference({'loss'}):
+                candidates = self.decode_batch(batch, batch_size, encoder_states=encoder_states)
+
+        if 'bleu' in self.metrics:
+            reports['bleu'] = sum(metrics.sentence_bleu_scores(references, candidates).tolist())
+        if 'rouge' in self.metrics:
+            reports['rouge'] = sum(metrics.rouge_l_scores(references, candidates).tolist())
+        if 'meteor' in self.metrics:
+            reports['meteor'] = sum(metrics.meteor_scores(references, candidates).tolist())
+        return candidates, reports
+
+    def __call__(self, dataloader=None, save_path=None):
+        """
+        evaluate the model on the whole dataset
+        :param dataloader: default to self.dataloader, whose comments are raw data
+        :param save_path: if given, file to write the summaries into, one per line
+        :return: candidates, words of the best sentence of every example
+                 scores, dict of 'loss', the average over batches as eval.Eval,
+                 'c_bleu', 's_bleu', 'meteor' and 'rouge_L', as eval.Test, as selected by self.metrics
+        """
+        if dataloader is None:
+            dataloader = self.dataloader
+        start_time = time.time()
+        criterion = nn.NLLLoss(ignore_index=utils.get_pad_index(self.nl_vocab))
+        total_references = []
+        total_candidates = []
+        totals = dict.fromkeys(self.metrics, 0)
+        dataset_size = 0
+        if 'meteor' in self.metrics and self.dataset is not None:
+            utils.preload_meteor_words(self.dataset.get_dataset()[2])
+
+        for index_batch, batch in enumerate(dataloader):
+            batch_size = batch[0].shape[1]
+            candidates, reports = self.translate_batch(batch, batch_size, criterion)
+            for name, value in reports.items():
+                totals[name] += value
+            total_references += batch[4]
+            total_candidates += candidates
+            dataset_size += batch_size
+
+            if index_batch % config.print_every == 0:
+                spend_h, spend_min, spend_s, spend_ms = utils.to_time(time.time() - start_time)
+                print('time: {:2d}h {:2d}min {:2d}s {:3d}ms, batch: {}, '.format(
+                    spend_h, spend_min, spend_s, spend_ms, index_batch), end='')
+                print(', '.join('{}: {:.4f}'.format(name, value / (1 if name == 'loss' else batch_size))
+                                for name, value in reports.items()))
+
+        scores = {}
+        if 'loss' in self.metrics:
+            scores['loss'] = totals['loss'] / len(dataloader)
+        if 'bleu' in self.metrics:
+            scores['c_bleu'] = utils.corpus_bleu_score(references=total_references, candidates=total_candidates)
+            scores['s_bleu'] = totals['bleu'] / dataset_size
+        if 'meteor' in self.metrics:
+            scores['meteor'] = totals['meteor'] / dataset_size
+        if 'rouge' in self.metrics:
+            scores['rouge_L'] = totals['rouge'] / dataset_size
+        utils.print_test_scores(scores)
+        if 'meteor' in self.metrics:
+            utils.save_meteor_cache()
 
-            # code_batch and ast_batch: [T, B]
-            # nl_batch is raw data, [B, T] in list
-            # nl_seq_lens is None
-            nl_batch = batch[4]
-
-            decoder_outputs = self.model(batch, batch_size, self.nl_vocab)  # [T, B, nl_vocab_size]
-
-            decoder_outputs = decoder_outputs.view(-1, config.nl_vocab_size)
-            nl_batch = nl_batch.view(-1)
-
-            loss = criterion(decoder_outputs, nl_batch)
-
-            return loss
-    def init_generator(self, data_gen):
-        data_gen.raw_data = self.unk_replace or self._metrics.difference({'loss'})
-        self.raw_data = data_gen.raw_data
-        self.weights = self.model.is_ensemble and data_gen.weights
-    
-    def __call__(self, batches, save_path=None):
-        self.init_generator(batches)
-        self.model.eval()
-        results = []
-        reports = defaultdict(float, scores=[], attn_history=[])
-        
-        pbar = tqdm(batches, desc='Translating...')
-        for batch in pbar:
-            predicts, reports_ = self.translate_batch(*batch)
-            pbar.set_postfix({metric: reports_[metric] for metric in self._metrics})
-            results.extend(predicts)
-            for metric in self._metrics:
-                reports[metric] += reports_[metric]
-#            reports['scores'].extend(reports_['scores'])
-            # reports['attn_history'].extend(reports_['attn_history'])
-        
-        for metric in self._metrics:
-            reports[metric] /= len(batches)
-            print('total {}: {:.2f}'.format(metric, reports[metric]))
-            if metric == 'loss':
-                reports['ppl'] = perplexity(reports[metric])
-                print('total ppl: {:.2f}'.format(reports['ppl']))
         if save_path is not None:
-            save(results, save_path)
-        return results, reports
-    
+            with open(save_path, encoding='utf-8', mode='w') as file:
+                for candidate in total_candidates:
+                    file.write(' '.join(candidate) + '\n')
+        return total_candidates, scores
@@ -1,7 +1,9 @@
 import time
 
 import torch
+from torch.optim import Optimizer
 import itertools
+import math
 import os
 import pickle
 import numpy as np
@@ -9,6 +11,7 @@ import nltk
 from rouge import Rouge
 import random
 import config
+import metrics
 
 # special vocabulary symbols
 
@@ -19,6 +22,10 @@ _UNK = '<UNK>'  # OOV word
 
 _START_VOCAB = [_PAD, _SOS, _EOS, _UNK]
 
+# scorers are built once in every process and reused for all sentences, see get_rouge
+_smoothing_function = nltk.translate.bleu_score.SmoothingFunction()
+_rouge = None
+
 
 class Vocab(object):
 
@@ -142,6 +149,98 @@ class EarlyStopping(object):
             self.counter = 0
 
 
+class RowSparseAdam(Optimizer):
+
+    def __init__(self, params, lr=config.learning_rate, betas=(0.9, 0.999), eps=1e-8):
+        """
+        lazy adam for parameters with sparse gradients (embeddings with sparse=True), same update as
+        torch.optim.SparseAdam but the moments are only allocated for the rows which have been touched,
+        so that fine tuning on a few examples does not keep moments of the whole vocabulary
+        :param params: parameters with sparse gradients, [vocab_size, embedding_dim] each
+        """
+        super(RowSparseAdam, self).__init__(params, dict(lr=lr, betas=betas, eps=eps))
+
+    @torch.no_grad()
+    def step(self, closure=None):
+        loss = None
+        if closure is not None:
+            with torch.enable_grad():
+                loss = closure()
+
+        for group in self.param_groups:
+            beta1, beta2 = group['betas']
+            for p in group['params']:
+                if p.grad is None:
+                    continue
+                if not p.grad.is_sparse:
+                    raise Exception('RowSparseAdam does not support dense gradients, use Adam instead.')
+                grad = p.grad.coalesce()
+                rows = grad.indices()[0]
+                grad_values = grad.values()
+                if grad_values.numel() == 0:
+                    continue
+
+                state = self.state[p]
+                if len(state) == 0:
+                    state['step'] = 0
+                    # slot of each row in the moments, -1 if the row has never been touched
+                    state['slots'] = torch.full((p.size(0),), -1, dtype=torch.long, device=p.device)
+                    state['exp_avg'] = p.new_zeros((0,) + p.size()[1:])
+                    state['exp_avg_sq'] = p.new_zeros((0,) + p.size()[1:])
+                state['step'] += 1
+
+                # allocate moments for rows touched for the first time
+                new_rows = rows[state['slots'][rows] < 0]
+                if new_rows.numel() > 0:
+                    n_slots = state['exp_avg'].size(0)
+                    state['slots'][new_rows] = torch.arange(n_slots, n_slots + new_rows.numel(), device=p.device)
+                    padding = p.new_zeros((new_rows.numel(),) + p.size()[1:])
+                    state['exp_avg'] = torch.cat([state['exp_avg'], padding])
+                    state['exp_avg_sq'] = torch.cat([state['exp_avg_sq'], padding])
+
+                slots = state['slots'][rows]
+                exp_avg = state['exp_avg'][slots].mul_(beta1).add_(grad_values, alpha=1 - beta1)
+                exp_avg_sq = state['exp_avg_sq'][slots].mul_(beta2).addcmul_(grad_values, grad_values,
+                                                                             value=1 - beta2)
+                state['exp_avg'][slots] = exp_avg
+                state['exp_avg_sq'][slots] = exp_avg_sq
+
+                bias_correction1 = 1 - beta1 ** state['step']
+                bias_correction2 = 1 - beta2 ** state['step']
+                step_size = group['lr'] * math.sqrt(bias_correction2) / bias_correction1
+                p.index_add_(0, rows, exp_avg.div_(exp_avg_sq.sqrt_().add_(group['eps'])), alpha=-step_size)
+
+        return loss
+
+
+def clip_grad_norm(params, max_norm) -> torch.Tensor:
+    """
+    clip gradients by their total norm as torch.nn.utils.clip_grad_norm_, with sparse gradients of embeddings,
+    see config.use_sparse_embedding, coalesced once here and kept coalesced for utils.RowSparseAdam,
+    which torch.nn.utils.clip_grad_norm_ does not keep, see validatesparse.py for a check against dense gradients
+    :param params: parameters, whose sparse gradients are replaced by coalesced ones
+    :param max_norm: max norm of all gradients
+    :return: total norm of the gradients, as if they were dense
+    """
+    grads = []
+    for param in params:
+        if param.grad is None:
+            continue
+        if param.grad.is_sparse:
+            param.grad = param.grad.coalesce()
+        grads.append(param.grad)
+    if not grads:
+        return torch.tensor(0.)
+    total_norm = torch.linalg.vector_norm(torch.stack([
+        torch.linalg.vector_norm(grad.values() if grad.is_sparse else grad) for grad in grads]))
+    # the same coefficient as torch.nn.utils.clip_grad_norm_
+    clip_coef = torch.clamp(max_norm / (total_norm + 1e-6), max=1.0)
+    for grad in grads:
+        # scaling a sparse tensor in place would mark it uncoalesced, its values are scaled instead
+        (grad.values() if grad.is_sparse else grad).mul_(clip_coef)
+    return total_norm
+
+
 def load_vocab_pk(file_name) -> Vocab:
     """
     load pickle file by given file name
@@ -184,6 +283,28 @@ def load_dataset(dataset_path,num_of_data=-1,seed=1) -> list:
         return [lines[i] for i in ele_pos]
         #return lines[:num_of_data]
 
+def compact_sbt(sbt: list) -> list:
+    """
+    convert sbt "( type ... ) type" into compact sbt "type ... )" by dropping "(" and the type after ")",
+    sbt which is already compact is returned unchanged
+    :param sbt: tokens of sbt
+    :return: tokens of compact sbt
+    """
+    if '(' not in sbt:
+        return sbt
+    compact = []
+    skip_next = False
+    for token in sbt:
+        if skip_next:
+            skip_next = False
+        elif token == '(':
+            continue
+        else:
+            compact.append(token)
+            skip_next = token == ')'
+    return compact
+
+
 def filter_data(codes, asts, nls):
     """
     filter the data according to the rules
@@ -346,6 +467,44 @@ def get_eos_index(vocab: Vocab) -> int:
     return vocab.word2index[_EOS]
 
 
+def get_unk_index(vocab: Vocab) -> int:
+    return vocab.word2index[_UNK]
+
+
+def restrict_vocab(nl_batch: torch.Tensor, vocab_size, vocab: Vocab) -> torch.Tensor:
+    """
+    map the words out of the first vocab_size words of vocab to unk,
+    the trimmed vocabulary is sorted by frequency so these are the most frequent words
+    :param nl_batch: indices of words, any shape
+    :param vocab_size: number of words kept
+    :return: same shape as nl_batch
+    """
+    if vocab_size >= len(vocab):
+        return nl_batch
+    return nl_batch.masked_fill(nl_batch >= vocab_size, get_unk_index(vocab))
+
+
+def filter_logits(logits: torch.Tensor, top_k=0, top_p=1.0) -> torch.Tensor:
+    """
+    keep only the top_k most likely words, and the smallest set of most likely words whose probability
+    reaches top_p, the logits of the other words are set to -inf
+    :param logits: [B, V]
+    :param top_k: 0 for no limit
+    :param top_p: 1.0 for no limit
+    :return: [B, V]
+    """
+    if 0 < top_k < logits.size(1):
+        kth_logits = logits.topk(top_k, dim=1)[0][:, -1:]   # [B, 1]
+        logits = logits.masked_fill(logits < kth_logits, float('-inf'))
+    if top_p < 1.0:
+        sorted_logits, sorted_indices = logits.sort(dim=1, descending=True)
+        sorted_probs = torch.softmax(sorted_logits, dim=1)
+        # probability of the more likely words, the most likely word is always kept
+        removed = sorted_probs.cumsum(dim=1) - sorted_probs >= top_p
+        logits = logits.masked_fill(removed.scatter(1, sorted_indices, removed), float('-inf'))
+    return logits
+
+
 def collate_fn(batch, code_vocab, ast_vocab, nl_vocab, is_eval=False) -> \
         (torch.Tensor, list, list, torch.Tensor, list, list, torch.Tensor, list):
     """
@@ -513,58 +672,108 @@ def measure(batch_size, references, candidates) -> (float, float):
     total_meteor = 0
     total_rouge=0
 
-    for index_batch in range(batch_size):
-        reference = references[index_batch]
-        candidate = candidates[index_batch]
-
-        # sentence level bleu score
-        sentence_bleu = sentence_bleu_score(reference, candidate)
+    # sentence level bleu score and rouge-L, of the whole batch at once
+    for sentence_bleu in metrics.sentence_bleu_scores(references[:batch_size], candidates[:batch_size]).tolist():
         total_s_bleu += sentence_bleu
-
-        # meteor score
-        meteor = meteor_score(reference, candidate)
+    for rouge_score in metrics.rouge_l_scores(references[:batch_size], candidates[:batch_size]).tolist():
+        total_rouge += rouge_score
+    for meteor in metrics.meteor_scores(references[:batch_size], candidates[:batch_size]).tolist():
         total_meteor += meteor
-
-        #rouge-L
-        rouge_score=rouge(reference,candidate)
-        total_rouge+=rouge_score
     return total_s_bleu, total_meteor,total_rouge
 
 
 def sentence_bleu_score(reference, candidate) -> float:
     """
-    calculate the sentence level bleu score, 4-gram with weights(0.25, 0.25, 0.25, 0.25)
+    calculate the sentence level bleu score, 4-gram with weights(0.25, 0.25, 0.25, 0.25),
+    see metrics.sentence_bleu_scores for many sentences at once
     :param reference: tokens of reference sentence
     :param candidate: tokens of sentence generated by model
     :return: sentence level bleu score
     """
-    smoothing_function = nltk.translate.bleu_score.SmoothingFunction()
+    return metrics.sentence_bleu_scores([reference], [candidate]).item()
+
+
+def corpus_bleu_score(references, candidates) -> float:
+    return metrics.corpus_bleu_score(references, candidates)
+
+
+def nltk_sentence_bleu_score(reference, candidate) -> float:
+    """
+    sentence level bleu score by nltk, which metrics.sentence_bleu_scores matches, see validatemetrics.py
+    """
     return nltk.translate.bleu_score.sentence_bleu(references=[reference],
                                                    hypothesis=candidate,
-                                                   smoothing_function=smoothing_function.method4)
+                                                   smoothing_function=_smoothing_function.method4)
 
 
-def corpus_bleu_score(references, candidates) -> float:
-    smoothing_function = nltk.translate.bleu_score.SmoothingFunction()
+def nltk_corpus_bleu_score(references, candidates) -> float:
+    """
+    corpus level bleu score by nltk, which metrics.corpus_bleu_score matches, see validatemetrics.py
+    """
     return nltk.translate.bleu_score.corpus_bleu(list_of_references=[[reference] for reference in references],
                                                  hypotheses=[candidate for candidate in candidates],
-                                                 smoothing_function=smoothing_function.method4)
+                                                 smoothing_function=_smoothing_function.method4)
 
 
 def meteor_score(reference, candidate):
     """
-    meteor score
+    meteor score, with alpha=0.85, beta=0.2, gamma=0.6, see metrics.meteor_score
     :param reference:
     :param candidate:
     :return:
     """
+    return metrics.meteor_score(reference, candidate)
+
+
+def nltk_meteor_score(reference, candidate):
+    """
+    meteor score by nltk, which metrics.meteor_score matches, see validatemetrics.py
+    """
     return nltk.translate.meteor_score.single_meteor_score(reference,
                                                            candidate, alpha=0.85, beta=0.2, gamma=0.6)
 
 
+def preload_meteor_words(sentences):
+    """
+    look up stems and synonyms of all words of given sentences for meteor in advance,
+    from the file of config.meteor_cache_path in config.out_dir first if there is one
+    :param sentences: list of token lists, e.g. all references of a dataset
+    """
+    if config.meteor_cache_path:
+        metrics.load_meteor_cache(os.path.join(config.out_dir, config.meteor_cache_path))
+    metrics.preload_meteor_words(itertools.chain.from_iterable(sentences))
+
+
+def save_meteor_cache():
+    """
+    save stems and synonyms looked up for meteor into config.meteor_cache_path in config.out_dir, if given
+    """
+    if config.meteor_cache_path:
+        metrics.save_meteor_cache(os.path.join(config.out_dir, config.meteor_cache_path))
+
+
+def get_rouge() -> Rouge:
+    """
+    rouge-L scorer of this process, built on first use
+    """
+    global _rouge
+    if _rouge is None:
+        _rouge = Rouge(metrics=['rouge-l'], max_n=4)
+    return _rouge
+
+
 def rouge(reference, candidate):
-    rouge = Rouge(metrics=['rouge-l'], max_n=4)
-    result=rouge.get_scores(' '.join(candidate), ' '.join(reference))
+    """
+    rouge-L f score, see metrics.rouge_l_scores for many sentences at once
+    """
+    return metrics.rouge_l_scores([reference], [candidate]).item()
+
+
+def package_rouge(reference, candidate):
+    """
+    rouge-L f score by the rouge package, which metrics.rouge_l_scores matches, see validatemetrics.py
+    """
+    result=get_rouge().get_scores(' '.join(candidate), ' '.join(reference))
     return result['rouge-l']['f']
     
 
@@ -618,3 +827,8 @@ def save_pickle(obj, path):
     with open(path, 'wb') as file:
         pickle.dump(obj, file)
 
+
+def load_pickle(path):
+    with open(path, 'rb') as file:
+        return pickle.load(file)
+
@@ -0,0 +1,139 @@
+import tempfile
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+import config
+import eval
+import models
+import utils
+
+# beam search of eval.Test over all examples and beams of a batch, against a search of one example at a time,
+# which decodes until no hypothesis is alive or max_decode_steps, the decoder is a random table of log probs
+# of the next word given the last one for each example, so that hypotheses end with EOS at varied lengths and
+# some short ones finish while longer ones, scored without EOS yet, are still ahead,
+# the returned hypotheses of both searches must have the same scores, sentences of equal scores may differ
+vocab_size = 20
+batch_size = 64
+max_decode_steps = 10
+logit_std = 2.
+eos_bias = 1.
+seed = 1
+beam_settings = [(1, 1), (3, 1), (5, 1), (5, 3)]  # beam_width, beam_top_sentences
+tolerance = 1e-5
+
+
+class BigramDecoder(nn.Module):
+    """
+    decoder whose log probs only depend on the last word, the hidden state is the index of the example,
+    so that it follows the beams of the example through the search
+    """
+
+    def __init__(self, log_probs):
+        """
+        :param log_probs: log probs of the next word given the last word of each example, [B, V, V]
+        """
+        super(BigramDecoder, self).__init__()
+        self.log_probs = log_probs
+
+    def project_keys(self, code_outputs, ast_outputs):
+        return code_outputs, ast_outputs
+
+    def forward(self, inputs, last_hidden, code_outputs, ast_outputs, keys=None, shortlist=None):
+        examples = last_hidden[0, :, 0].long()
+        return self.log_probs[examples, inputs], last_hidden, None, None
+
+
+def build_test_instance(log_probs):
+    """
+    eval.Test of a model with the bigram decoder, vocabularies are saved to a temporary vocab_dir
+    """
+    vocab = utils.Vocab('vocab')
+    vocab.add_sentence(['word_{}'.format(index) for index in range(vocab_size - len(vocab))])
+    config.vocab_dir = tempfile.mkdtemp()
+    for name in ('code_vocab.pk', 'ast_vocab.pk', 'nl_vocab.pk'):
+        vocab.save(name)
+
+    model = models.Model(vocab_size, vocab_size, vocab_size, is_eval=True,
+                         model_config={'hidden_size': 1, 'embedding_dim': 1, 'nl_vocab_size': vocab_size})
+    model.decoder = BigramDecoder(log_probs)
+    return eval.Test(model, code_path=None, vocab_path=('code_vocab.pk', 'ast_vocab.pk', 'nl_vocab.pk'),
+                     decode_method='beam', use_shortlist=False)
+
+
+def random_log_probs(nl_vocab):
+    """
+    log probs of the next word given the last one of each example, [B, V, V], pad, SOS and unk are never decoded
+    """
+    logits = torch.randn(batch_size, vocab_size, vocab_size) * logit_std
+    logits[:, :, utils.get_eos_index(nl_vocab)] += eos_bias
+    for word in (utils.get_pad_index(nl_vocab), utils.get_sos_index(nl_vocab), nl_vocab.word2index[utils._UNK]):
+        logits[:, :, word] = float('-inf')
+    return F.log_softmax(logits, dim=2)
+
+
+def sentence_score(log_probs, sentence):
+    """
+    sum of log probs / length of a sentence, as scored by both searches
+    :param log_probs: log probs of one example, [V, V]
+    """
+    return sum(log_probs[word, next_word].item() for word, next_word in zip(sentence[:-1], sentence[1:])) / len(sentence)
+
+
+def reference_beam_decode(log_probs, sos_index, eos_index):
+    """
+    beam search of one example, a hypothesis is (sentence indices, sum of log probs),
+    beams ended with EOS are finished, the beams alive at max_decode_steps compete with the finished ones
+    :param log_probs: log probs of one example, [V, V]
+    :return: sentences
+    """
+    alive = [([sos_index], 0.)]
+    finished = []
+    for _ in range(config.max_decode_steps):
+        if not alive:
+            break
+        extensions = [(sentence + [word], log_prob + word_log_prob)
+                      for sentence, log_prob in alive
+                      for word, word_log_prob in enumerate(log_probs[sentence[-1]].tolist())]
+        extensions = sorted(extensions, key=lambda item: item[1], reverse=True)[: config.beam_width]
+        finished += [extension for extension in extensions if extension[0][-1] == eos_index]
+        alive = [extension for extension in extensions if extension[0][-1] != eos_index]
+    hypotheses = sorted(finished + alive, key=lambda item: item[1] / len(item[0]), reverse=True)
+    return [sentence for sentence, _ in hypotheses[: config.beam_top_sentences]]
+
+
+torch.manual_seed(seed)
+config.max_decode_steps = max_decode_steps
+nl_vocab = utils.Vocab('vocab')
+nl_vocab.add_sentence(['word_{}'.format(index) for index in range(vocab_size - len(nl_vocab))])
+log_probs = random_log_probs(nl_vocab)
+test_instance = build_test_instance(log_probs)
+sos_index = utils.get_sos_index(test_instance.nl_vocab)
+eos_index = utils.get_eos_index(test_instance.nl_vocab)
+encoder_outputs = torch.zeros((1, batch_size, 1))
+decoder_hidden = torch.arange(batch_size, dtype=torch.float).view(1, batch_size, 1)
+
+all_match = True
+for beam_width, beam_top_sentences in beam_settings:
+    config.beam_width = beam_width
+    config.beam_top_sentences = beam_top_sentences
+    batch_sentences = test_instance.beam_decode(batch_size, encoder_outputs, encoder_outputs, decoder_hidden)
+    mismatches = 0
+    truncated = 0
+    for index_batch in range(batch_size):
+        sentences = reference_beam_decode(log_probs[index_batch], sos_index, eos_index)
+        scores = [sentence_score(log_probs[index_batch], sentence) for sentence in sentences]
+        batch_scores = [sentence_score(log_probs[index_batch], sentence) for sentence in batch_sentences[index_batch]]
+        if len(batch_scores) != len(scores) or \
+                any(abs(batch_score - score) > tolerance for batch_score, score in zip(batch_scores, scores)):
+            mismatches += 1
+        # a sentence without EOS is only returned at max_decode_steps
+        truncated += any(sentence[-1] != eos_index and len(sentence) <= max_decode_steps
+                         for sentence in batch_sentences[index_batch])
+    print('beam width {}, top {}: {}/{} examples differ, {} truncated without EOS, {}'.format(
+        beam_width, beam_top_sentences, mismatches, batch_size, truncated, 'ok' if mismatches == 0 else 'MISMATCH'))
+    all_match &= mismatches == 0
+
+print('Batch beam search matches the search of one example at a time.' if all_match
+      else 'Batch beam search does not match the search of one example at a time.')
@@ -0,0 +1,82 @@
+import random
+
+import torch
+import torch.nn as nn
+import learn2learn as l2l
+
+import config
+import models
+import utils
+
+# a tiny model with activation checkpointing, see config.use_activation_checkpoint, against the same model
+# without it: one meta step of metatrain_3.MetaTrain with two adapt steps of MAML, the second order meta
+# gradients must be the same, which they are not if the recomputation in backward uses the adapted parameters
+vocab_size = 40
+batch_size = 4
+code_length = 7
+nl_length = 5
+model_config = {'hidden_size': 16, 'embedding_dim': 8, 'nl_vocab_size': vocab_size,
+                'transformer_layers': 1, 'transformer_heads': 2, 'transformer_ff_size': 32}
+decoder_checkpoint_steps = 2    # less than nl_length, so that the decoder is checkpointed in chunks
+inner_train_steps = 2
+maml_lr = 0.1
+seed = 1
+tolerance = 1e-6
+
+nl_vocab = utils.Vocab('nl_vocab')
+nl_vocab.add_sentence(['word_{}'.format(index) for index in range(vocab_size - len(nl_vocab))])
+criterion = nn.NLLLoss(ignore_index=utils.get_pad_index(nl_vocab))
+# some steps without teacher forcing, so that chunks depend on outputs of the previous ones
+teacher_forcing = [step % 2 == 0 for step in range(nl_length)]
+
+
+def random_batch():
+    """
+    batch as from utils.collate_fn, all sequences of full length
+    """
+    first_word = len(utils._START_VOCAB)
+    return (torch.randint(first_word, vocab_size, (code_length, batch_size)), [code_length] * batch_size,
+            torch.randint(first_word, vocab_size, (code_length, batch_size)), [code_length] * batch_size,
+            torch.randint(first_word, vocab_size, (nl_length, batch_size)), [nl_length] * batch_size)
+
+
+def batch_loss(model, batch):
+    # the same dropout with and without checkpointing
+    torch.manual_seed(seed)
+    random.seed(seed)
+    decoder_outputs = model(batch, batch_size, nl_vocab, teacher_forcing=teacher_forcing)
+    return criterion(decoder_outputs.view(-1, vocab_size), batch[4].view(-1))
+
+
+def meta_grads(model, support_batch, query_batch, use_checkpoint):
+    """
+    meta gradients of metatrain_3.MetaTrain.train_iter on one project
+    """
+    config.use_activation_checkpoint = use_checkpoint
+    maml = l2l.algorithms.MAML(model, lr=maml_lr)
+    maml.zero_grad()
+    task_model = maml.clone()
+    for _ in range(inner_train_steps):
+        task_model.adapt(batch_loss(task_model, support_batch))
+    batch_loss(task_model, query_batch).backward()
+    return [param.grad.to_dense() if param.grad.is_sparse else param.grad.clone() for param in maml.parameters()]
+
+
+config.decoder_checkpoint_steps = decoder_checkpoint_steps
+all_match = True
+for encoder_type in ('gru', 'transformer'):
+    torch.manual_seed(seed)
+    model = models.Model(vocab_size, vocab_size, vocab_size, model_config=dict(model_config, encoder_type=encoder_type))
+    support_batch, query_batch = random_batch(), random_batch()
+    plain_grads = meta_grads(model, support_batch, query_batch, use_checkpoint=False)
+    checkpoint_grads = meta_grads(model, support_batch, query_batch, use_checkpoint=True)
+    max_grad = max(grad.abs().max().item() for grad in plain_grads)
+    max_error = max((plain_grad - checkpoint_grad).abs().max().item()
+                    for plain_grad, checkpoint_grad in zip(plain_grads, checkpoint_grads))
+    print('{} encoders: max meta gradient {:.6f}, max error {:.3e}, {}'.format(
+        encoder_type, max_grad, max_error, 'ok' if max_error <= tolerance else 'MISMATCH'))
+    all_match &= max_error <= tolerance
+config.use_activation_checkpoint = False
+
+print('Meta gradients with activation checkpointing match those without.' if all_match
+      else 'Meta gradients with activation checkpointing do not match those without.')
@@ -0,0 +1,78 @@
+import os
+import sys
+import time
+
+import config
+import metrics
+import utils
+
+# test details files written by eval.Test, see config.save_test_details, default to all files in config.out_dir
+details_paths = sys.argv[1:]
+if not details_paths:
+    details_paths = [os.path.join(config.out_dir, name) for name in sorted(os.listdir(config.out_dir))
+                     if name.startswith('test_details_')]
+tolerance = 1e-9
+
+
+def load_test_details(path):
+    """
+    references and candidates of a test details file
+    """
+    references = []
+    candidates = []
+    with open(path, encoding='utf-8') as file:
+        for line in file:
+            words = line.rstrip('\n').split(' ')
+            if words[0] == 'Reference:':
+                references.append(words[1:])
+            elif words[0] == 'Candidate:':
+                candidates.append(words[1:])
+    return references, candidates
+
+
+def compare(name, reference_scores, scores, reference_time, score_time):
+    errors = [abs(reference_score - score) for reference_score, score in zip(reference_scores, scores)]
+    max_error = max(errors) if errors else 0
+    print('{}: max error {:.3e}, {}, reference {:.3f}s, native {:.3f}s, {:.1f}x faster'.format(
+        name, max_error, 'ok' if max_error <= tolerance else 'MISMATCH', reference_time, score_time,
+        reference_time / max(score_time, 1e-9)))
+    return max_error <= tolerance
+
+
+all_match = True
+for path in details_paths:
+    references, candidates = load_test_details(path)
+    print('{}: {} samples'.format(path, len(candidates)))
+
+    start_time = time.time()
+    nltk_scores = [utils.nltk_sentence_bleu_score(reference, candidate)
+                   for reference, candidate in zip(references, candidates)]
+    nltk_time = time.time() - start_time
+    start_time = time.time()
+    scores = metrics.sentence_bleu_scores(references, candidates).tolist()
+    all_match &= compare('s_bleu', nltk_scores, scores, nltk_time, time.time() - start_time)
+
+    start_time = time.time()
+    nltk_score = utils.nltk_corpus_bleu_score(references, candidates)
+    nltk_time = time.time() - start_time
+    start_time = time.time()
+    score = metrics.corpus_bleu_score(references, candidates)
+    all_match &= compare('c_bleu', [nltk_score], [score], nltk_time, time.time() - start_time)
+
+    start_time = time.time()
+    package_scores = [utils.package_rouge(reference, candidate)
+                      for reference, candidate in zip(references, candidates)]
+    package_time = time.time() - start_time
+    start_time = time.time()
+    scores = metrics.rouge_l_scores(references, candidates).tolist()
+    all_match &= compare('rouge_L', package_scores, scores, package_time, time.time() - start_time)
+
+    start_time = time.time()
+    nltk_scores = [utils.nltk_meteor_score(reference, candidate)
+                   for reference, candidate in zip(references, candidates)]
+    nltk_time = time.time() - start_time
+    start_time = time.time()
+    scores = metrics.meteor_scores(references, candidates).tolist()
+    all_match &= compare('meteor', nltk_scores, scores, nltk_time, time.time() - start_time)
+
+print('All scores match.' if all_match else 'Some scores do not match.')
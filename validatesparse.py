@@ -0,0 +1,121 @@
+import random
+
+import torch
+import torch.nn as nn
+from torch.optim import SGD
+import learn2learn as l2l
+
+import config
+import models
+import utils
+
+# a tiny model trained with sparse embedding gradients, see config.use_sparse_embedding, against the same model
+# with dense ones: one step of train.Train, and one meta step of metatrain_3.MetaTrain with an adapt step of MAML,
+# gradients after clipping, adapted parameters and parameters after the steps must be the same
+vocab_size = 40
+batch_size = 4
+code_length = 7
+nl_length = 5
+model_config = {'hidden_size': 16, 'embedding_dim': 8, 'nl_vocab_size': vocab_size}
+sgd_lr = 0.5   # as train.Train without adam
+maml_lr = 0.1
+max_norm = 0.1      # small enough that gradients are clipped
+seed = 1
+tolerance = 1e-6
+
+nl_vocab = utils.Vocab('nl_vocab')
+nl_vocab.add_sentence(['word_{}'.format(index) for index in range(vocab_size - len(nl_vocab))])
+criterion = nn.NLLLoss(ignore_index=utils.get_pad_index(nl_vocab))
+
+
+def random_batch():
+    """
+    batch as from utils.collate_fn, all sequences of full length
+    """
+    first_word = len(utils._START_VOCAB)
+    return (torch.randint(first_word, vocab_size, (code_length, batch_size)), [code_length] * batch_size,
+            torch.randint(first_word, vocab_size, (code_length, batch_size)), [code_length] * batch_size,
+            torch.randint(first_word, vocab_size, (nl_length, batch_size)), [nl_length] * batch_size)
+
+
+def build_model(sparse, state_dict=None):
+    config.use_sparse_embedding = sparse
+    model = models.Model(vocab_size, vocab_size, vocab_size, model_config=model_config)
+    if state_dict is not None:
+        model.load_state_dict(state_dict)
+    return model
+
+
+def batch_loss(model, batch):
+    # the same dropout in both models
+    torch.manual_seed(seed)
+    random.seed(seed)
+    decoder_outputs = model(batch, batch_size, nl_vocab, teacher_forcing=[True] * nl_length)
+    return criterion(decoder_outputs.view(-1, vocab_size), batch[4].view(-1))
+
+
+def dense_grads(module) -> list:
+    return [param.grad.to_dense() if param.grad.is_sparse else param.grad for param in module.parameters()]
+
+
+def train_step(model, batch):
+    """
+    step of train.Train.train_one_batch, with sgd as the update of utils.RowSparseAdam is the one of
+    torch.optim.SparseAdam, which differs from that of dense adam by the scale of eps in the first steps
+    :return: total norm of the gradients, clipped gradients
+    """
+    optimizer = SGD(model.parameters(), lr=sgd_lr)
+    batch_loss(model, batch).backward()
+    grad_norm = utils.clip_grad_norm(model.parameters(), max_norm)
+    grads = dense_grads(model)
+    optimizer.step()
+    return grad_norm.item(), grads
+
+
+def meta_step(model, support_batch, query_batch):
+    """
+    step of metatrain_3.MetaTrain.train_iter on one project with one adapt step, with sgd as train_step
+    :return: total norm of the meta gradients, parameters of the adapted model and clipped meta gradients
+    """
+    maml = l2l.algorithms.MAML(model, lr=maml_lr)
+    optimizer = SGD(maml.parameters(), lr=sgd_lr)
+    task_model = maml.clone()
+    task_model.adapt(batch_loss(task_model, support_batch))
+    adapted_params = [param.detach().clone() for param in task_model.parameters()]
+    batch_loss(task_model, query_batch).backward()
+    grad_norm = utils.clip_grad_norm(maml.parameters(), max_norm)
+    grads = dense_grads(maml)
+    optimizer.step()
+    return grad_norm.item(), adapted_params + grads
+
+
+def compare(name, dense_model, sparse_model, dense_results, sparse_results):
+    """
+    compare gradient norms, the other tensors of results, and parameters after the step
+    """
+    dense_norm, dense_tensors = dense_results
+    sparse_norm, sparse_tensors = sparse_results
+    dense_tensors = dense_tensors + list(dense_model.parameters())
+    sparse_tensors = sparse_tensors + list(sparse_model.parameters())
+    max_error = max((dense_tensor - sparse_tensor).abs().max().item()
+                    for dense_tensor, sparse_tensor in zip(dense_tensors, sparse_tensors))
+    max_error = max(max_error, abs(dense_norm - sparse_norm))
+    print('{}: gradient norm {:.6f} dense, {:.6f} sparse, max error {:.3e}, {}'.format(
+        name, dense_norm, sparse_norm, max_error, 'ok' if max_error <= tolerance else 'MISMATCH'))
+    return max_error <= tolerance
+
+
+torch.manual_seed(seed)
+dense_model = build_model(sparse=False)
+sparse_model = build_model(sparse=True, state_dict=dense_model.state_dict())
+batch = random_batch()
+all_match = compare('train step', dense_model, sparse_model,
+                    train_step(dense_model, batch), train_step(sparse_model, batch))
+
+support_batch, query_batch = random_batch(), random_batch()
+all_match &= compare('maml step', dense_model, sparse_model,
+                     meta_step(dense_model, support_batch, query_batch),
+                     meta_step(sparse_model, support_batch, query_batch))
+config.use_sparse_embedding = False
+
+print('Sparse embedding steps match dense ones.' if all_match else 'Sparse embedding steps do not match dense ones.')